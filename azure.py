@@ -1,148 +1,139 @@
+import json
 import requests
 import base64
 from configuration import Configuration
+from httpClient import HttpClient, AsyncHttpClient, TokenBucket
 
 
 class Azure:
     __token64 = base64.b64encode((":" + Configuration.azureToken).encode()).decode()
 
-    create_item_template = """[
-        {{
-            'op': 'add',
-            'path': '/fields/System.CreatedDate',
-            'value': '{created_date}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.Title',
-            'value': '{title}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.CreatedBy',
-            'value': '{created_by}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.Tags',
-            'value': '{tags}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/Microsoft.VSTS.Common.Priority',
-            'value': '{priority}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.AssignedTo',
-            'value': '{assignee}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.State',
-            'value': '{status}'
-        }}
-        ]"""
-
-    patch_attachment_template = """[
-        {{
-            'op': 'add',
-            'path': '/relations/-',
-            'value': 
-            {{
-                'rel': 'AttachedFile',
-                'url': '{url}',
-                'attributes': 
-                {{
-                    'comment': ''
-                }}
-            }}
-        }}
-        ]"""
-
-    patch_closed_date_template = """[
-        {{
-            'op': 'replace',
-            'path': '/fields/Microsoft.VSTS.Common.ClosedDate',
-            'value': '{date}'
-        }}
-        ]"""
-
-    patch_description_template = """[
-        {{
-            'op': 'replace',
-            'path': '/fields/System.Description',
-            'value': '{description}'
-        }}
-        ]"""
-
-    patch_repro_steps_template = """[
-        {{
-            'op': 'replace',
-            'path': '/fields/Microsoft.VSTS.TCM.ReproSteps',
-            'value': '{description}'
-        }}
-        ]"""
-
-    patch_add_comment_template = """[
-        {{
-            'op': 'add',
-            'path': '/fields/System.History',
-            'value': '{html}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.ChangedBy',
-            'value': '{author}'
-        }},
-        {{
-            'op': 'add',
-            'path': '/fields/System.createdDate',
-            'value': '{date}'
-        }}
-        ]"""
-
-    patch_add_related_template = f"""[
-    {{{{
-        'op': 'add',
-        'path': '/relations/-',
-        'value': 
-        {{{{
-            'rel': 'System.LinkTypes.Related',
-            'url': 
-            '{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}/workItems/{{id}}',
-            'attributes': 
-            {{{{
-                'isLocked': false,
-                'name': 'Related'
-            }}}}
-        }}}}
-    }}}}
-    ]"""
-
-    patch_add_parent_template = f"""[
-    {{{{
-        'op': 'add',
-        'path': '/relations/-',
-        'value': 
-        {{{{
-            'rel': 'System.LinkTypes.Hierarchy-Reverse',
-            'url': 
-            '{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}/workItems/{{id}}',
-            'attributes': 
-            {{{{
-                'isLocked': false,
-                'name': 'Parent'
-            }}}}
-        }}}}
-    }}}}
-    ]"""
+    # one pooled client and one rate limiter for all the Azure calls of the process;
+    # only throttling is retried, other failures of POST\PATCH might have been applied already
+    client = HttpClient(name="azure",
+                        pool_size=Configuration.azurePoolSize,
+                        timeout=Configuration.azureTimeout,
+                        retries=Configuration.azureRetries,
+                        retry_statuses=frozenset([429, 503]),
+                        limiter=TokenBucket(Configuration.azureRequestRate))
+
+    @staticmethod
+    def async_client() -> AsyncHttpClient:
+        """
+        client for asyncio mode, requests are limited by the rate limiter of Azure.client
+        :return: client to be opened on the event loop by async with
+        """
+        return AsyncHttpClient(name="azure",
+                               pool_size=Configuration.azurePoolSize,
+                               timeout=Configuration.azureTimeout,
+                               retries=Configuration.azureRetries,
+                               retry_statuses=frozenset([429, 503]),
+                               limiter=Azure.client.limiter)
 
     @staticmethod
     def address(path: str, args: str = ''):
         return f"{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}"\
                f"/_apis/wit{path}?{args}api-version={Configuration.azureApiVersion}"
 
+    @staticmethod
+    def query_address(path: str, args: str = ''):
+        # WIQL and workitemsbatch are versioned apart from the work item endpoints
+        return f"{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}"\
+               f"/_apis/wit{path}?{args}api-version={Configuration.azureQueryApiVersion}"
+
+    @staticmethod
+    def batch_address():
+        return f"{Configuration.azureAddress}/{Configuration.azureOrganization}"\
+               f"/_apis/wit/$batch?api-version={Configuration.azureBatchApiVersion}"
+
+    @staticmethod
+    def batch_uri(path: str, args: str = ''):
+        # address of a single operation inside $batch request, relative to organization
+        return f"/{Configuration.azureProject}/_apis/wit{path}?{args}api-version={Configuration.azureBatchApiVersion}"
+
+    @staticmethod
+    def workitem_url(wid: str):
+        return f"{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}"\
+               f"/workItems/{wid}"
+
+    @staticmethod
+    def payload(document) -> bytes:
+        """
+        serialize json-patch document or $batch request: compact json in UTF-8, non-ASCII text is not escaped
+        :param document: list of operations
+        :return: request body
+        """
+        return json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def create_item_ops(created_date: str, title: str, created_by: str, tags: str,
+                        priority: str, assignee: str, status: str) -> list[dict]:
+        fields = [("System.CreatedDate", created_date),
+                  ("System.Title", title),
+                  ("System.CreatedBy", created_by),
+                  ("System.Tags", tags),
+                  ("Microsoft.VSTS.Common.Priority", priority),
+                  ("System.AssignedTo", assignee),
+                  ("System.State", status)]
+        return [Azure.field_op(name, value) for name, value in fields]
+
+    @staticmethod
+    def update_item_ops(title: str, tags: str, priority: str, assignee: str, status: str) -> list[dict]:
+        # fields set by create_item_ops() which may change in Redmine later
+        fields = [("System.Title", title),
+                  ("System.Tags", tags),
+                  ("Microsoft.VSTS.Common.Priority", priority),
+                  ("System.AssignedTo", assignee),
+                  ("System.State", status)]
+        return [Azure.field_op(name, value) for name, value in fields]
+
+    @staticmethod
+    def field_op(field: str, value: str, op: str = 'add') -> dict:
+        return {"op": op, "path": f"/fields/{field}", "value": value}
+
+    @staticmethod
+    def comment_ops(html: str, author: str, date: str) -> list[dict]:
+        return [Azure.field_op("System.History", html),
+                Azure.field_op("System.ChangedBy", author),
+                Azure.field_op("System.createdDate", date)]
+
+    @staticmethod
+    def attachment_op(url: str) -> dict:
+        return {
+            "op": "add",
+            "path": "/relations/-",
+            "value": {
+                "rel": "AttachedFile",
+                "url": url,
+                "attributes": {"comment": ""}
+            }
+        }
+
+    @staticmethod
+    def add_link_op(rel: str, wid: str, name: str) -> dict:
+        # rel: 'System.LinkTypes.Hierarchy-Reverse' for parent, 'System.LinkTypes.Related' for related item
+        return {
+            "op": "add",
+            "path": "/relations/-",
+            "value": {
+                "rel": rel,
+                "url": Azure.workitem_url(wid),
+                "attributes": {"isLocked": False, "name": name}
+            }
+        }
+
+    @staticmethod
+    def post(url: str, **kwargs) -> requests.Response:
+        return Azure.client.post(url, **kwargs)
+
+    @staticmethod
+    def patch(url: str, **kwargs) -> requests.Response:
+        return Azure.client.patch(url, **kwargs)
+
+    @staticmethod
+    def put(url: str, **kwargs) -> requests.Response:
+        return Azure.client.request("PUT", url, **kwargs)
+
     @staticmethod
     def header(app_content: str = 'json-patch+json'):
         return {
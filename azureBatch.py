@@ -0,0 +1,131 @@
+import json
+import requests
+from typing import Callable
+from azure import Azure
+from httpClient import HttpClient
+
+
+class AzureBatch:
+    """
+    Collects work item create and update operations and sends them to Azure DevOps $batch endpoint.
+    Every operation is identified by a key given by the caller (Redmine ID), results are returned per key.
+    Only operations which provably haven't been applied are resent: the ones throttled by Azure (429/503)
+    and the ones of a request which never reached the server. Operations which failed after they might have
+    been applied (5xx, timeout or connection lost while waiting for the response) are resent only if
+    the recover callback of send() doesn't find them applied, otherwise they are reported as failed.
+    """
+    max_size = 200
+    retry_codes = frozenset([429, 503])
+
+    def __init__(self, size: int = max_size, retries: int = 3):
+        self.size = max(1, min(size, self.max_size))
+        self.retries = retries
+        self.operations: dict[str, dict] = {}
+
+    def add(self, key: str, method: str, uri: str, ops: list[dict]):
+        self.operations[key] = {
+            "method": method,
+            "uri": uri,
+            "headers": {"Content-Type": "application/json-patch+json"},
+            "body": ops
+        }
+
+    def __post(self, keys: list[str]) -> list[dict]:
+        """
+        :return: results of the operations; BatchError tells whether the failed request hasn't been applied
+        ('retry'), might have been applied ('unknown') or has been rejected ('failed')
+        """
+        try:
+            response = Azure.post(Azure.batch_address(),
+                                  headers=Azure.header('json'),
+                                  data=Azure.payload([self.operations[k] for k in keys]))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise BatchError(f"{e}", "unknown" if HttpClient.sent(e) else "retry")
+        if response.status_code in self.retry_codes:
+            raise BatchError(f"Server is busy [{response.status_code}]", "retry")
+        if not response.ok:
+            raise BatchError(f"Server responded False [{response.text}]",
+                             "unknown" if response.status_code >= 500 else "failed")
+
+        results = json.loads(response.content)["value"]
+        if len(results) != len(keys):
+            raise BatchError(f"Server returned {len(results)} results for {len(keys)} operations", "unknown")
+        return results
+
+    def send(self,
+             on_done: Callable[[str, dict], None] = None,
+             recover: Callable[[list[str]], dict[str, dict]] = None) -> dict[str, dict]:
+        """
+        send all the collected operations
+        :param on_done: optional callback called with key and response body as soon as an operation succeeds
+        :param recover: optional callback looking up operations which failed after they might have been applied,
+        returns key -> response body of the ones which have been applied, the rest of them are resent
+        :return: dictionary of key -> response body of successful operation,
+        failed operations are reported and missing in the result
+        """
+        done = {}
+        errors = {}
+
+        def succeeded(k: str, body: dict):
+            done[k] = body
+            errors.pop(k, None)
+            if on_done:
+                on_done(k, body)
+
+        pending = list(self.operations)
+        for attempt in range(self.retries + 1):
+            retry = []
+            unknown = []
+            for start in range(0, len(pending), self.size):
+                keys = pending[start:start + self.size]
+                try:
+                    results = self.__post(keys)
+                except BatchError as e:
+                    errors.update({k: f"{e}" for k in keys})
+                    retry.extend(keys if e.reason == "retry" else [])
+                    unknown.extend(keys if e.reason == "unknown" else [])
+                    continue
+
+                for k, r in zip(keys, results):
+                    code = r.get("code", 0)
+                    if 200 <= code < 300:
+                        succeeded(k, json.loads(r["body"]) if isinstance(r.get("body"), str) else r.get("body"))
+                    else:
+                        errors[k] = f"code {code} [{r.get('body')}]"
+                        if code in self.retry_codes:
+                            retry.append(k)
+                        elif code >= 500:
+                            unknown.append(k)
+
+            if unknown and recover:
+                try:
+                    applied = recover(unknown)
+                except Exception as e:
+                    print(f"Warning: $batch: cannot look up {len(unknown)} operations "
+                          f"which might have been applied [{e}]")
+                    applied = None
+                for k in unknown if applied is not None else []:
+                    if k in applied:
+                        succeeded(k, applied[k])
+                    else:
+                        retry.append(k)
+            for k in unknown:
+                if k in errors and k not in retry:
+                    errors[k] += ", it might have been applied, not sent again"
+
+            if not retry or attempt == self.retries:
+                break
+            pending = retry
+            print(f"Warning: $batch: {len(retry)} operations failed, retry #{attempt + 1}")
+
+        for k, e in errors.items():
+            print(f"Error: $batch: operation for {k} failed [{e}]")
+
+        self.operations.clear()
+        return done
+
+
+class BatchError(Exception):
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason  # 'retry', 'unknown' or 'failed', see AzureBatch.__post()
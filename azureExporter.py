@@ -1,80 +1,519 @@
 import os
+import re
 import json
+import asyncio
+import threading
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from configuration import Configuration
 from azureItem import AzureItem
+from azureBatch import AzureBatch
+from azure import Azure
+from migrationState import MigrationState
+from dumpStore import DumpStore
+from metrics import metrics
 
 
 class AzureExporter:
+    query_page_size = 10000   # ids returned by one WIQL query, Azure fails queries with more than 20000 results
+    titles_batch_size = 200   # max ids of one workitemsbatch request
 
     def __init__(self,
                  redmine_dir: str = Configuration.redmineDumpDir,
-                 working_dir: str = Configuration.azureWorkingDir):
+                 working_dir: str = Configuration.azureWorkingDir,
+                 store: DumpStore = None,
+                 state: MigrationState = None):
 
         os.makedirs(working_dir, exist_ok=True)
 
         self.redmineDir: str = redmine_dir
         self.workingDir: str = working_dir
-        self.azureItems: list[AzureItem] = []
+        self.store: DumpStore = store or DumpStore.open(redmine_dir)
+        self.index: dict[str, dict] = {}  # Redmine ID -> manifest entry, see RedmineItem.summary()
+        self.state = state or MigrationState(working_dir)
+        self.cancel = threading.Event()  # set by another thread to stop the running step after the current item
         self.redmineToAzureMap: dict[str, str] = {}
+        self.load_map()
 
     def load(self, wish_list: list = None):
+        """
+        read index of the dumped tickets, items themselves are loaded from the dump only when they are processed
+        :param wish_list: optional list of Redmine IDs to export, all the dumped tickets otherwise
+        """
         print(f"Start loading Redmine tickets from {self.redmineDir}...")
-        rids = os.listdir(self.redmineDir)
-        for d in rids:
-            rid_path = os.path.join(self.redmineDir, d)
-            wid_path = os.path.join(self.workingDir, d)
-            if os.path.isdir(rid_path) and True if wish_list is None else d in wish_list:
-                ai = AzureItem(rid_path, wid_path)
-                ai.load()
-                self.azureItems.append(ai)
-                print(d)
-
-        print(f"Loaded {len(self.azureItems)} items.")
-
-    def create(self) -> bool:
-
-        if bool(self.redmineToAzureMap):
-            print("Error: cannot do create second time")
-            return False
+        wanted = None if wish_list is None else {f"{w}" for w in wish_list}
+        try:
+            with open(os.path.join(self.redmineDir, DumpStore.manifest_name), "r") as data:
+                issues = json.load(data)["issues"]
+        except Exception as e:
+            print(f"Warning: dump manifest not found, scan {self.redmineDir} [{e}]")
+            issues = {}
 
-        print(f"Start creating Azure work items...")
+        # manifest misses issues dumped before it was introduced or after its last save before a crash
+        missing = {d for d in self.store.ids() if d not in issues and (wanted is None or d in wanted)}
+        if missing and issues:
+            print(f"Warning: {len(missing)} dumped issues are not in the manifest, scan them")
+        if missing:
+            issues.update(self.scan(missing))
+
+        self.index = {rid: entry for rid, entry in issues.items() if wanted is None or rid in wanted}
+        print(f"Loaded {len(self.index)} items.")
+
+    def scan(self, wanted: set[str] = None) -> dict[str, dict]:
+        # index of dumps which are not in the manifest, data of every issue has to be read
+        issues = {}
+        for d in self.store.ids():
+            if wanted is not None and d not in wanted:
+                continue
+            try:
+                rd = self.store.data(d)
+                issues[d] = {"tracker": rd.get("tracker"),
+                             "status": rd.get("status"),
+                             "parent": rd.get("parent"),
+                             "relations": rd.get("relations") or []}
+            except Exception as e:
+                print(f"Warning: {d}: not a dumped ticket, skip [{e}]")
+
+        return issues
+
+    def item(self, rid: str) -> AzureItem:
+        a = AzureItem(self.store, rid, os.path.join(self.workingDir, rid), self.state)
+        a.load()
+        return a
+
+    def __ids(self) -> Iterator[str]:
+        for rid in self.index:
+            if self.cancel.is_set():
+                print(f"Warning: cancelled before {rid}")
+                return
+            yield rid
 
-        redmine2azure_path = os.path.join(self.workingDir, "redmine2azure.json")
+    def items(self) -> Iterator[AzureItem]:
+        # items are loaded one by one, only the index is kept in memory
+        for rid in self.__ids():
+            yield self.item(rid)
+
+    def load_map(self):
+        # map of Redmine->Azure items is kept in migration state, items which are in map are not created again;
+        # redmine2azure.json of older versions is imported on the first run
+        self.redmineToAzureMap = self.state.map()
+        if self.redmineToAzureMap:
+            return
         try:
-            # go to self.workingDir and find if there is a stored map of Redmine->Azure items
-            # we should skip creating items which are in map
-            with open(redmine2azure_path, "r") as data:
-                self.redmineToAzureMap = json.load(data)
+            with open(os.path.join(self.workingDir, "redmine2azure.json"), "r") as data:
+                self.state.import_map(json.load(data))
+            self.redmineToAzureMap = self.state.map()
         except Exception as e:
             print(f'Info: redmine2azure not found, clean run [{e}]')
 
-        for idx, a in enumerate(self.azureItems):
-            aid = self.redmineToAzureMap.get(f"{a.rid}")
-            if aid:
-                print(f"Warning: {a.rid} already created, skip")
-                a.id = aid
-            elif a.create_workitem():
-                self.redmineToAzureMap[a.rid] = f"{a.id}"
+    def save_map(self):
+        # export of the map for other tools, migration state stays the source of truth
+        with open(os.path.join(self.workingDir, "redmine2azure.json"), "w+") as data:
+            json.dump(self.redmineToAzureMap, data, indent=4)
+
+    def __query_ids(self, after: int, rids: list[str] = None) -> list[int]:
+        # one page of ids of work items titled by create_workitem(), in ascending order
+        titles = " OR ".join(f"[System.Title] CONTAINS '[REDMINE{r}]'" for r in rids) if rids else \
+            "[System.Title] CONTAINS '[REDMINE'"
+        query = ("SELECT [System.Id] FROM WorkItems WHERE [System.TeamProject] = @project "
+                 f"AND ({titles}) AND [System.Id] > {after} ORDER BY [System.Id]")
+        response = Azure.post(Azure.query_address(path='/wiql', args=f'$top={self.query_page_size}&'),
+                              headers=Azure.header('json'),
+                              data=Azure.payload({"query": query}))
+        if not response.ok:
+            raise Exception(f"Server responded False [{response.text}]")
+        return [w["id"] for w in json.loads(response.content)["workItems"]]
 
-            print(f"Finished with #{idx} from #{len(self.azureItems)}")
+    @staticmethod
+    def __titles(ids: list[int]) -> dict[int, str]:
+        response = Azure.post(Azure.query_address(path='/workitemsbatch'),
+                              headers=Azure.header('json'),
+                              data=Azure.payload({"ids": ids, "fields": ["System.Id", "System.Title"]}))
+        if not response.ok:
+            raise Exception(f"Server responded False [{response.text}]")
+        return {w["id"]: w["fields"].get("System.Title", '') for w in json.loads(response.content)["value"]}
 
-        # save updated map
-        with open(redmine2azure_path, "w+") as data:
-            json.dump(self.redmineToAzureMap, data, indent=4)
+    def recover_map(self) -> bool:
+        """
+        rebuild map of Redmine->Azure items from Azure, e.g. when redmine2azure.json or the migration state
+        has been lost: ids of work items titled [REDMINE<id>] are found by paged WIQL queries and their titles
+        are read by workitemsbatch, titles_batch_size items per request. Items missing in the map are added
+        to it and to the migration state, so they are never created again; item created twice keeps the first id.
+        Only the map is recovered, patch steps done before the state has been lost are not known
+        :return: True if all the items have been looked up
+        """
+        print(f"Start looking for migrated work items in Azure...")
+        try:
+            with metrics.phase("recover") as phase:
+                found = self.__find_migrated(phase=phase)
+        except Exception as e:
+            print(f"Error: Azure: cannot look up migrated work items [{e}]")
+            metrics.error("recover")
+            return False
+
+        added = 0
+        for rid, aid in found.items():
+            known = self.redmineToAzureMap.get(rid)
+            if not known:
+                self.__created(rid, aid)
+                added += 1
+            elif known != aid:
+                print(f"Warning: {rid} is mapped to {known}, keep it instead of {aid} found in Azure")
+
+        print(f"Found {len(found)} migrated work items, {added} of them added to the map.")
+        self.save_map()
+        return True
+
+    def __find_migrated(self, rids: list[str] = None, phase=None) -> dict[str, str]:
+        """
+        :param rids: Redmine IDs to look up, all the migrated items by default
+        :param phase: optional phase advanced by every item found
+        :return: map of Redmine ID -> Azure ID of work items found in Azure
+        """
+        found: dict[str, str] = {}
+        duplicates = []
+        ids = self.__query_ids(0, rids)
+        while ids:
+            for start in range(0, len(ids), self.titles_batch_size):
+                titles = self.__titles(ids[start:start + self.titles_batch_size])
+                for aid, title in sorted(titles.items()):
+                    m = re.match(r"\[REDMINE(\d+)]", title)
+                    if not m or (rids and m.group(1) not in rids):
+                        continue
+                    if m.group(1) in found:
+                        duplicates.append(f"{aid}({m.group(1)})")
+                    else:
+                        found[m.group(1)] = f"{aid}"
+                if phase:
+                    phase.advance(len(titles))
+            ids = self.__query_ids(ids[-1], rids) if len(ids) == self.query_page_size else []
+
+        if duplicates:
+            print(f"Warning: {len(duplicates)} work items have been created twice: {', '.join(duplicates)}")
+        return found
+
+    def __find_created(self, rids: list[str]) -> dict[str, dict]:
+        # items of $batch which failed after it might have been applied, the ones missing in Azure are sent again
+        return {rid: {"id": int(aid)} for rid, aid in self.__find_migrated(rids).items()}
+
+    def __created(self, rid: str, aid: str):
+        self.state.set_azure_id(rid, aid)
+        self.redmineToAzureMap[rid] = f"{aid}"
+
+    @staticmethod
+    def __flush(batch: AzureBatch, on_done, force: bool = False, recover=None):
+        # operations are sent as soon as there are enough for one $batch request, so items are not kept in memory
+        if batch.operations and (force or len(batch.operations) >= batch.size):
+            batch.send(on_done, recover)
+            batch.operations.clear()
+
+    def create(self,
+               batch_size: int = Configuration.azureBatchSize,
+               recover: bool = Configuration.azureRecoverMap) -> bool:
+        """
+        create work items for all the loaded Redmine tickets which are not in redmine2azure map yet
+        :param batch_size: number of items created by one $batch request, 0 to create items one by one
+        :param recover: look up items of previous runs in Azure first, see recover_map()
+        :return: True if map has been saved
+        """
+        if recover and not self.recover_map():
+            return False
+
+        print(f"Start creating Azure work items...")
+
+        batch = AzureBatch(batch_size) if batch_size > 0 else None
+        created = lambda rid, body: self.__created(rid, body["id"])
+        with metrics.phase("create", len(self.index)) as phase:
+            for rid in self.__ids():
+                if rid in self.redmineToAzureMap:
+                    print(f"Warning: {rid} already created, skip")
+                    phase.advance()
+                    continue
+
+                a = self.item(rid)
+                if batch and a.type:
+                    batch.add(a.rid, *a.create_operation())
+                    self.__flush(batch, created, recover=self.__find_created)
+                elif a.create_workitem():
+                    self.redmineToAzureMap[a.rid] = f"{a.id}"
+
+                phase.advance()
+
+            if batch:
+                self.__flush(batch, created, force=True, recover=self.__find_created)
+
+        self.save_map()
+        return True
 
     def attachments(self) -> bool:
         print(f"Start creating Azure attachments...")
-        for idx, a in enumerate(self.azureItems):
-            a.create_attachments()
-            print(f"Finished with attachments for #{idx} from #{len(self.azureItems)}")
+        with metrics.phase("attachments", len(self.index)) as phase:
+            for a in self.items():
+                a.create_attachments()
+                phase.advance()
 
         return True
 
-    def patch(self) -> bool:
+    def patch(self,
+              batch_size: int = Configuration.azureBatchSize,
+              combined: bool = Configuration.azureCombinedPatch,
+              relations: bool = True) -> bool:
+        """
+        patch created work items: closed date, attachments, description, notes and relations
+        :param batch_size: relations of that many items are added by one $batch request, 0 to add them one by one
+        :param combined: send all the fields and links of an item by one request, notes are sent one by one
+        :param relations: add parent and related links, False to add them later by link()
+        :return: True
+        """
         print(f"Start patching Azure work items...")
-        for idx, a in enumerate(self.azureItems):
-            a.patch(self.redmineToAzureMap)
-            print(f"Finished with patching for #{idx} from #{len(self.azureItems)}")
+        batch = AzureBatch(batch_size) if batch_size > 0 else None
+        steps = {}
+        linked = lambda rid, body: self.state.mark_all(rid, steps.pop(rid))
+        with metrics.phase("patch", len(self.index)) as phase:
+            for a in self.items():
+                a.patch(self.redmineToAzureMap, relations=relations and batch is None, combined=combined)
+                if relations and batch and a.id:
+                    pending = [(step, op) for step, op in a.relation_steps(self.redmineToAzureMap)
+                               if not a.done(step)]
+                    if pending:
+                        steps[a.rid] = [step for step, _ in pending]
+                        batch.add(a.rid, "PATCH", Azure.batch_uri(path=f'/workitems/{a.id}'),
+                                  [op for _, op in pending])
+                        self.__flush(batch, linked)
+                phase.advance()
+
+            if batch:
+                self.__flush(batch, linked, force=True)
+
+        return True
+
+    def link(self, batch_size: int = Configuration.azureBatchSize) -> bool:
+        """
+        add parent and related links of created work items, nothing else is patched;
+        links of items patched by patch(relations=False) are added once the map is complete
+        :param batch_size: links of that many items are added by one $batch request, 0 for a request per item
+        :return: True
+        """
+        print(f"Start linking Azure work items...")
+        batch = AzureBatch(batch_size) if batch_size > 0 else None
+        steps = {}
+        linked = lambda rid, body: self.state.mark_all(rid, steps.pop(rid))
+        with metrics.phase("link", len(self.index)) as phase:
+            for a in self.items():
+                pending = [(step, op) for step, op in a.relation_steps(self.redmineToAzureMap)
+                           if not a.done(step)] if a.id else []
+                if pending and batch:
+                    steps[a.rid] = [step for step, _ in pending]
+                    batch.add(a.rid, "PATCH", Azure.batch_uri(path=f'/workitems/{a.id}'), [op for _, op in pending])
+                    self.__flush(batch, linked)
+                elif pending:
+                    a.patch_links(pending)
+                phase.advance()
+
+            if batch:
+                self.__flush(batch, linked, force=True)
+
+        return True
+
+    own_steps = "attachments"  # token of the item's own steps in the waiting set of run()
+
+    def __dependencies(self) -> tuple[dict[str, set[str]], dict[str, list[str]]]:
+        """
+        :return: tokens every item waits for before it's patched (items it links to which are not created yet
+        and own_steps), and items waiting for every item
+        """
+        waiting: dict[str, set[str]] = {}
+        dependents: dict[str, list[str]] = {}
+        for rid, entry in self.index.items():
+            # parent and related items, see AzureItem.link_targets()
+            targets = [entry["parent"]] if entry.get("parent") else []
+            targets += [f"{r}" for r in entry.get("relations") or []]
+            deps = {d for d in targets if d in self.index and d != rid and d not in self.redmineToAzureMap}
+            waiting[rid] = deps | {self.own_steps}
+            for d in deps:
+                dependents.setdefault(d, []).append(rid)
+
+        return waiting, dependents
+
+    def run(self,
+            workers: int = Configuration.azureWorkers,
+            combined: bool = Configuration.azureCombinedPatch,
+            recover: bool = Configuration.azureRecoverMap) -> bool:
+        """
+        create, attachments and patch steps for all the loaded items at once, items are processed in parallel.
+        An item is patched as soon as its own attachments are uploaded and the items it links to
+        (parent and related) are created, so links never wait for the whole project to be created:
+        at most `workers` items are being created at once and the next one is submitted only when one of them
+        is over, so patches of ready items are queued before the rest of the creations.
+        Notes of one item are still added in order by a single thread.
+        :param workers: number of items processed in parallel
+        :param combined: patch fields and links of an item by one request, see AzureItem.patch_combined()
+        :param recover: look up items of previous runs in Azure first, see recover_map()
+        :return: True, False if items of previous runs couldn't be looked up
+        """
+        if recover and not self.recover_map():
+            return False
+
+        print(f"Start exporting {len(self.index)} Azure work items by {workers} workers...")
+
+        own = self.own_steps
+        waiting, dependents = self.__dependencies()
+        lock = threading.Lock()
+        finished = threading.Event()
+        progress = {"done": 0}
+        phase = None
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        slots = threading.Semaphore(max(1, workers))
+
+        def release(rid: str, token: str):
+            # token is resolved for the item rid, patch it if nothing else is left
+            with lock:
+                pending = waiting[rid]
+                pending.discard(token)
+                ready = not pending
+            if ready:
+                executor.submit(patch_item, rid)
+
+        def create_item(rid: str):
+            a = None
+            try:
+                a = self.item(rid)
+                aid = self.redmineToAzureMap.get(rid)
+                if aid:
+                    print(f"Warning: {rid} already created, skip")
+                    a.id = aid
+                elif a.create_workitem():
+                    with lock:
+                        self.redmineToAzureMap[rid] = f"{a.id}"
+            finally:
+                # failed item is resolved as well, dependent items are patched without the link
+                with lock:
+                    waiters = dependents.pop(rid, [])
+                for w in waiters:
+                    release(w, rid)
+
+            try:
+                if a and a.id:
+                    a.create_attachments()
+            finally:
+                # patch of the item is queued before the next creation
+                release(rid, own)
+                slots.release()
+
+        def patch_item(rid: str):
+            # the item is loaded again, its Azure ID and attachments are restored from the migration state
+            try:
+                self.item(rid).patch(self.redmineToAzureMap, combined=combined)
+            except Exception as e:
+                print(f"Error: {self.redmineToAzureMap.get(rid, 0)}({rid}): patch failed [{e}]")
+                metrics.error("patch")
+            phase.advance()
+            with lock:
+                progress["done"] += 1
+                if progress["done"] == len(self.index):
+                    finished.set()
+
+        try:
+            with metrics.phase("export", len(self.index)) as phase:
+                for rid in self.index:
+                    # backpressure: the next item is created only when one of the creations is over
+                    slots.acquire()
+                    executor.submit(create_item, rid)
+                if self.index:
+                    finished.wait()
+        finally:
+            executor.shutdown(wait=True)
+            self.save_map()
+
+        return True
+
+    async def run_async(self,
+                        tasks: int = Configuration.azureAsyncTasks,
+                        combined: bool = Configuration.azureCombinedPatch,
+                        recover: bool = Configuration.azureRecoverMap) -> bool:
+        """
+        run() on one event loop instead of a thread pool: every item is an asyncio task and at most `tasks`
+        of them are in flight, requests wait for one of azurePoolSize connections of the async client
+        and share the rate limiter with the synchronous client. Items are created, uploaded and patched
+        by the same requests in the same order as by run(). Requires aiohttp.
+        Run it by asyncio.run(exporter.run_async())
+        :param tasks: number of items processed at once
+        :param combined: patch fields and links of an item by one request, see AzureItem.patch_combined()
+        :param recover: look up items of previous runs in Azure first, see recover_map()
+        :return: True, False if items of previous runs couldn't be looked up
+        """
+        # the lookup takes a few dozens of requests, it's done before any task starts
+        if recover and not await asyncio.to_thread(self.recover_map):
+            return False
+
+        print(f"Start exporting {len(self.index)} Azure work items by {tasks} asyncio tasks...")
+
+        own = self.own_steps
+        waiting, dependents = self.__dependencies()
+        slots = asyncio.Semaphore(max(1, tasks))
+        running = set()
+        finished = asyncio.Event()
+        progress = {"done": 0}
+        phase = None
+        client = None
+
+        def spawn(coroutine):
+            task = asyncio.create_task(coroutine)
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        # tasks run on one thread, so the map and the waiting sets don't need a lock
+        def release(rid: str, token: str):
+            pending = waiting[rid]
+            pending.discard(token)
+            if not pending:
+                spawn(patch_item(rid))
+
+        async def create_item(rid: str):
+            a = None
+            try:
+                try:
+                    a = self.item(rid)
+                    aid = self.redmineToAzureMap.get(rid)
+                    if aid:
+                        print(f"Warning: {rid} already created, skip")
+                        a.id = aid
+                    elif await a.create_workitem_async(client):
+                        self.redmineToAzureMap[rid] = f"{a.id}"
+                finally:
+                    # failed item is resolved as well, dependent items are patched without the link
+                    for w in dependents.pop(rid, []):
+                        release(w, rid)
+
+                if a and a.id:
+                    await a.create_attachments_async(client)
+            finally:
+                slots.release()
+                release(rid, own)
+
+        async def patch_item(rid: str):
+            async with slots:
+                try:
+                    await self.item(rid).patch_async(client, self.redmineToAzureMap, combined=combined)
+                except Exception as e:
+                    print(f"Error: {self.redmineToAzureMap.get(rid, 0)}({rid}): patch failed [{e}]")
+                    metrics.error("patch")
+            phase.advance()
+            progress["done"] += 1
+            if progress["done"] == len(self.index):
+                finished.set()
+
+        try:
+            async with Azure.async_client() as client:
+                with metrics.phase("export", len(self.index)) as phase:
+                    for rid in self.index:
+                        # backpressure: the next item is created only when one of the tasks is over
+                        await slots.acquire()
+                        spawn(create_item(rid))
+                    if self.index:
+                        await finished.wait()
+        finally:
+            self.save_map()
 
         return True
 
@@ -83,8 +522,9 @@ if __name__ == '__main__':
 
     az = AzureExporter()
     az.load()   # specific Redmine ticket can be given for test purposes in form: az.load(['149714'])
-    az.create()
+    az.create()     # az.create(recover=True) looks up items of previous runs in Azure if the map has been lost
     az.attachments()
-    az.patch()
+    az.patch()      # or all three steps in parallel: az.run()
+                    # or on one event loop (requires aiohttp): asyncio.run(az.run_async())
 
 
@@ -1,24 +1,36 @@
 import os
-import requests
 import json
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit, urlencode
+from configuration import Configuration
 from azure import Azure
+from httpClient import AsyncHttpClient
+from migrationState import MigrationState
+from dumpStore import DumpStore
+from urlRewriter import UrlRewriter
+from metrics import metrics
 
 
-def escape_text(text: str):
-    return (text
-            .encode('unicode_escape')
-            .decode()
-            .replace("'", r"\'")
-            .replace(r'\x', r'\u00'))
+def file_hash(file_path: str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
 
 
 class AzureItem:
-    def __init__(self, redmine_dir: str, azure_dir: str):
-        self.redmineDir = redmine_dir
+    def __init__(self, store: DumpStore, rid: str, azure_dir: str, state: MigrationState = None):
+        self.store = store
         self.azureDir = azure_dir
+        self.state = state
 
         self.redmineData = {}
-        self.rid = ''
+        self.rid = rid
         self.id = ''
 
         # data for step #1: to create work item
@@ -39,6 +51,7 @@ class AzureItem:
 
         # data for step #2: add attachments
         self.attachments = {}
+        self.rewriter: UrlRewriter = None
 
         # data for step #3: patch
         self.description = ''
@@ -50,9 +63,7 @@ class AzureItem:
     def load(self) -> bool:
 
         try:
-            data_json = os.path.join(self.redmineDir, "data.json")
-            with open(data_json, "r") as data:
-                self.redmineData = json.load(data)
+            self.redmineData = self.store.data(self.rid)
 
             self.rid = self.redmineData['id']
 
@@ -92,8 +103,14 @@ class AzureItem:
             if self.status == "Resolved" and self.type == "task":
                 self.status = "Active"
 
+            # resume from the state of previous runs
+            if self.state:
+                self.id = self.state.azure_id(self.rid)
+                self.attachments = self.state.attachments(self.rid)
+
         except Exception as e:
             print(f"Error: 0({self.rid}): cannot load data with type {self.redmineData.get('tracker')} [{e}]")
+            metrics.error("load")
             return False
 
         return True
@@ -101,38 +118,95 @@ class AzureItem:
     def create_workitem(self) -> bool:
         try:
             if self.type:
-                d = Azure.create_item_template.format(created_date=self.createdDate,
-                                                      title=escape_text(self.title),
-                                                      created_by=self.createdBy,
-                                                      assignee=self.assignee,
-                                                      tags=self.tags,
-                                                      priority=self.priority,
-                                                      status=self.status)
-
+                _, _, ops = self.create_operation()
                 ad = Azure.address(path=f'/workitems/${self.type}', args='bypassRules=true&')
-                response = requests.post(ad, headers=Azure.header(), data=d)
+                with metrics.timer("create"):
+                    response = Azure.post(ad, headers=Azure.header(), data=Azure.payload(ops))
                 if not response.ok:
                     raise Exception(f"Server responded False [{response.text}]")
                 
                 json_resp = json.loads(response.content)
-                self.id = json_resp['id']
+                self.created(json_resp['id'])
         except Exception as e:
             print(f"Error: 0({self.rid}): cannot create work item for {self.rid} [{e}]")
+            metrics.error("create")
             return False
 
         return True
 
-    def create_attachments(self):
+    def update_workitem(self) -> bool:
+        """
+        send fields of the creation which may have changed in Redmine to the existing work item,
+        the description is sent again by the next patch
+        :return: True if success
+        """
+        try:
+            ops = Azure.update_item_ops(title=self.title,
+                                        tags=self.tags,
+                                        priority=self.priority,
+                                        assignee=self.assignee,
+                                        status=self.status)
+            with metrics.timer("update"):
+                response = Azure.patch(Azure.address(path=f'/workitems/{self.id}', args='bypassRules=true&'),
+                                       headers=Azure.header(),
+                                       data=Azure.payload(ops))
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+        except Exception as e:
+            print(f"Error: {self.id}({self.rid}): cannot update work item [{e}]")
+            metrics.error("update")
+            return False
+
+        if self.state:
+            self.state.unmark(self.rid, "description")
+        return True
+
+    def created(self, aid: str):
+        self.id = aid
+        if self.state:
+            self.state.set_azure_id(self.rid, aid)
+
+    def done(self, step: str) -> bool:
+        return bool(self.state) and self.state.done(self.rid, step)
+
+    def mark(self, step: str, data: str = ''):
+        if self.state:
+            self.state.mark(self.rid, step, data)
+
+    def create_operation(self) -> tuple[str, str, list[dict]]:
+        """
+        operation creating the work item inside $batch request, see create_workitem();
+        $batch creates work items by PATCH of workitems/$<type>
+        :return: method, uri and json-patch document
+        """
+        ops = Azure.create_item_ops(created_date=self.createdDate,
+                                    title=self.title,
+                                    created_by=self.createdBy,
+                                    assignee=self.assignee,
+                                    tags=self.tags,
+                                    priority=self.priority,
+                                    status=self.status)
+        return "PATCH", Azure.batch_uri(path=f'/workitems/${self.type}', args='bypassRules=true&'), ops
+
+    def __restore_attachments(self) -> str:
         os.makedirs(self.azureDir, exist_ok=True)
 
         # get attachments info stored in working directory not to upload any file twice
         azure_attachments = os.path.join(self.azureDir, "attachments.json")
         try:
             with open(azure_attachments, "r") as data:
-                self.attachments = json.load(data)
+                legacy = json.load(data)
+            for name, a in legacy.items():
+                if name not in self.attachments:
+                    self.attachments[name] = a
+                    self.mark(f"attachment:{name}", json.dumps(a))
         except Exception as e:
             print(f"Info: {self.id}({self.rid}): no attachment has been uploaded yet {e}")
 
+        return azure_attachments
+
+    def create_attachments(self):
+        azure_attachments = self.__restore_attachments()
         redmine_attachments = self.redmineData.get("attachments")
 
         for a in redmine_attachments:
@@ -141,92 +215,235 @@ class AzureItem:
                 if self.attachments.get(name):
                     print(f"Info: attachment {name} has been already uploaded to azure")
                 else:
-                    a_path = os.path.join(self.redmineDir, "attachments", name)
-                    with open(a_path, 'rb') as file:
-                        name_mod = name.replace('#', 'n')
-                        ad = Azure.address(path=f'/attachments', args=f'fileName={name_mod}&')
-                        response = requests.post(ad, headers=Azure.header('octet-stream'), data=file)
-                        if not response.ok:
-                            raise Exception(f"Server responded False [{response.text}]")
-                        resp = json.loads(response.content)
-                        self.attachments[name] = {"id": resp.get("id"), "url": resp.get("url")}
+                    with metrics.timer("upload"):
+                        self.attachments[name] = self.upload_attachment(name)
+                    self.mark(f"attachment:{name}", json.dumps(self.attachments[name]))
             except Exception as e:
                 print(f"Error: {self.id}({self.rid}): failed to upload attachment [{e}]")
-
-        with open(azure_attachments, "w") as json_file:
-            json.dump(self.attachments, json_file, indent=4)
+                metrics.error("upload")
+
+        if not self.state:
+            with open(azure_attachments, "w") as json_file:
+                json.dump(self.attachments, json_file, indent=4)
+
+    def upload_attachment(self, name: str) -> dict:
+        """
+        upload file from Redmine dump to Azure; the same content is uploaded once per migration,
+        other work items reuse Azure attachment found by content hash
+        :param name: file name in attachments directory of the dump
+        :return: Azure attachment id and url
+        """
+        a_path = self.store.attachment(self.rid, name)
+        name_mod = name.replace('#', 'n')
+        if not self.state:
+            return self.__send_attachment(a_path, name_mod)
+
+        content_hash = file_hash(a_path)
+        with self.state.blob_lock(content_hash):
+            blob = self.state.blob(content_hash)
+            if blob:
+                print(f"Info: {self.id}({self.rid}): attachment {name} has been already uploaded to azure")
+                return self.__reuse_blob(blob, name_mod)
+
+            blob = self.__send_attachment(a_path, name_mod, content_hash)
+            self.state.add_blob(content_hash, blob["id"], blob["url"])
+            return blob
+
+    @staticmethod
+    def __reuse_blob(blob: dict, name_mod: str) -> dict:
+        # keep file name of this item in the link
+        url = urlunsplit(urlsplit(blob["url"])._replace(query=urlencode({"fileName": name_mod})))
+        return {"id": blob["id"], "url": url}
+
+    def __send_attachment(self, a_path: str, name_mod: str, content_hash: str = '') -> dict:
+        if os.path.getsize(a_path) > Configuration.azureChunkedUploadThreshold:
+            return self.__send_chunked(a_path, name_mod, content_hash)
+
+        with open(a_path, 'rb') as file:
+            ad = Azure.address(path=f'/attachments', args=f'fileName={name_mod}&')
+            response = Azure.post(ad, headers=Azure.header('octet-stream'), data=file)
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+            resp = json.loads(response.content)
+            return {"id": resp.get("id"), "url": resp.get("url")}
+
+    def __send_chunked(self, a_path: str, name_mod: str, content_hash: str = '') -> dict:
+        """
+        upload large file by chunks (uploadType=Chunked); acknowledged chunks are recorded in migration state,
+        so interrupted upload continues from the chunks which are not acknowledged yet
+        """
+        size = os.path.getsize(a_path)
+        chunk_size = Configuration.azureUploadChunkSize
+        progress = self.state.upload(content_hash) if self.state and content_hash else {}
+        if progress.get("size") != size:
+            ad = Azure.address(path=f'/attachments', args=f'fileName={name_mod}&uploadType=Chunked&')
+            response = Azure.post(ad, headers=Azure.header('octet-stream'), data=b'')
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+            resp = json.loads(response.content)
+            progress = {"id": resp.get("id"), "url": resp.get("url"), "size": size, "chunks": []}
+        else:
+            print(f"Info: {self.id}({self.rid}): resume upload of {name_mod}, "
+                  f"{len(progress['chunks'])} chunks are uploaded already")
+
+        lock = threading.Lock()
+
+        def save_progress():
+            if self.state and content_hash:
+                self.state.save_upload(content_hash, progress)
+
+        def put_chunk(offset: int):
+            with open(a_path, 'rb') as file:
+                file.seek(offset)
+                chunk = file.read(chunk_size)
+            headers = Azure.header('octet-stream')
+            headers["Content-Range"] = f"bytes {offset}-{offset + len(chunk) - 1}/{size}"
+            response = Azure.put(Azure.address(path=f'/attachments/{progress["id"]}', args=f'fileName={name_mod}&'),
+                                 headers=headers,
+                                 data=chunk)
+            if not response.ok:
+                raise Exception(f"Server responded False on chunk at {offset} [{response.text}]")
+            with lock:
+                progress["chunks"].append(offset)
+                save_progress()
+
+        save_progress()
+        uploaded = set(progress["chunks"])
+        offsets = [o for o in range(0, size, chunk_size) if o not in uploaded]
+        if Configuration.azureUploadChunkWorkers > 1:
+            with ThreadPoolExecutor(max_workers=Configuration.azureUploadChunkWorkers) as executor:
+                for f in [executor.submit(put_chunk, o) for o in offsets]:
+                    f.result()
+        else:
+            for o in offsets:
+                put_chunk(o)
+
+        if self.state and content_hash:
+            self.state.remove_upload(content_hash)
+
+        return {"id": progress["id"], "url": progress["url"]}
 
     def replace_attachments_urls(self, html: str):
-        redmine_attachments = self.redmineData.get("attachments")
-        for a in redmine_attachments:
-            try:
-                name = a['filename']
-                aid = a['id']
-                html = html.replace(f"/attachments/download/{aid}/{name}", self.attachments[name]["url"])
-            except Exception as e:
-                print(f"Error: {self.id}({self.rid}): cannot find Azure attachment for Redmine [{e}]")
+        # rewriter is built again only when more attachments have been uploaded
+        if self.rewriter is None or len(self.rewriter.urls) != len(self.attachments):
+            self.rewriter = UrlRewriter({a['id']: self.attachments[a['filename']]["url"]
+                                         for a in self.redmineData.get("attachments") or []
+                                         if a['filename'] in self.attachments})
+
+        html, unresolved = self.rewriter.rewrite(html)
+        if unresolved:
+            print(f"Warning: {self.id}({self.rid}): links to attachments which are not in Azure are kept: "
+                  f"{', '.join(sorted(set(unresolved)))}")
 
         return html
 
-    def patch_description(self) -> bool:
-        # description
-        descr = os.path.join(self.redmineDir, "description.htm")
-        text = ''
-        with open(descr, 'r', encoding="utf-8") as descr_text:
-            text = descr_text.read()
+    def __save_description(self):
+        with open(os.path.join(self.azureDir, "description.htm"), "w", encoding="utf-8") as htm_file:
+            htm_file.write(self.description)
 
-        text = escape_text(text)
-        self.description = self.replace_attachments_urls(text)
+    def patch_description(self) -> bool:
+        if self.done("description"):
+            return True
 
+        # description
         try:
-            if self.type == "bug":
-                patch = Azure.patch_repro_steps_template.format(description=self.description)
-            else:
-                patch = Azure.patch_description_template.format(description=self.description)
-
-            response = requests.patch(Azure.address(path=f'/workitems/{self.id}'),
-                                      headers=Azure.header(),
-                                      data=f"{patch}")
+            _, op = self.description_steps()[0]
+            response = Azure.patch(Azure.address(path=f'/workitems/{self.id}'),
+                                   headers=Azure.header(),
+                                   data=Azure.payload([op]))
             if not response.ok:
                 raise Exception(f"Server responded False [{response.text}]")
         except Exception as e:
             print(f"Error: {self.id}({self.rid}): cannot patch description [{e}]")
+            metrics.error("description")
             return False
 
-        with open(os.path.join(self.azureDir, "description.htm"), "w", encoding="utf-8") as htm_file:
-            htm_file.write(self.description)
-
+        self.mark("description")
+        self.__save_description()
         return True
 
     def patch_attachments(self):
         for a in self.attachments:
+            if self.done(f"link-attachment:{a}"):
+                continue
             try:
-                patch_att = Azure.patch_attachment_template.format(url=self.attachments[a]["url"])
+                patch_att = [Azure.attachment_op(self.attachments[a]["url"])]
 
                 ad = Azure.address(path=f'/workitems/{self.id}')
-                response = requests.patch(ad, headers=Azure.header(), data=patch_att)
+                response = Azure.patch(ad, headers=Azure.header(), data=Azure.payload(patch_att))
                 # json_resp = json.loads(response.content)
                 if not response.ok:
                     raise Exception(f"Server responded False [{response.text}]")
+                self.mark(f"link-attachment:{a}")
             except Exception as e:
                 print(f"Error: {self.id}({self.rid}): cannot assign attachment to work item [{e}]")
+                metrics.error("link-attachment")
         pass
 
     def patch_closedate(self):
         # closed date should be set to avoid further validation failures
         # set fixed fake close date
-        if self.status == "Closed":
+        if self.status == "Closed" and not self.done("closedate"):
             try:
-                closed_date = self.closedDate if len(self.closedDate) > 5 else "2024-03-30T00:00:00Z"
-                patch = Azure.patch_closed_date_template.format(date=closed_date)
-                response = requests.patch(Azure.address(path=f'/workitems/{self.id}' args='bypassRules=true&'),
-                                          headers=Azure.header(),
-                                          data=patch)
+                patch = [op for _, op in self.closedate_steps()]
+                response = Azure.patch(Azure.address(path=f'/workitems/{self.id}', args='bypassRules=true&'),
+                                       headers=Azure.header(),
+                                       data=Azure.payload(patch))
                 if not response.ok:
                     raise Exception(f"Server responded False [{response.text}]")
+                self.mark("closedate")
 
             except Exception as e:
                 print(f"Error: {self.id}({self.rid}): cannot set close date [{e}]")
+                metrics.error("closedate")
+
+    def closedate_steps(self) -> list[tuple[str, dict]]:
+        # requires bypassRules
+        if self.status != "Closed":
+            return []
+        closed_date = self.closedDate if len(self.closedDate) > 5 else "2024-03-30T00:00:00Z"
+        return [("closedate", Azure.field_op('Microsoft.VSTS.Common.ClosedDate', closed_date, 'replace'))]
+
+    def attachment_steps(self) -> list[tuple[str, dict]]:
+        return [(f"link-attachment:{a}", Azure.attachment_op(self.attachments[a]["url"])) for a in self.attachments]
+
+    def description_steps(self) -> list[tuple[str, dict]]:
+        self.description = self.replace_attachments_urls(self.store.description(self.rid))
+
+        field = 'Microsoft.VSTS.TCM.ReproSteps' if self.type == "bug" else 'System.Description'
+        return [("description", Azure.field_op(field, self.description, 'replace'))]
+
+    def patch_combined(self, redmine2azure: dict[str, str], relations: bool = True) -> bool:
+        """
+        set closed date, attachments, description and relations by a single json-patch request
+        instead of patch_closedate(), patch_attachments(), patch_description() and patch_relations()
+        :param redmine2azure: map of Redmine ID -> Azure ID
+        :param relations: add parent and related links too
+        :return: True if success
+        """
+        try:
+            steps = self.closedate_steps() + self.attachment_steps() + self.description_steps()
+            if relations:
+                steps += self.relation_steps(redmine2azure)
+            steps = [(step, op) for step, op in steps if not self.done(step)]
+            if not steps:
+                return True
+
+            response = Azure.patch(Azure.address(path=f'/workitems/{self.id}', args='bypassRules=true&'),
+                                   headers=Azure.header(),
+                                   data=Azure.payload([op for _, op in steps]))
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+        except Exception as e:
+            print(f"Error: {self.id}({self.rid}): cannot patch work item [{e}]")
+            metrics.error("patch")
+            return False
+
+        if self.state:
+            self.state.mark_all(self.rid, [step for step, _ in steps])
+
+        self.__save_description()
+        return True
 
     def patch_notes(self):
         notes = self.redmineData.get("notes")
@@ -236,69 +453,366 @@ class AzureItem:
         os.makedirs(history_path, exist_ok=True)
 
         for n in notes:
+            if self.done(f"note:{n['id']}"):
+                continue
             try:
-                content_path = os.path.join(self.redmineDir, "history", f"{n['id']}.htm")
-                with open(content_path, 'r', encoding="utf-8") as c:
-                    content = c.read()
-
-                content = escape_text(content)
-                content = self.replace_attachments_urls(content)
-                # add author\date info
-                content = f"<p>Added by {n['author']} on {n['created_on']}</p>" + content
-                patch = Azure.patch_add_comment_template.format(html=content,
-                                                                author=n["author"],
-                                                                date=n["created_on"])
-                response = requests.patch(Azure.address(path=f'/workitems/{self.id}', args='bypassRules=true&'),
-                                          headers=Azure.header(),
-                                          data=patch)
+                content = self.note_content(n)
+                patch = Azure.comment_ops(content, n["author"], n["created_on"])
+                response = Azure.patch(Azure.address(path=f'/workitems/{self.id}', args='bypassRules=true&'),
+                                       headers=Azure.header(),
+                                       data=Azure.payload(patch))
                 if not response.ok:
                     raise Exception(f"Server responded False [{response.text}]")
+                self.mark(f"note:{n['id']}")
 
                 with open(os.path.join(history_path, f"{n['id']}.htm"), "w", encoding="utf-8") as htm_file:
                     htm_file.write(content)
             except Exception as e:
                 print(f"Error: {self.id}({self.rid}): cannot add comment [{e}]")
+                metrics.error("note")
+
+    def note_content(self, note: dict) -> str:
+        content = self.replace_attachments_urls(self.store.note(self.rid, note['id']))
+        # add author\date info
+        return f"<p>Added by {note['author']} on {note['created_on']}</p>" + content
 
     def patch_relations(self, redmine2azure: dict[str, str]):
         # set parent
         try:
             redmine_parent = self.redmineData["parent"]
-            if redmine_parent:
+            if redmine_parent and not self.done("parent"):
                 self.parent = redmine2azure[redmine_parent]
                 if self.parent:
-                    patch = Azure.patch_add_parent_template.format(id=self.parent)
-                    response = requests.patch(Azure.address(path=f'/workitems/{self.id}'),
-                                              headers=Azure.header(),
-                                              data=patch)
+                    patch = [Azure.add_link_op('System.LinkTypes.Hierarchy-Reverse', self.parent, 'Parent')]
+                    response = Azure.patch(Azure.address(path=f'/workitems/{self.id}'),
+                                           headers=Azure.header(),
+                                           data=Azure.payload(patch))
                     if not response.ok:
                         raise Exception(f"Server responded False [{response.text}]")
+                    self.mark("parent")
 
         except Exception as e:
             print(f"Error: {self.id}({self.rid}): Failed to set parent [{e}]")
+            metrics.error("relation")
 
         # set related
         redmine_relations = self.redmineData["relations"]
         for r in redmine_relations or []:
+            if self.done(f"related:{r}"):
+                continue
             try:
                 azure_id = redmine2azure[f"{r}"]
                 if azure_id:
-                    patch = Azure.patch_add_related_template.format(id=azure_id)
-                    response = requests.patch(Azure.address(path=f'/workitems/{self.id}'),
-                                              headers=Azure.header(),
-                                              data=patch)
+                    patch = [Azure.add_link_op('System.LinkTypes.Related', azure_id, 'Related')]
+                    response = Azure.patch(Azure.address(path=f'/workitems/{self.id}'),
+                                           headers=Azure.header(),
+                                           data=Azure.payload(patch))
                     if not response.ok:
                         raise Exception(f"Server responded False [{response.text}]")
+                    self.mark(f"related:{r}")
 
             except Exception as e:
                 print(f"Error: {self.id}({self.rid}): Failed to add related item [{e}]")
+                metrics.error("relation")
+
+    def link_targets(self) -> list[str]:
+        # Redmine IDs of items the work item is linked to by patch_relations()
+        parent = self.redmineData.get("parent")
+        return ([parent] if parent else []) + [f"{r}" for r in self.redmineData.get("relations") or []]
+
+    @staticmethod
+    def link_op(step: str, azure_id: str) -> dict:
+        # operation of link step 'parent' or 'related:<Redmine ID>' to the work item azure_id
+        if step == "parent":
+            return Azure.add_link_op('System.LinkTypes.Hierarchy-Reverse', azure_id, 'Parent')
+        return Azure.add_link_op('System.LinkTypes.Related', azure_id, 'Related')
+
+    def relation_steps(self, redmine2azure: dict[str, str], missing: list = None) -> list[tuple[str, dict]]:
+        """
+        operations adding parent and related links, the same patch_relations() sends one by one
+        :param redmine2azure: map of Redmine ID -> Azure ID
+        :param missing: optional list collecting step name and Redmine ID of links to items which are not
+        in Azure yet, otherwise such links are reported as errors
+        :return: list of step name and json-patch operation, empty if there is nothing to link
+        """
+        steps = []
+        redmine_parent = self.redmineData.get("parent")
+        if redmine_parent:
+            self.parent = redmine2azure.get(redmine_parent, '')
+            if self.parent:
+                steps.append(("parent", self.link_op("parent", self.parent)))
+            elif missing is not None:
+                missing.append(("parent", redmine_parent))
+            else:
+                print(f"Error: {self.id}({self.rid}): Failed to set parent [{redmine_parent} is not in Azure]")
+                metrics.error("relation")
+
+        for r in self.redmineData.get("relations") or []:
+            azure_id = redmine2azure.get(f"{r}")
+            if azure_id:
+                steps.append((f"related:{r}", self.link_op(f"related:{r}", azure_id)))
+            elif missing is not None:
+                missing.append((f"related:{r}", f"{r}"))
+            else:
+                print(f"Error: {self.id}({self.rid}): Failed to add related item [{r} is not in Azure]")
+                metrics.error("relation")
+
+        return steps
+
+    def patch_links(self, steps: list[tuple[str, dict]]) -> bool:
+        """
+        add links by one json-patch request
+        :param steps: step name and json-patch operation, see relation_steps()
+        :return: True if success
+        """
+        steps = [(step, op) for step, op in steps if not self.done(step)]
+        if not steps:
+            return True
+
+        try:
+            response = Azure.patch(Azure.address(path=f'/workitems/{self.id}'),
+                                   headers=Azure.header(),
+                                   data=Azure.payload([op for _, op in steps]))
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+        except Exception as e:
+            print(f"Error: {self.id}({self.rid}): Failed to add links [{e}]")
+            metrics.error("relation")
+            return False
+
+        if self.state:
+            self.state.mark_all(self.rid, [step for step, _ in steps])
+        return True
+
+    def patch(self, redmine2azure: dict[str, str], relations: bool = True, combined: bool = False):
+        if not self.id:
+            return False
+
+        with metrics.timer("patch"):
+            if combined:
+                # notes have to stay separate revisions to keep history
+                self.patch_combined(redmine2azure, relations)
+                self.patch_notes()
+                return True
 
-    def patch(self, redmine2azure: dict[str, str]):
-        if self.id:
             self.patch_closedate()
             self.patch_attachments()
             self.patch_description()
             self.patch_notes()
-            self.patch_relations(redmine2azure)
+            if relations:
+                self.patch_relations(redmine2azure)
+            return True
+
+    # asyncio mode, see AzureExporter.run_async(): the same requests sent by AsyncHttpClient of the event loop
+
+    async def create_workitem_async(self, client: AsyncHttpClient) -> bool:
+        try:
+            if self.type:
+                _, _, ops = self.create_operation()
+                ad = Azure.address(path=f'/workitems/${self.type}', args='bypassRules=true&')
+                with metrics.timer("create"):
+                    response = await client.post(ad, headers=Azure.header(), data=Azure.payload(ops))
+                if not response.ok:
+                    raise Exception(f"Server responded False [{response.text}]")
+
+                json_resp = json.loads(response.content)
+                self.created(json_resp['id'])
+        except Exception as e:
+            print(f"Error: 0({self.rid}): cannot create work item for {self.rid} [{e}]")
+            metrics.error("create")
+            return False
+
+        return True
+
+    async def create_attachments_async(self, client: AsyncHttpClient):
+        azure_attachments = self.__restore_attachments()
+        for a in self.redmineData.get("attachments"):
+            try:
+                name = a["filename"]
+                if self.attachments.get(name):
+                    print(f"Info: attachment {name} has been already uploaded to azure")
+                else:
+                    with metrics.timer("upload"):
+                        self.attachments[name] = await self.upload_attachment_async(client, name)
+                    self.mark(f"attachment:{name}", json.dumps(self.attachments[name]))
+            except Exception as e:
+                print(f"Error: {self.id}({self.rid}): failed to upload attachment [{e}]")
+                metrics.error("upload")
+
+        if not self.state:
+            with open(azure_attachments, "w") as json_file:
+                json.dump(self.attachments, json_file, indent=4)
+
+    async def upload_attachment_async(self, client: AsyncHttpClient, name: str) -> dict:
+        # see upload_attachment(), file is hashed in a thread
+        a_path = self.store.attachment(self.rid, name)
+        name_mod = name.replace('#', 'n')
+        if not self.state:
+            return await self.__send_attachment_async(client, a_path, name_mod)
+
+        content_hash = await asyncio.to_thread(file_hash, a_path)
+        async with self.state.blob_lock_async(content_hash):
+            blob = self.state.blob(content_hash)
+            if blob:
+                print(f"Info: {self.id}({self.rid}): attachment {name} has been already uploaded to azure")
+                return self.__reuse_blob(blob, name_mod)
+
+            blob = await self.__send_attachment_async(client, a_path, name_mod, content_hash)
+            self.state.add_blob(content_hash, blob["id"], blob["url"])
+            return blob
+
+    async def __send_attachment_async(self, client: AsyncHttpClient, a_path: str, name_mod: str,
+                                      content_hash: str = '') -> dict:
+        if os.path.getsize(a_path) > Configuration.azureChunkedUploadThreshold:
+            return await self.__send_chunked_async(client, a_path, name_mod, content_hash)
+
+        with open(a_path, 'rb') as file:
+            ad = Azure.address(path=f'/attachments', args=f'fileName={name_mod}&')
+            response = await client.post(ad, headers=Azure.header('octet-stream'), data=file)
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+            resp = json.loads(response.content)
+            return {"id": resp.get("id"), "url": resp.get("url")}
+
+    async def __send_chunked_async(self, client: AsyncHttpClient, a_path: str, name_mod: str,
+                                   content_hash: str = '') -> dict:
+        # see __send_chunked(), chunks are read in a thread
+        size = os.path.getsize(a_path)
+        chunk_size = Configuration.azureUploadChunkSize
+        progress = self.state.upload(content_hash) if self.state and content_hash else {}
+        if progress.get("size") != size:
+            ad = Azure.address(path=f'/attachments', args=f'fileName={name_mod}&uploadType=Chunked&')
+            response = await client.post(ad, headers=Azure.header('octet-stream'), data=b'')
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+            resp = json.loads(response.content)
+            progress = {"id": resp.get("id"), "url": resp.get("url"), "size": size, "chunks": []}
+        else:
+            print(f"Info: {self.id}({self.rid}): resume upload of {name_mod}, "
+                  f"{len(progress['chunks'])} chunks are uploaded already")
+
+        def save_progress():
+            if self.state and content_hash:
+                self.state.save_upload(content_hash, progress)
+
+        def read_chunk(offset: int) -> bytes:
+            with open(a_path, 'rb') as file:
+                file.seek(offset)
+                return file.read(chunk_size)
+
+        slots = asyncio.Semaphore(max(1, Configuration.azureUploadChunkWorkers))
+
+        async def put_chunk(offset: int):
+            async with slots:
+                chunk = await asyncio.to_thread(read_chunk, offset)
+                headers = Azure.header('octet-stream')
+                headers["Content-Range"] = f"bytes {offset}-{offset + len(chunk) - 1}/{size}"
+                response = await client.request("PUT",
+                                                Azure.address(path=f'/attachments/{progress["id"]}',
+                                                              args=f'fileName={name_mod}&'),
+                                                headers=headers,
+                                                data=chunk)
+                if not response.ok:
+                    raise Exception(f"Server responded False on chunk at {offset} [{response.text}]")
+                progress["chunks"].append(offset)
+                save_progress()
+
+        save_progress()
+        uploaded = set(progress["chunks"])
+        offsets = [o for o in range(0, size, chunk_size) if o not in uploaded]
+        if Configuration.azureUploadChunkWorkers > 1:
+            await asyncio.gather(*(put_chunk(o) for o in offsets))
+        else:
+            for o in offsets:
+                await put_chunk(o)
+
+        if self.state and content_hash:
+            self.state.remove_upload(content_hash)
+
+        return {"id": progress["id"], "url": progress["url"]}
+
+    async def __patch_steps_async(self, client: AsyncHttpClient, steps, args: str, failure: str,
+                                  category: str) -> bool:
+        """
+        send the steps which are not done yet by one json-patch request and mark them done
+        :param steps: callable returning list of step name and json-patch operation, like closedate_steps
+        :param args: arguments of the request, e.g. 'bypassRules=true&'
+        :param failure: error message
+        :param category: error category in metrics
+        :return: True if the steps are done
+        """
+        try:
+            steps = [(step, op) for step, op in steps() if not self.done(step)]
+            if not steps:
+                return True
+
+            response = await client.patch(Azure.address(path=f'/workitems/{self.id}', args=args),
+                                          headers=Azure.header(),
+                                          data=Azure.payload([op for _, op in steps]))
+            if not response.ok:
+                raise Exception(f"Server responded False [{response.text}]")
+        except Exception as e:
+            print(f"Error: {self.id}({self.rid}): {failure} [{e}]")
+            metrics.error(category)
+            return False
+
+        if self.state:
+            self.state.mark_all(self.rid, [step for step, _ in steps])
+        return True
+
+    async def patch_async(self, client: AsyncHttpClient, redmine2azure: dict[str, str],
+                          relations: bool = True, combined: bool = False) -> bool:
+        """
+        patch() for asyncio mode, fields, links and notes are sent in the same order by the same requests
+        """
+        if not self.id:
+            return False
+
+        with metrics.timer("patch"):
+            if combined:
+                steps = lambda: (self.closedate_steps() + self.attachment_steps() + self.description_steps()
+                                 + (self.relation_steps(redmine2azure) if relations else []))
+                if await self.__patch_steps_async(client, steps, 'bypassRules=true&',
+                                                  "cannot patch work item", "patch"):
+                    self.__save_description()
+                await self.__patch_notes_async(client)
+                return True
+
+            await self.__patch_steps_async(client, self.closedate_steps, 'bypassRules=true&',
+                                           "cannot set close date", "closedate")
+            for step in self.attachment_steps():
+                await self.__patch_steps_async(client, lambda: [step], '',
+                                               "cannot assign attachment to work item", "link-attachment")
+            if not self.done("description"):
+                if await self.__patch_steps_async(client, self.description_steps, '',
+                                                  "cannot patch description", "description"):
+                    self.__save_description()
+            await self.__patch_notes_async(client)
+            if relations:
+                for step in self.relation_steps(redmine2azure):
+                    await self.__patch_steps_async(client, lambda: [step], '', "Failed to add link", "relation")
             return True
 
-        return False
+    async def __patch_notes_async(self, client: AsyncHttpClient):
+        # notes are added one by one in order of their ids, see patch_notes()
+        history_path = os.path.join(self.azureDir, "history")
+        os.makedirs(history_path, exist_ok=True)
+
+        for n in sorted(self.redmineData.get("notes"), key=lambda el: el["id"]):
+            if self.done(f"note:{n['id']}"):
+                continue
+            try:
+                content = self.note_content(n)
+                patch = Azure.comment_ops(content, n["author"], n["created_on"])
+                response = await client.patch(Azure.address(path=f'/workitems/{self.id}', args='bypassRules=true&'),
+                                              headers=Azure.header(),
+                                              data=Azure.payload(patch))
+                if not response.ok:
+                    raise Exception(f"Server responded False [{response.text}]")
+                self.mark(f"note:{n['id']}")
+
+                with open(os.path.join(history_path, f"{n['id']}.htm"), "w", encoding="utf-8") as htm_file:
+                    htm_file.write(content)
+            except Exception as e:
+                print(f"Error: {self.id}({self.rid}): cannot add comment [{e}]")
+                metrics.error("note")
@@ -0,0 +1,189 @@
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import multiprocessing
+from configuration import Configuration
+from mockServers import ServerProfile, serve
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def mock_counters(url: str, reset: bool = False) -> dict:
+    import requests
+    if reset:
+        requests.post(f"{url}/_mock/reset", timeout=10)
+        return {}
+    return requests.get(f"{url}/_mock/counters", timeout=10).json()
+
+
+def peak_rss() -> int:
+    # peak resident memory of the process in bytes, 0 where it can't be measured
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(phase: str, url: str, action, trace_memory: bool, verbose: bool) -> dict:
+    """
+    run one phase of the migration against a mock server
+    :param phase: name of the phase in the report
+    :param url: mock server the phase talks to
+    :param action: callable returning number of processed issues
+    :param trace_memory: measure peak of Python allocations of the phase by tracemalloc, slows the phase down
+    :param verbose: keep output of the phase
+    :return: report of the phase
+    """
+    mock_counters(url, reset=True)
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        issues = action()
+    elapsed = time.perf_counter() - start
+
+    traced = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    if trace_memory:
+        tracemalloc.stop()
+
+    counters = mock_counters(url)
+    total = sum(counters["requests"].values())
+    return {
+        "phase": phase,
+        "issues": issues,
+        "seconds": round(elapsed, 3),
+        "issuesPerSecond": round(issues / elapsed, 2) if elapsed else 0,
+        "requests": total,
+        "requestsPerIssue": round(total / issues, 2) if issues else 0,
+        "bytesSent": counters["bytesIn"],
+        "bytesReceived": counters["bytesOut"],
+        "endpoints": counters["requests"],
+        "errors": counters["errors"],
+        "peakTraced": traced,
+        "peakRss": peak_rss()
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['phase']}: {report['issues']} issues in {report['seconds']}s, "
+          f"{report['issuesPerSecond']} issues/s, {report['requestsPerIssue']} requests/issue")
+    print(f"    sent {report['bytesSent']} bytes, received {report['bytesReceived']} bytes, "
+          f"peak memory {report['peakTraced'] // 1024} KB traced, {report['peakRss'] // 1024} KB rss")
+    for endpoint, count in sorted(report["endpoints"].items()):
+        print(f"    {endpoint:>20}: {count} requests")
+    for error, count in sorted(report["errors"].items()):
+        print(f"    {error:>20}: {count} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of RedmineImporter and AzureExporter "
+                                                 "against local Redmine and Azure DevOps stand-ins")
+    parser.add_argument("--issues", type=int, default=200)
+    parser.add_argument("--notes", type=int, default=5, help="mean number of notes per issue")
+    parser.add_argument("--attachments", type=int, default=1, help="mean number of attachments per issue")
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="mean attachment size in bytes")
+    parser.add_argument("--description-size", type=int, default=2000, help="mean description length")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.02, help="mean response delay of both servers, seconds")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failed with 503")
+    parser.add_argument("--azure-rate-limit", type=float, default=0.0,
+                        help="requests per second Azure serves before throttling, 0 for no throttling")
+    parser.add_argument("--workers", type=int, default=Configuration.redmineDumpWorkers)
+    parser.add_argument("--bulk", action="store_true", help="fetch Redmine metadata in bulk")
+    parser.add_argument("--packed", action="store_true", help="write packed dump")
+    parser.add_argument("--parse-processes", type=int, default=Configuration.redmineParseProcesses,
+                        help="processes parsing issue pages, 0 to parse them in dumping threads")
+    parser.add_argument("--batch", type=int, default=0, help="$batch size of the step by step export")
+    parser.add_argument("--pipeline", action="store_true", help="export by AzureExporter.run()")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="dump by RedmineImporter.dump_async() and export by AzureExporter.run_async()")
+    parser.add_argument("--tasks", type=int, default=Configuration.azureAsyncTasks, help="asyncio tasks in flight")
+    parser.add_argument("--combined", action="store_true", help="patch fields and links by one request")
+    parser.add_argument("--azure-rate", type=float, default=1000.0, help="client side limit of Azure requests")
+    parser.add_argument("--trace-memory", action="store_true", help="peak memory of each phase by tracemalloc")
+    parser.add_argument("--verbose", action="store_true", help="keep output of importer and exporter")
+    parser.add_argument("--json", help="save report to the file")
+    args = parser.parse_args()
+
+    project = {"issues": args.issues, "notes": args.notes, "attachments": args.attachments,
+               "attachment_size": args.attachment_size, "description_size": args.description_size,
+               "seed": args.seed}
+    profile = ServerProfile(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    azure_profile = ServerProfile(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                  rate_limit=args.azure_rate_limit)
+
+    # servers get their own process, so they don't share CPU, GIL and memory with the measured code
+    connection, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, project, profile, azure_profile), daemon=True)
+    server.start()
+    redmine_url, azure_url = connection.recv()
+
+    # configuration is read when the modules are imported
+    Configuration.redmineAddress = redmine_url
+    Configuration.redmineProject = "benchmark"
+    Configuration.redmineDumpPacked = args.packed
+    Configuration.redmineParseProcesses = args.parse_processes
+    Configuration.azureAddress = azure_url
+    Configuration.azureOrganization = "benchmark"
+    Configuration.azureProject = "benchmark"
+    Configuration.azureToken = "benchmark"
+    Configuration.azureRequestRate = args.azure_rate
+    from redmineImporter import RedmineImporter
+    from azureExporter import AzureExporter
+
+    reports = []
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            dump_dir = f"{root}/redmine"
+            working_dir = f"{root}/azure"
+
+            def import_project() -> int:
+                importer = RedmineImporter(dump_dir)
+                importer.list_issues()
+                if args.asyncio:
+                    asyncio.run(importer.dump_async(tasks=args.tasks, bulk=args.bulk))
+                else:
+                    importer.dump(workers=args.workers, bulk=args.bulk)
+                return len(importer.issues)
+
+            def export_project() -> int:
+                exporter = AzureExporter(dump_dir, working_dir)
+                exporter.load()
+                if args.asyncio:
+                    asyncio.run(exporter.run_async(tasks=args.tasks, combined=args.combined))
+                elif args.pipeline:
+                    exporter.run(workers=args.workers, combined=args.combined)
+                else:
+                    exporter.create(args.batch)
+                    exporter.attachments()
+                    exporter.patch(args.batch, combined=args.combined)
+                exporter.state.close()
+                return len(exporter.index)
+
+            for phase, url, action in [("import", redmine_url, import_project),
+                                       ("export", azure_url, export_project)]:
+                reports.append(measure(phase, url, action, args.trace_memory, args.verbose))
+                print_report(reports[-1])
+    finally:
+        connection.send("stop")
+        server.join(10)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"arguments": vars(args), "phases": reports}, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    # python benchmark.py --issues 500 --latency 0.05 --azure-rate-limit 50 --pipeline --json report.json
+    main()
@@ -5,11 +5,48 @@ class Configuration:
     redmineProject = ""
     redmineToken = ""
     redmineDumpDir = r'd:\workdir\redmineData'
+    redmineDumpWorkers = 8        # number of issues dumped in parallel
+    redmineMaxConnections = 4     # max simultaneous requests to one Redmine host
+    redmineTimeout = (10, 120)    # connect and read timeouts in seconds
+    redmineRetries = 5            # retries for failed connections and 429/5xx responses
+    redmineBackoff = 1.0          # initial retry delay in seconds, doubled on each retry
+    redmineBulkMetadata = False   # fetch issue metadata in batches of 100 from issues.json, saves only the issue
+                                  # json request, pages and journals are still fetched per issue (~3% fewer requests)
+    redmineDumpPacked = False     # write a new dump as one indexed container, see dumpStore.py
+    redmineAsyncTasks = 200       # issues dumped at once by RedmineImporter.dump_async()
+    redmineParseProcesses = None  # processes parsing issue pages, None for one per CPU, 0 to parse in dumping threads
 
     # Azure devops data
     azureAddress = "https://dev.azure.com"
     azureOrganization = ""
     azureProject = ""
     azureApiVersion = "7.1-preview.3"
+    azureBatchApiVersion = "4.1"  # version of $batch endpoint and operations inside it
+    azureQueryApiVersion = "7.1"  # version of WIQL and workitemsbatch endpoints
+    azureBatchSize = 0            # operations per $batch request (max 200), 0 to send one request per operation
+    azureCombinedPatch = False    # patch fields, attachments and links of an item by one request
+    azureRecoverMap = False       # find items of previous runs in Azure before creating new ones, see recover_map()
+    azureWorkers = 8              # number of items exported in parallel by AzureExporter.run()
+    azureAsyncTasks = 200         # items exported at once by AzureExporter.run_async()
+    azurePoolSize = 16            # max open connections to Azure
+    azureTimeout = (10, 300)      # connect and read timeouts in seconds
+    azureRetries = 5              # retries for throttled (429/503) requests
+    azureRequestRate = 20.0       # max requests per second, lowered automatically while Azure throttles
+    azureChunkedUploadThreshold = 32 * 1024 * 1024   # larger attachments are uploaded by chunks
+    azureUploadChunkSize = 8 * 1024 * 1024
+    azureUploadChunkWorkers = 1   # chunks of one file uploaded in parallel, Azure expects them in order by default
     azureToken = ""
     azureWorkingDir = r'd:\workdir\azureData'
+
+    # Streaming migration
+    streamQueueSize = 100         # issues waiting for each step of streamingMigration.py
+
+    # Sharded migration
+    shardSize = 500               # issues per shard claimed by one worker of shardedMigration.py
+    shardLeaseTime = 300          # seconds a shard stays claimed without heartbeat, then another worker takes it
+    shardHeartbeatPeriod = 30     # seconds between heartbeats of a worker, also between checks for free shards
+
+    # Metrics
+    metricsDir = ''               # metrics.json and redmine2azure.prom are written there, empty to disable
+    metricsPeriod = 30            # seconds between snapshots
+    metricsProgressPeriod = 5     # seconds between progress lines
@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import zlib
+import mmap
+import shutil
+import struct
+import hashlib
+import threading
+from configuration import Configuration
+
+
+class DumpStore:
+    """
+    Dump of Redmine issues as a directory per issue:
+    <id>/data.json, <id>/description.htm, <id>/history/<note id>.htm and <id>/attachments/<file name>.
+    Issue is written to .staging/<id> first and moved in place by save(), so a failed dump can be repeated.
+    """
+    staging_dir = ".staging"
+    manifest_name = "manifest.json"  # written by RedmineImporter, copied by convert()
+
+    def __init__(self, root_dir: str):
+        self.rootDir = root_dir
+
+    @staticmethod
+    def open(root_dir: str, packed: bool = None) -> 'DumpStore':
+        """
+        open dump in the layout found in root_dir
+        :param root_dir: dump directory
+        :param packed: layout of the dump, by default packed dump is detected by its pack file,
+        new dump is created in the layout given by Configuration.redmineDumpPacked
+        :return: store of the dump
+        """
+        if packed is None:
+            packed = (os.path.isfile(os.path.join(root_dir, PackedDumpStore.pack_name))
+                      or (Configuration.redmineDumpPacked and not DumpStore(root_dir).ids()))
+
+        return PackedDumpStore(root_dir) if packed else DumpStore(root_dir)
+
+    def ids(self) -> list[str]:
+        try:
+            names = os.listdir(self.rootDir)
+        except FileNotFoundError:
+            return []
+
+        # service directories and files of the importer are skipped
+        return [d for d in names if not d.startswith('.') and os.path.isdir(os.path.join(self.rootDir, d))]
+
+    def exists(self, rid: str) -> bool:
+        return os.path.exists(os.path.join(self.rootDir, rid))
+
+    def data(self, rid: str) -> dict:
+        with open(os.path.join(self.rootDir, rid, "data.json"), "r") as data:
+            return json.load(data)
+
+    def description(self, rid: str) -> str:
+        with open(os.path.join(self.rootDir, rid, "description.htm"), "r", encoding="utf-8") as descr_text:
+            return descr_text.read()
+
+    def note(self, rid: str, note_id) -> str:
+        with open(os.path.join(self.rootDir, rid, "history", f"{note_id}.htm"), "r", encoding="utf-8") as c:
+            return c.read()
+
+    def attachment(self, rid: str, name: str) -> str:
+        """
+        :return: path to the dumped attachment file, it doesn't exist if the attachment hasn't been dumped;
+        packed dump returns empty string for unknown attachment
+        """
+        return os.path.join(self.rootDir, rid, "attachments", name)
+
+    def staging_attachment(self, rid: str, name: str) -> str:
+        """
+        :return: path the attachment is downloaded to before save(), file left by previous attempt is kept there
+        """
+        attachments_path = os.path.join(self.rootDir, self.staging_dir, rid, "attachments")
+        os.makedirs(attachments_path, exist_ok=True)
+        return os.path.join(attachments_path, name)
+
+    def save(self, rid: str, data: dict, description: str, notes: dict):
+        """
+        save the issue together with attachments downloaded to staging_attachment() paths,
+        existing dump of the issue is replaced
+        :param rid: Redmine ID
+        :param data: general data of the issue, see RedmineItem.dump()
+        :param description: html of the description
+        :param notes: note id -> html of the note
+        """
+        issue_path = os.path.join(self.rootDir, rid)
+        staging_path = os.path.join(self.rootDir, self.staging_dir, rid)
+        history_path = os.path.join(staging_path, "history")
+
+        shutil.rmtree(history_path, ignore_errors=True)
+        os.makedirs(history_path, exist_ok=True)
+        os.makedirs(os.path.join(staging_path, "attachments"), exist_ok=True)
+
+        with open(os.path.join(staging_path, 'data.json'), "w") as json_file:
+            json.dump(data, json_file, indent=4)
+
+        with open(os.path.join(staging_path, 'description.htm'), "w", encoding="utf-8") as descr_file:
+            descr_file.write(f"{description}")
+
+        for note_id in notes:
+            with open(os.path.join(history_path, f"{note_id}.htm"), 'w', encoding="utf-8") as h_file:
+                h_file.write(f"{notes[note_id]}")
+
+        # swap the new dump in
+        if os.path.exists(issue_path):
+            old_path = os.path.join(self.rootDir, self.staging_dir, f"{rid}.old")
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(issue_path, old_path)
+            os.replace(staging_path, issue_path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.replace(staging_path, issue_path)
+
+    def flush(self):
+        # every issue is complete on disk as soon as it's saved
+        pass
+
+    def discard(self, rid: str):
+        # issue has been migrated, only transient store forgets it
+        pass
+
+
+class PackedDumpStore(DumpStore):
+    """
+    Dump of Redmine issues in one container instead of hundreds of thousands of small files:
+    records.pack holds a zlib-compressed json record per issue (data, description and notes html),
+    index.json maps issue id to the position of its record, attachments are kept once per content
+    in blobs/<sha256[:2]>/<sha256>. Records are only appended and the last record of an issue wins,
+    records appended after the index has been saved are found again by scanning the tail of the pack.
+    Records are read through memory mapping of the pack.
+    """
+    pack_name = "records.pack"
+    index_name = "index.json"
+    blobs_dir = "blobs"
+    magic = b"RDP1"
+    header = struct.Struct("<4sII")  # magic, length of issue id, length of compressed record
+
+    def __init__(self, root_dir: str):
+        super().__init__(root_dir)
+        os.makedirs(root_dir, exist_ok=True)
+        self.packPath = os.path.join(root_dir, self.pack_name)
+        self.records: dict[str, tuple[int, int]] = {}  # issue id -> offset and length of the record
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.map = None
+        self.__load_index()
+
+    def __load_index(self):
+        size = 0
+        try:
+            with open(os.path.join(self.rootDir, self.index_name), "r") as data:
+                index = json.load(data)
+            self.records = {rid: (r[0], r[1]) for rid, r in index["records"].items()}
+            size = index["size"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Warning: {self.rootDir}: index of packed dump is damaged, rebuild it [{e}]")
+            self.records = {}
+
+        with open(self.packPath, "ab"):
+            pass
+        if size > os.path.getsize(self.packPath):
+            print(f"Warning: {self.rootDir}: index of packed dump doesn't match the pack, rebuild it")
+            self.records, size = {}, 0
+
+        end = self.__scan(size)
+        if end < os.path.getsize(self.packPath):
+            # tail of a record which was being written when the importer stopped
+            print(f"Warning: {self.rootDir}: incomplete record at {end} is dropped")
+            with open(self.packPath, "r+b") as pack:
+                pack.truncate(end)
+
+    def __scan(self, offset: int) -> int:
+        # index records starting at offset, return end of the last complete record
+        pack_size = os.path.getsize(self.packPath)
+        with open(self.packPath, "rb") as pack:
+            pack.seek(offset)
+            while True:
+                head = pack.read(self.header.size)
+                if len(head) < self.header.size:
+                    break
+                magic, key_size, size = self.header.unpack(head)
+                key = pack.read(key_size)
+                start = pack.tell()
+                if magic != self.magic or len(key) < key_size or start + size > pack_size:
+                    break
+                pack.seek(start + size)
+                self.records[key.decode()] = (start, size)
+                offset = start + size
+
+        return offset
+
+    def __record(self, rid: str) -> dict:
+        cached = getattr(self.local, "record", None)
+        position = self.records[rid]
+        if cached and cached[0] == position:
+            return cached[1]
+
+        offset, size = position
+        with self.lock:
+            if self.map is None or offset + size > len(self.map):
+                # pack has grown since it was mapped
+                with open(self.packPath, "rb") as pack:
+                    self.map = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+            view = self.map
+
+        record = json.loads(zlib.decompress(view[offset:offset + size]))
+        self.local.record = (position, record)
+        return record
+
+    def __blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.rootDir, self.blobs_dir, content_hash[:2], content_hash)
+
+    def __add_blob(self, file_path: str) -> str:
+        h = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        content_hash = h.hexdigest()
+
+        blob_path = self.__blob_path(content_hash)
+        if os.path.isfile(blob_path):
+            os.remove(file_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(file_path, blob_path)
+
+        return content_hash
+
+    def ids(self) -> list[str]:
+        return list(self.records)
+
+    def exists(self, rid: str) -> bool:
+        return rid in self.records
+
+    def data(self, rid: str) -> dict:
+        return self.__record(rid)["data"]
+
+    def description(self, rid: str) -> str:
+        return self.__record(rid)["description"]
+
+    def note(self, rid: str, note_id) -> str:
+        return self.__record(rid)["notes"][f"{note_id}"]
+
+    def attachment(self, rid: str, name: str) -> str:
+        blob = self.__record(rid)["blobs"].get(name) if rid in self.records else None
+        return self.__blob_path(blob) if blob else ''
+
+    def save(self, rid: str, data: dict, description: str, notes: dict):
+        staging_path = os.path.join(self.rootDir, self.staging_dir, rid)
+        blobs = {}
+        for a in data.get("attachments") or []:
+            # attachments of the same name share one staged file as in the directory layout, it's moved only once
+            if a["filename"] not in blobs:
+                blobs[a["filename"]] = self.__add_blob(self.staging_attachment(rid, a["filename"]))
+        record = zlib.compress(json.dumps({"data": data,
+                                           "description": f"{description}",
+                                           "notes": {f"{n}": f"{notes[n]}" for n in notes},
+                                           "blobs": blobs}).encode())
+        key = rid.encode()
+        with self.lock:
+            with open(self.packPath, "ab") as pack:
+                start = pack.seek(0, os.SEEK_END) + self.header.size + len(key)
+                pack.write(self.header.pack(self.magic, len(key), len(record)) + key + record)
+            self.records[rid] = (start, len(record))
+
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    def flush(self):
+        with self.lock:
+            index = {"size": os.path.getsize(self.packPath), "records": self.records}
+            index_path = os.path.join(self.rootDir, self.index_name)
+            with open(f"{index_path}.tmp", "w") as json_file:
+                json.dump(index, json_file, separators=(',', ':'))
+            os.replace(f"{index_path}.tmp", index_path)
+
+
+class TransientDumpStore(DumpStore):
+    """
+    Issues of streaming migration which is run without a dump: data, description and notes are kept in memory
+    and attachments in <root>/.staging/<id>/attachments only until the issue is exported and discarded.
+    """
+
+    def __init__(self, root_dir: str):
+        super().__init__(root_dir)
+        self.records: dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def ids(self) -> list[str]:
+        with self.lock:
+            return list(self.records)
+
+    def exists(self, rid: str) -> bool:
+        return rid in self.records
+
+    def data(self, rid: str) -> dict:
+        return self.records[rid]["data"]
+
+    def description(self, rid: str) -> str:
+        return self.records[rid]["description"]
+
+    def note(self, rid: str, note_id) -> str:
+        return self.records[rid]["notes"][f"{note_id}"]
+
+    def attachment(self, rid: str, name: str) -> str:
+        # attachments stay where they have been downloaded to
+        return os.path.join(self.rootDir, self.staging_dir, rid, "attachments", name)
+
+    def save(self, rid: str, data: dict, description: str, notes: dict):
+        with self.lock:
+            self.records[rid] = {"data": data,
+                                 "description": f"{description}",
+                                 "notes": {f"{n}": f"{notes[n]}" for n in notes}}
+
+    def discard(self, rid: str):
+        with self.lock:
+            self.records.pop(rid, None)
+        shutil.rmtree(os.path.join(self.rootDir, self.staging_dir, rid), ignore_errors=True)
+
+
+def convert(src_dir: str, dst_dir: str, packed: bool) -> bool:
+    """
+    copy dump into another layout, attachments are hard linked when possible;
+    packing a packed dump again drops the records replaced by delta dumps
+    :param src_dir: existing dump in any layout
+    :param dst_dir: new dump directory
+    :param packed: layout of the new dump
+    :return: True if all the issues have been converted
+    """
+    src = DumpStore.open(src_dir)
+    dst = DumpStore.open(dst_dir, packed)
+    ids = src.ids()
+    print(f"Start converting {len(ids)} issues from {src_dir} to {'packed' if packed else 'directory'} dump {dst_dir}...")
+
+    failed = []
+    for idx, rid in enumerate(ids):
+        try:
+            data = src.data(rid)
+            for a in data.get("attachments") or []:
+                target = dst.staging_attachment(rid, a["filename"])
+                if os.path.isfile(target):
+                    os.remove(target)
+                try:
+                    os.link(src.attachment(rid, a["filename"]), target)
+                except OSError:
+                    shutil.copy2(src.attachment(rid, a["filename"]), target)
+
+            notes = {}
+            for n in data.get("notes") or []:
+                try:
+                    notes[n["id"]] = src.note(rid, n["id"])
+                except (OSError, KeyError) as e:
+                    print(f"Warning: {rid}: note #{n['id']} is missing in the dump [{e}]")
+
+            dst.save(rid, data, src.description(rid), notes)
+        except Exception as e:
+            print(f"Error: {rid}: failed to convert [{e}]")
+            failed.append(rid)
+        print(f"Finished with {rid}, #{idx + 1} from #{len(ids)}")
+
+    dst.flush()
+    manifest_path = os.path.join(src_dir, DumpStore.manifest_name)
+    if os.path.isfile(manifest_path):
+        shutil.copy2(manifest_path, os.path.join(dst_dir, DumpStore.manifest_name))
+
+    if failed:
+        print(f"Error: failed to convert {len(failed)} issues: {', '.join(failed)}")
+
+    return not failed
+
+
+if __name__ == '__main__':
+    # python dumpStore.py <source dump> <new dump> pack|unpack
+    convert(sys.argv[1], sys.argv[2], sys.argv[3] == "pack")
@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+from configuration import Configuration
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Redmine renders the note of journal N as <div id="journal-N-notes">
+_notes_id = re.compile(r'^journal-(\d+)-notes$')
+_notes_tag = re.compile(rb'id="journal-\d+-notes"')
+
+_lxml_query = ("//div[contains(concat(' ', normalize-space(@class), ' '), ' description ')]"
+               " | //div[starts-with(@id, 'journal-')]")
+
+
+def _extract_lxml(content: bytes) -> tuple[str, dict[int, str]]:
+    root = lxml.html.document_fromstring(content, parser=lxml.html.HTMLParser(encoding="utf-8"))
+    description = ''
+    notes = {}
+    # one pass over the document collects description and all the notes
+    for el in root.xpath(_lxml_query):
+        m = _notes_id.match(el.get("id", ''))
+        if m:
+            notes[int(m.group(1))] = lxml.html.tostring(el, encoding="unicode", with_tail=False)
+        elif not description and "description" in el.get("class", '').split():
+            for contextual in el.xpath("./div[contains(concat(' ', normalize-space(@class), ' '), ' contextual ')]"):
+                el.remove(contextual)
+            description = lxml.html.tostring(el, encoding="unicode", with_tail=False)
+
+    return description, notes
+
+
+def _wanted(name: str, attrs: dict) -> bool:
+    # top level tags kept by the strainer with all their content: description block and notes
+    if name != "div" or not attrs:
+        return False
+    classes = attrs.get("class") or ''
+    if isinstance(classes, str):
+        classes = classes.split()
+    return "description" in classes or bool(_notes_id.match(attrs.get("id") or ''))
+
+
+class _PageStrainer(SoupStrainer):
+    # bs4 4.13+ asks allow_tag_creation(), older versions call the name function with the attributes
+    def __init__(self):
+        super().__init__(_wanted)
+
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:
+        return _wanted(name, attrs)
+
+
+def _extract_soup(content: bytes) -> tuple[str, dict[int, str]]:
+    # only the description block and the notes are built into the tree, the rest of the page is skipped
+    html_soup = BeautifulSoup(content, 'html.parser', parse_only=_PageStrainer())
+    description = ''
+    d = html_soup.find('div', attrs={'class': 'description'})
+    if d:
+        contextual = d.find('div', {'class': 'contextual'})
+        if contextual:
+            contextual.decompose()
+        description = f"{d}"
+
+    notes = {int(_notes_id.match(n["id"]).group(1)): f"{n}" for n in html_soup.find_all('div', id=_notes_id)}
+    return description, notes
+
+
+def has_notes(content: bytes) -> bool:
+    # raw page is searched without parsing
+    return _notes_tag.search(content) is not None
+
+
+def extract_issue_html(content: bytes, note_ids: list) -> tuple[str, dict]:
+    """
+    get html of description and notes from Redmine issue page;
+    lxml is used when installed, otherwise the page is parsed by BeautifulSoup with html.parser
+    :param content: raw issue page
+    :param note_ids: ids of journals having notes
+    :return: description html and dictionary of note id -> note html, empty string for notes not found
+    """
+    description, notes = _extract_lxml(content) if lxml else _extract_soup(content)
+    return description, {nid: notes.get(int(nid), '') for nid in note_ids}
+
+
+_pool: ProcessPoolExecutor = None
+_pool_lock = threading.Lock()
+
+
+def _parse_processes() -> int:
+    # one per CPU by default, on a single CPU the pool would only add transfer of the pages
+    processes = Configuration.redmineParseProcesses
+    if processes is None:
+        processes = os.cpu_count() or 1
+        return processes if processes > 1 else 0
+    return processes
+
+
+def _parser_pool() -> ProcessPoolExecutor:
+    # started on the first page, processes are spawned as dumping threads may hold locks a forked child would inherit
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=_parse_processes(),
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def parse_issue_html(content: bytes, note_ids: list) -> tuple[str, dict]:
+    """
+    extract_issue_html() in a pool of Configuration.redmineParseProcesses processes, so parsing of pages
+    fetched by many threads is not limited to one core by GIL; only the page and the resulting strings
+    cross the process boundary. Page is parsed by the calling thread if there is no pool.
+    :param content: raw issue page
+    :param note_ids: ids of journals having notes
+    :return: description html and dictionary of note id -> note html
+    """
+    if not _parse_processes():
+        return extract_issue_html(content, note_ids)
+    return _parser_pool().submit(extract_issue_html, content, note_ids).result()
+
+
+def _extract_legacy(content: bytes, note_ids: list) -> tuple[str, dict]:
+    # the way RedmineItem.fill used to do it, kept for benchmarking
+    html_soup = BeautifulSoup(content, 'html.parser')
+    d = html_soup.body.find('div', attrs={'class': 'description'})
+    if bool(d):
+        d.find('div', {'class': 'contextual'}).decompose()
+    history_block = html_soup.body.find("div", "tab-content")
+    return f"{d}", {nid: f"{history_block.find('div', id=f'journal-{nid}-notes')}" for nid in note_ids}
+
+
+if __name__ == '__main__':
+    # micro-benchmark on saved issue pages: python htmlExtractor.py page1.html page2.html ...
+    pages = []
+    for page_path in sys.argv[1:]:
+        with open(page_path, 'rb') as page_file:
+            page = page_file.read()
+        pages.append((page, [int(m) for m in re.findall(rb'id="journal-(\d+)-notes"', page)]))
+
+    engines = [("legacy html.parser", _extract_legacy), ("soup single pass", lambda c, n: _extract_soup(c))]
+    if lxml:
+        engines.append(("lxml", lambda c, n: _extract_lxml(c)))
+
+    for name, engine in engines:
+        start = time.perf_counter()
+        for page, note_ids in pages:
+            engine(page, note_ids)
+        print(f"{name:>20}: {time.perf_counter() - start:.3f}s for {len(pages)} pages")
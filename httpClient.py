@@ -0,0 +1,362 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from metrics import metrics, endpoint_label
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class TokenBucket:
+    """
+    Process-wide request rate limiter shared by all the threads.
+    Rate is halved and all the requests are paused when server throttles (429/503, Retry-After,
+    X-RateLimit-Delay or X-RateLimit-Remaining running out) and grows back slowly while it doesn't.
+    """
+
+    def __init__(self, rate: float, min_rate: float = 0.5):
+        self.maxRate = rate
+        self.minRate = min(min_rate, rate)
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.blockedUntil = 0.0
+        self.__lock = threading.Lock()
+
+    def __take(self) -> float:
+        # take a token if there is one, otherwise return time to wait for it
+        with self.__lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.blockedUntil:
+                return self.blockedUntil - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        wait until a request may be sent
+        """
+        while wait := self.__take():
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        # the same for asyncio tasks, the event loop is not blocked while waiting
+        while wait := self.__take():
+            await asyncio.sleep(wait)
+
+    def adapt(self, response: requests.Response):
+        """
+        adjust rate to throttling information of the response
+        :param response: server response, requests.Response or AsyncResponse
+        """
+        headers = response.headers
+        pause = HttpClient.retry_after(response)
+        throttled = response.status_code in (429, 503) or pause > 0
+        try:
+            throttled = throttled or float(headers.get("X-RateLimit-Delay", 0)) > 0
+            remaining = float(headers["X-RateLimit-Remaining"])
+            limit = float(headers["X-RateLimit-Limit"])
+            # usage resets at X-RateLimit-Reset, slow down before the remaining budget is gone
+            if remaining < limit * 0.1:
+                throttled = True
+                pause = max(pause, min(60.0, float(headers.get("X-RateLimit-Reset", 0)) - time.time()))
+        except (KeyError, ValueError):
+            pass
+
+        with self.__lock:
+            if throttled:
+                self.rate = max(self.minRate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+                self.blockedUntil = max(self.blockedUntil, time.monotonic() + pause)
+            else:
+                self.rate = min(self.maxRate, self.rate + self.maxRate / 100)
+
+
+class HttpClient:
+    """
+    Keep-alive HTTP client shared by all the threads of the process.
+    Retries connection failures and 429/5xx responses with exponential backoff and jitter,
+    honoring Retry-After header sent by the server.
+    Requests which are not idempotent are retried after a connection failure only if they haven't been sent.
+    Every attempt is counted in metrics by client name, endpoint, method and status together with its latency
+    and bytes sent and received.
+    """
+    retry_statuses = frozenset([429, 500, 502, 503, 504])
+    idempotent_methods = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+    def __init__(self,
+                 name: str = "http",
+                 headers: dict = None,
+                 pool_size: int = 10,
+                 timeout: tuple = (10, 60),
+                 retries: int = 5,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 retry_statuses: frozenset = retry_statuses,
+                 limiter: TokenBucket = None):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = max_backoff
+        self.retryStatuses = retry_statuses
+        self.limiter = limiter
+        self.session = self.open_session(headers or {}, pool_size)
+
+    def open_session(self, headers: dict, pool_size: int):
+        # requests.Session is safe to share between threads as long as nobody changes its settings
+        # after creation; connections are taken from urllib3 pool which is thread-safe
+        session = requests.Session()
+        session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def backoff_delay(self, attempt: int) -> float:
+        delay = min(self.maxBackoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> float:
+        """
+        get delay requested by server in Retry-After header
+        :param response: server response
+        :return: delay in seconds, 0 if there is no header
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return 0
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _body_size(data) -> int:
+        if isinstance(data, (bytes, str)):
+            return len(data)
+        try:
+            return os.fstat(data.fileno()).st_size - data.tell()
+        except (AttributeError, OSError, ValueError):
+            return 0
+
+    def _count(self, method: str, endpoint: str, status: str, elapsed: float, sent: int,
+               response: requests.Response = None, stream: bool = False):
+        labels = {"client": self.name, "endpoint": endpoint, "method": method}
+        metrics.inc("http_requests_total", status=status, **labels)
+        metrics.observe("http_request_seconds", elapsed, **labels)
+        metrics.inc("http_sent_bytes_total", sent, **labels)
+        if response is not None:
+            # streamed body is not read yet, its size is taken from the header
+            received = response.headers.get("Content-Length") if stream else len(response.content)
+            metrics.inc("http_received_bytes_total", int(received or 0), **labels)
+        if status[0] not in "23":
+            metrics.error(f"http {status}", client=self.name)
+
+    @staticmethod
+    def sent(e: Exception) -> bool:
+        # False if the connection failed before the request could reach the server
+        if isinstance(e, requests.ConnectTimeout):
+            return False
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return not isinstance(reason, NewConnectionError)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        send request retrying transient failures
+        :param method: HTTP method
+        :param url: full url
+        :param kwargs: arguments passed to requests.Session.request
+        :return: last response received from the server
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        # file-like body has to be rewound before sending it again
+        data = kwargs.get("data")
+        position = data.tell() if hasattr(data, "seek") else None
+        endpoint = endpoint_label(url)
+        sent = self._body_size(data) if data is not None else 0
+
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                self._count(method, endpoint, f"{response.status_code}", time.monotonic() - start, sent,
+                            response, kwargs.get("stream", False))
+                if self.limiter:
+                    self.limiter.adapt(response)
+                if response.status_code not in self.retryStatuses or attempt >= self.retries:
+                    return response
+                delay = max(self.retry_after(response), self.backoff_delay(attempt))
+                reason = f"status {response.status_code}"
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._count(method, endpoint, "timeout" if isinstance(e, requests.Timeout) else "connection",
+                            time.monotonic() - start, 0)
+                if attempt >= self.retries or (self.sent(e) and method.upper() not in self.idempotent_methods):
+                    raise
+                delay = self.backoff_delay(attempt)
+                reason = f"{e}"
+
+            attempt += 1
+            print(f"Warning: {method} {url}: {reason}, retry #{attempt} in {delay:.1f}s")
+            time.sleep(delay)
+            if position is not None:
+                data.seek(position)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
+
+
+class AsyncResponse:
+    """
+    Response of AsyncHttpClient with the part of requests.Response interface the migration uses.
+    Body is read before the response is returned unless it's streamed, streamed body is read by iter_content()
+    and the response has to be closed, e.g. by async with.
+    """
+
+    def __init__(self, response: 'aiohttp.ClientResponse', content: bytes = None):
+        self.raw = response
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = content
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return (self.content or b'').decode(errors="replace")
+
+    def raise_for_status(self):
+        self.raw.raise_for_status()
+
+    async def iter_content(self, chunk_size: int):
+        async for chunk in self.raw.content.iter_chunked(chunk_size):
+            yield chunk
+
+    def close(self):
+        self.raw.release()
+
+    async def __aenter__(self) -> 'AsyncResponse':
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+class AsyncHttpClient(HttpClient):
+    """
+    HttpClient for asyncio tasks of one event loop, based on aiohttp which is needed only for asyncio mode.
+    Retries, backoff, rate limiter and metrics are the same, number of open connections is limited by pool_size,
+    so thousands of tasks may send requests through one client and wait for a free connection.
+    Session is opened on the event loop: async with AsyncHttpClient(...) as client: ...
+    """
+
+    def open_session(self, headers: dict, pool_size: int):
+        if aiohttp is None:
+            raise ImportError("asyncio mode requires aiohttp, install it by pip install aiohttp")
+        self.headers = headers
+        self.poolSize = pool_size
+        return None
+
+    async def __aenter__(self) -> 'AsyncHttpClient':
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=self.poolSize, limit_per_host=self.poolSize),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def sent(e: Exception) -> bool:
+        # False if the connection failed before the request could reach the server
+        return not isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+
+    async def request(self, method: str, url: str, stream: bool = False, **kwargs) -> AsyncResponse:
+        """
+        send request retrying transient failures
+        :param method: HTTP method
+        :param url: full url
+        :param stream: don't read the body, see AsyncResponse
+        :param kwargs: arguments passed to aiohttp.ClientSession.request
+        :return: last response received from the server
+        """
+        # file-like body has to be rewound before sending it again
+        data = kwargs.get("data")
+        position = data.tell() if hasattr(data, "seek") else None
+        endpoint = endpoint_label(url)
+        sent = self._body_size(data) if data is not None else 0
+
+        attempt = 0
+        while True:
+            if self.limiter:
+                await self.limiter.acquire_async()
+            start = time.monotonic()
+            try:
+                raw = await self.session.request(method, url, **kwargs)
+                try:
+                    response = AsyncResponse(raw, None if stream else await raw.read())
+                finally:
+                    if not stream:
+                        raw.release()
+                self._count(method, endpoint, f"{response.status_code}", time.monotonic() - start, sent,
+                            response, stream)
+                if self.limiter:
+                    self.limiter.adapt(response)
+                if response.status_code not in self.retryStatuses or attempt >= self.retries:
+                    return response
+                delay = max(self.retry_after(response), self.backoff_delay(attempt))
+                reason = f"status {response.status_code}"
+                response.close()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._count(method, endpoint, "timeout" if isinstance(e, asyncio.TimeoutError) else "connection",
+                            time.monotonic() - start, 0)
+                if attempt >= self.retries or (self.sent(e) and method.upper() not in self.idempotent_methods):
+                    raise
+                delay = self.backoff_delay(attempt)
+                reason = f"{e}" or type(e).__name__
+
+            attempt += 1
+            print(f"Warning: {method} {url}: {reason}, retry #{attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            if position is not None:
+                data.seek(position)
+
+    async def get(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request("PATCH", url, **kwargs)
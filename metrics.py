@@ -0,0 +1,239 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from configuration import Configuration
+
+
+def endpoint_label(url: str) -> str:
+    """
+    url path with ids replaced, so that all the requests to one endpoint are counted together
+    :param url: request url
+    :return: e.g. /issues/{id}.json, /attachments/download/{id}, /org/project/_apis/wit/workitems/{id}
+    """
+    path = urlsplit(url).path
+    # attachment file name follows its id
+    path = re.sub(r"(/attachments/download/\d+)/.*$", r"\1", path)
+    path = re.sub(r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "/{id}", path)
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+class Histogram:
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        # (upper bound, number of observations not greater than it) as Prometheus expects
+        total = 0
+        result = []
+        for bound, count in zip([f"{b:g}" for b in self.buckets] + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Phase:
+    """
+    progress of one phase: processed items, throughput and ETA, printed at most once per progress period
+    """
+
+    def __init__(self, metrics: 'Metrics', name: str, total: int = None):
+        self.metrics = metrics
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.reported = self.started
+
+    def advance(self, count: int = 1, failed: bool = False):
+        with self.metrics.lock:
+            self.done += count
+            self.failed += count if failed else 0
+            now = time.monotonic()
+            if now - self.reported < Configuration.metricsProgressPeriod:
+                return
+            self.reported = now
+            line = self.progress_line()
+        print(line)
+
+    def seconds(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def progress_line(self) -> str:
+        elapsed = self.seconds()
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = f"Progress: {self.name} {self.done}"
+        if self.total:
+            line += f" from {self.total} ({100 * self.done // self.total}%)"
+        line += f", {rate:.1f} items/s"
+        if self.failed:
+            line += f", {self.failed} failed"
+        if self.total and rate > 0 and not self.finished:
+            left = int((self.total - self.done) / rate)
+            line += f", ETA {left // 3600}:{left // 60 % 60:02}:{left % 60:02}"
+        return line
+
+    def state(self) -> dict:
+        return {"total": self.total, "done": self.done, "failed": self.failed,
+                "seconds": round(self.seconds(), 3), "finished": self.finished is not None}
+
+
+class Metrics:
+    """
+    Process-wide instrumentation: counters and latency histograms with labels, phases with progress and ETA.
+    Snapshot is written to Configuration.metricsDir periodically while a phase runs and when it's finished,
+    as metrics.json and as Prometheus text file redmine2azure.prom for node exporter textfile collector.
+    """
+    prefix = "redmine2azure"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # periodic writer and the end of a phase write the same files
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.phases: dict[str, Phase] = {}
+        self.writer = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def error(self, category: str, **labels):
+        self.inc("errors_total", category=category, **labels)
+
+    @contextmanager
+    def timer(self, step: str, **labels):
+        """
+        time a step of an item, e.g. with metrics.timer("fill"): ...
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe("step_seconds", time.monotonic() - start, step=step, **labels)
+
+    @contextmanager
+    def phase(self, name: str, total: int = None):
+        """
+        time a phase of the migration and report its progress,
+        e.g. with metrics.phase("create", len(items)) as p: ... p.advance()
+        :param name: phase name
+        :param total: number of items in the phase, if known
+        """
+        p = Phase(self, name, total)
+        with self.lock:
+            self.phases[name] = p
+        self.start_writer()
+        try:
+            yield p
+        finally:
+            p.finished = time.monotonic()
+            print(p.progress_line() + f", finished in {p.seconds():.1f}s")
+            self.write()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in self.counters.items()],
+                "histograms": [{"name": name, "labels": dict(labels), "buckets": dict(h.cumulative()),
+                                "sum": h.sum, "count": h.count}
+                               for (name, labels), h in self.histograms.items()],
+                "phases": {name: p.state() for name, p in self.phases.items()}
+            }
+
+    def prometheus(self) -> str:
+        def labels_text(labels: dict) -> str:
+            if not labels:
+                return ''
+            escaped = (f"{v}".replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in labels.values())
+            return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for c in sorted(snapshot["counters"], key=lambda c: c["name"]):
+            name = f"{self.prefix}_{c['name']}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{labels_text(c['labels'])} {c['value']:.15g}")
+        for h in sorted(snapshot["histograms"], key=lambda h: h["name"]):
+            name = f"{self.prefix}_{h['name']}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in h["buckets"].items():
+                lines.append(f"{name}_bucket{labels_text(dict(h['labels'], le=bound))} {count}")
+            lines.append(f"{name}_sum{labels_text(h['labels'])} {h['sum']:.15g}")
+            lines.append(f"{name}_count{labels_text(h['labels'])} {h['count']}")
+        for field in ("total", "done", "failed", "seconds"):
+            name = f"{self.prefix}_phase_{field}"
+            lines.append(f"# TYPE {name} gauge")
+            for phase, state in snapshot["phases"].items():
+                lines.append(f"{name}{labels_text({'phase': phase})} {state[field] or 0:.15g}")
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory: str = None):
+        """
+        save snapshot as metrics.json and redmine2azure.prom, files are replaced atomically;
+        temporary files are named by the process, workers of a sharded migration may share the directory
+        :param directory: output directory, Configuration.metricsDir by default, nothing is written if it's empty
+        """
+        directory = directory or Configuration.metricsDir
+        if not directory:
+            return
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self.write_lock:
+                for name, content in [("metrics.json", json.dumps(self.snapshot(), indent=1)),
+                                      (f"{self.prefix}.prom", self.prometheus())]:
+                    path = os.path.join(directory, name)
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp, "w") as f:
+                        f.write(content)
+                    os.replace(tmp, path)
+        except OSError as e:
+            print(f"Warning: cannot write metrics to {directory} [{e}]")
+
+    def start_writer(self):
+        # background thread writing snapshots every Configuration.metricsPeriod seconds
+        with self.lock:
+            if self.writer or not Configuration.metricsDir:
+                return
+            self.writer = threading.Thread(target=self.__write_periodically, daemon=True)
+        self.writer.start()
+
+    def __write_periodically(self):
+        while True:
+            time.sleep(Configuration.metricsPeriod)
+            self.write()
+
+
+metrics = Metrics()
@@ -0,0 +1,194 @@
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+
+
+class MigrationState:
+    """
+    Progress of the migration kept in SQLite database in Azure working directory.
+    Every step is committed as soon as it's done, so the migration can be resumed after a crash
+    without creating duplicates: Azure ID of every created work item and completion of every step
+    (uploaded attachment, closed date, description, note, relation) of every item.
+    """
+    file_name = "migration.db"
+
+    def __init__(self, working_dir: str, shared: bool = False):
+        """
+        :param working_dir: directory of the database
+        :param shared: the directory is on a volume shared by several hosts, WAL needs memory shared
+        by the processes of one host, so the rollback journal is used instead
+        """
+        os.makedirs(working_dir, exist_ok=True)
+        self.path = os.path.join(working_dir, self.file_name)
+        # one connection shared by all the threads, access is serialized by the lock
+        self.__db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__db.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+            self.__db.execute(f"PRAGMA synchronous={'FULL' if shared else 'NORMAL'}")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS items ("
+                              "rid TEXT PRIMARY KEY, "
+                              "aid TEXT NOT NULL) WITHOUT ROWID")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS steps ("
+                              "rid TEXT NOT NULL, "
+                              "step TEXT NOT NULL, "
+                              "data TEXT NOT NULL DEFAULT '', "
+                              "PRIMARY KEY (rid, step)) WITHOUT ROWID")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS steps_by_step ON steps (step, rid)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                              "hash TEXT PRIMARY KEY, "
+                              "id TEXT NOT NULL, "
+                              "url TEXT NOT NULL) WITHOUT ROWID")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                              "hash TEXT PRIMARY KEY, "
+                              "data TEXT NOT NULL) WITHOUT ROWID")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS links ("
+                              "target TEXT NOT NULL, "
+                              "rid TEXT NOT NULL, "
+                              "step TEXT NOT NULL, "
+                              "PRIMARY KEY (target, rid, step)) WITHOUT ROWID")
+        self.__blob_locks: dict[str, threading.Lock] = {}
+        self.__async_blob_locks: dict[str, asyncio.Lock] = {}
+
+    def __execute(self, sql: str, args: tuple = ()) -> list[tuple]:
+        with self.__lock:
+            return self.__db.execute(sql, args).fetchall()
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def azure_id(self, rid: str) -> str:
+        rows = self.__execute("SELECT aid FROM items WHERE rid = ?", (rid,))
+        return rows[0][0] if rows else ''
+
+    def set_azure_id(self, rid: str, aid: str):
+        self.__execute("INSERT OR REPLACE INTO items (rid, aid) VALUES (?, ?)", (f"{rid}", f"{aid}"))
+
+    def map(self) -> dict[str, str]:
+        """
+        :return: map of Redmine ID -> Azure ID of all created work items
+        """
+        return dict(self.__execute("SELECT rid, aid FROM items"))
+
+    def import_map(self, redmine2azure: dict[str, str]):
+        # redmine2azure.json of previous versions
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.executemany("INSERT OR IGNORE INTO items (rid, aid) VALUES (?, ?)",
+                                      [(f"{r}", f"{a}") for r, a in redmine2azure.items()])
+
+    def merge(self, path: str):
+        """
+        add created items, completed steps and uploaded files of another migration state, e.g. of a shard;
+        rows which are here already are kept
+        :param path: migration.db of the other state
+        """
+        with self.__lock:
+            self.__db.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                with self.__db:
+                    self.__db.execute("BEGIN")
+                    for table in ("items", "steps", "blobs"):
+                        self.__db.execute(f"INSERT OR IGNORE INTO {table} SELECT * FROM other.{table}")
+            finally:
+                self.__db.execute("DETACH DATABASE other")
+
+    def done(self, rid: str, step: str) -> bool:
+        return bool(self.__execute("SELECT 1 FROM steps WHERE rid = ? AND step = ?", (rid, step)))
+
+    def mark(self, rid: str, step: str, data: str = ''):
+        self.__execute("INSERT OR REPLACE INTO steps (rid, step, data) VALUES (?, ?, ?)", (rid, step, data))
+
+    def unmark(self, rid: str, step: str):
+        # the step has to be done again
+        self.__execute("DELETE FROM steps WHERE rid = ? AND step = ?", (rid, step))
+
+    def mark_all(self, rid: str, steps: list[str]):
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.executemany("INSERT OR REPLACE INTO steps (rid, step, data) VALUES (?, ?, '')",
+                                      [(rid, s) for s in steps])
+
+    def steps(self, rid: str, prefix: str = '') -> dict[str, str]:
+        """
+        :param rid: Redmine ID
+        :param prefix: optional step prefix like 'attachment:'
+        :return: dictionary of completed step -> its data
+        """
+        return dict(self.__execute("SELECT step, data FROM steps WHERE rid = ? AND substr(step, 1, ?) = ?",
+                                   (rid, len(prefix), prefix)))
+
+    def attachments(self, rid: str) -> dict[str, dict]:
+        """
+        :return: uploaded attachments of the item: file name -> {"id": ..., "url": ...}
+        """
+        prefix = "attachment:"
+        return {s[len(prefix):]: json.loads(d) for s, d in self.steps(rid, prefix).items()}
+
+    def missing(self, step: str) -> list[str]:
+        """
+        :param step: step name like 'description'
+        :return: Redmine IDs of created items which still miss the step
+        """
+        return [r for r, in self.__execute("SELECT rid FROM items WHERE rid NOT IN "
+                                           "(SELECT rid FROM steps WHERE step = ?) ORDER BY rid", (step,))]
+
+    def blob(self, content_hash: str) -> dict:
+        """
+        :param content_hash: SHA256 of file content
+        :return: Azure attachment id and url of the file uploaded before, empty if there is no such file
+        """
+        rows = self.__execute("SELECT id, url FROM blobs WHERE hash = ?", (content_hash,))
+        return {"id": rows[0][0], "url": rows[0][1]} if rows else {}
+
+    def add_blob(self, content_hash: str, aid: str, url: str):
+        self.__execute("INSERT OR REPLACE INTO blobs (hash, id, url) VALUES (?, ?, ?)", (content_hash, aid, url))
+
+    def blob_lock(self, content_hash: str) -> threading.Lock:
+        # the same content uploaded by several threads at once is uploaded only by the first one
+        with self.__lock:
+            return self.__blob_locks.setdefault(content_hash, threading.Lock())
+
+    def blob_lock_async(self, content_hash: str) -> asyncio.Lock:
+        # blob_lock() for tasks of one event loop, waiting task doesn't block the loop
+        return self.__async_blob_locks.setdefault(content_hash, asyncio.Lock())
+
+    def upload(self, content_hash: str) -> dict:
+        """
+        :param content_hash: SHA256 of file content
+        :return: progress of unfinished chunked upload of the file: Azure id, url, size and uploaded chunks
+        """
+        rows = self.__execute("SELECT data FROM uploads WHERE hash = ?", (content_hash,))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def save_upload(self, content_hash: str, progress: dict):
+        self.__execute("INSERT OR REPLACE INTO uploads (hash, data) VALUES (?, ?)", (content_hash, json.dumps(progress)))
+
+    def remove_upload(self, content_hash: str):
+        self.__execute("DELETE FROM uploads WHERE hash = ?", (content_hash,))
+
+    def defer_link(self, rid: str, step: str, target: str):
+        """
+        remember link step of an item which has to wait until the linked item is created
+        :param rid: Redmine ID of the item
+        :param step: 'parent' or 'related:<target>'
+        :param target: Redmine ID of the linked item
+        """
+        self.__execute("INSERT OR IGNORE INTO links (target, rid, step) VALUES (?, ?, ?)", (target, rid, step))
+
+    def deferred_links(self, target: str = None) -> list[tuple[str, str, str]]:
+        """
+        :param target: Redmine ID of the linked item, all the deferred links by default
+        :return: target, Redmine ID and step of links waiting for the target
+        """
+        if target is None:
+            return self.__execute("SELECT target, rid, step FROM links ORDER BY target")
+        return self.__execute("SELECT target, rid, step FROM links WHERE target = ?", (target,))
+
+    def remove_link(self, rid: str, step: str, target: str):
+        self.__execute("DELETE FROM links WHERE target = ? AND rid = ? AND step = ?", (target, rid, step))
@@ -0,0 +1,529 @@
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import itertools
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+
+@dataclass
+class ServerProfile:
+    """
+    behaviour of a mock server, the same for all its endpoints
+    """
+    latency: float = 0.0        # mean response delay in seconds
+    jitter: float = 0.0         # response delay varies by up to that many seconds
+    error_rate: float = 0.0     # share of requests failed with error_status
+    error_status: int = 503
+    rate_limit: float = 0.0     # requests per second served before 429 with Retry-After, 0 for no throttling
+    retry_after: float = 1.0
+
+
+def generate_project(issues: int = 100,
+                     notes: int = 5,
+                     attachments: int = 1,
+                     attachment_size: int = 64 * 1024,
+                     description_size: int = 2000,
+                     seed: int = 1) -> dict[int, dict]:
+    """
+    synthetic Redmine project, the same seed gives the same project
+    :param issues: number of issues
+    :param notes: mean number of notes per issue
+    :param attachments: mean number of attachments per issue
+    :param attachment_size: mean size of an attachment in bytes
+    :param description_size: mean length of description and notes in characters
+    :param seed: seed of the random generator
+    :return: issue id -> issue as Redmine returns it with all the includes,
+    html of description and notes is kept in "_description" and "_notes"
+    """
+    rnd = random.Random(seed)
+    words = ["ошибка", "задача", "проверка", "модуль", "сервер", "отчёт", "error", "build", "release", "test"]
+    trackers = ["Bug", "Task", "User Story"]
+    statuses = ["New", "In Progress", "Resolved", "Closed"]
+    priorities = ["Low", "Normal", "High", "Urgent"]
+
+    def text(size: int) -> str:
+        size = rnd.randint(size // 2, size * 3 // 2) if size else 0
+        paragraph = []
+        length = 0
+        while length < size:
+            paragraph.append(rnd.choice(words))
+            length += len(paragraph[-1]) + 1
+        return f"<p>{' '.join(paragraph)}</p>"
+
+    project = {}
+    attachment_ids = itertools.count(1)
+    journal_ids = itertools.count(1)
+    for i in range(1, issues + 1):
+        created = f"2024-01-{1 + i % 28:02}T10:00:00Z"
+        status = rnd.choice(statuses)
+        issue = {
+            "id": i,
+            "project": {"id": 1, "name": "Benchmark"},
+            "tracker": {"id": 1, "name": rnd.choice(trackers)},
+            "status": {"id": 1, "name": status},
+            "priority": {"id": 1, "name": rnd.choice(priorities)},
+            "author": {"id": 1, "name": "Author"},
+            "assigned_to": {"id": 2, "name": "Assignee"},
+            "fixed_version": {"id": 1, "name": "1.0"},
+            "subject": f"Issue {i}: {rnd.choice(words)} {rnd.choice(words)}",
+            "description": "text",
+            "custom_fields": [{"id": 1, "name": "Sub project", "value": "Core"}],
+            "created_on": created,
+            "updated_on": created,
+            "closed_on": "2024-02-01T10:00:00Z" if status == "Closed" else None,
+            "relations": [],
+            "children": [],
+            "attachments": [],
+            "journals": [],
+            "_description": text(description_size),
+            "_notes": {}
+        }
+        if i > 1 and rnd.random() < 0.3:
+            issue["parent"] = {"id": rnd.randint(1, i - 1)}
+        if i > 1 and rnd.random() < 0.3:
+            issue["relations"].append({"id": i, "issue_id": i, "issue_to_id": rnd.randint(1, i - 1),
+                                       "relation_type": "relates"})
+
+        for _ in range(rnd.randint(0, 2 * attachments) if attachments else 0):
+            aid = next(attachment_ids)
+            size = rnd.randint(attachment_size // 2, attachment_size * 3 // 2) if attachment_size else 0
+            issue["attachments"].append({"id": aid, "filename": f"file {aid}.bin", "filesize": size,
+                                         "digest": attachment_digest(aid, size),
+                                         "content_url": f"/attachments/download/{aid}/file%20{aid}.bin"})
+
+        for _ in range(rnd.randint(0, 2 * notes) if notes else 0):
+            jid = next(journal_ids)
+            html = text(description_size // 2)
+            if issue["attachments"] and rnd.random() < 0.5:
+                a = rnd.choice(issue["attachments"])
+                html += f'<p><img src="/attachments/download/{a["id"]}/file%20{a["id"]}.bin"></p>'
+            issue["journals"].append({"id": jid, "user": {"id": 1, "name": "Author"},
+                                      "notes": "text", "created_on": created, "details": []})
+            issue["_notes"][jid] = html
+        if issue["journals"]:
+            issue["updated_on"] = f"2024-03-{1 + i % 28:02}T10:00:00Z"
+
+        project[i] = issue
+
+    for issue in project.values():
+        parent = issue.get("parent")
+        if parent:
+            project[parent["id"]]["children"].append({"id": issue["id"], "tracker": issue["tracker"],
+                                                      "subject": issue["subject"]})
+
+    return project
+
+
+def attachment_blocks(aid: int, size: int, block_size: int = 64 * 1024, offset: int = 0):
+    # content of a synthetic attachment, generated on the fly instead of being kept in memory
+    block = random.Random(aid).randbytes(min(size, block_size))
+    for start in range(0, size, block_size):
+        end = min(start + block_size, size)
+        if end > offset:
+            yield block[max(0, offset - start):end - start]
+
+
+def attachment_digest(aid: int, size: int) -> str:
+    h = hashlib.md5()
+    for block in attachment_blocks(aid, size):
+        h.update(block)
+    return h.hexdigest()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, Nagle's algorithm would delay every response by the client's ACK
+    disable_nagle_algorithm = True
+    server: 'MockServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", '').lower() == "chunked":
+            data = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def reply(self, code: int, body=b'', content_type: str = "application/json",
+              headers: dict = None, size: int = None):
+        """
+        :param body: bytes, text, json object or iterator over bytes of the given size
+        """
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, bytes):
+            body, size = [body], len(body)
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", f"{size}")
+        for name, value in (headers or {}).items():
+            self.send_header(name, f"{value}")
+        self.end_headers()
+        for chunk in body:
+            self.wfile.write(chunk)
+        self.server.count_out(size)
+
+    def handle_request(self, method: str):
+        body = self.body()
+        path = urlsplit(self.path).path
+        if path.startswith("/_mock/"):
+            # control endpoints of the benchmark are not counted
+            return self.server.control(self, method, path)
+
+        endpoint = self.server.endpoint(method, path)
+        self.server.count_in(endpoint, len(self.requestline) + len(f"{self.headers}") + len(body))
+
+        self.server.delay()
+        failure = self.server.failure()
+        if failure:
+            code, headers = failure
+            self.server.count_error(endpoint, code)
+            return self.reply(code, {"message": "injected failure"}, headers=headers)
+
+        try:
+            self.server.route(self, method, body)
+        except Exception as e:
+            self.server.count_error(endpoint, 500)
+            self.reply(500, {"message": f"{e}"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    local stand-in of a remote service with configurable latency, failures and throttling;
+    counts requests and bytes per endpoint
+    """
+    daemon_threads = True
+    endpoints: list[tuple[str, re.Pattern]] = []  # endpoint name and pattern of "METHOD path"
+
+    def __init__(self, profile: ServerProfile = None):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.profile = profile or ServerProfile()
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.tokens = self.profile.rate_limit
+        self.updated = time.monotonic()
+        self.requests: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self) -> str:
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # client closing its keep-alive connections is not an error of the server
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests, self.errors = {}, {}
+            self.bytesIn = self.bytesOut = 0
+
+    def counters(self) -> dict:
+        with self.lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors),
+                    "bytesIn": self.bytesIn, "bytesOut": self.bytesOut}
+
+    def endpoint(self, method: str, path: str) -> str:
+        request = f"{method} {path}"
+        return next((name for name, pattern in self.endpoints if pattern.search(request)), request)
+
+    def count_in(self, endpoint: str, size: int):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytesIn += size
+
+    def count_out(self, size: int):
+        with self.lock:
+            self.bytesOut += size
+
+    def count_error(self, endpoint: str, code: int):
+        with self.lock:
+            key = f"{endpoint} {code}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def delay(self):
+        p = self.profile
+        if p.latency or p.jitter:
+            with self.lock:
+                jitter = self.random.uniform(-p.jitter, p.jitter)
+            time.sleep(max(0.0, p.latency + jitter))
+
+    def failure(self) -> tuple[int, dict]:
+        # injected error or throttling of the request, None if it's served
+        p = self.profile
+        with self.lock:
+            if p.rate_limit:
+                now = time.monotonic()
+                self.tokens = min(p.rate_limit, self.tokens + (now - self.updated) * p.rate_limit)
+                self.updated = now
+                if self.tokens < 1:
+                    return 429, {"Retry-After": f"{p.retry_after:g}"}
+                self.tokens -= 1
+            if p.error_rate and self.random.random() < p.error_rate:
+                return p.error_status, {}
+        return None
+
+    def control(self, handler: MockHandler, method: str, path: str):
+        if method == "GET" and path == "/_mock/counters":
+            return handler.reply(200, self.counters())
+        if method == "POST" and path == "/_mock/reset":
+            self.reset_counters()
+            return handler.reply(200, {})
+        handler.reply(404, {"message": "unknown control endpoint"})
+
+    def route(self, handler: MockHandler, method: str, body: bytes):
+        raise NotImplementedError
+
+
+class MockRedmine(MockServer):
+    """
+    Redmine endpoints used by Redmine.get() and Redmine.get_file():
+    issues.json listing and bulk metadata, issue json and html page, attachment download with Range support
+    """
+    endpoints = [("issues.json", re.compile(r"^GET .*/issues\.json$")),
+                 ("issue.json", re.compile(r"^GET /issues/\d+\.json$")),
+                 ("issue.html", re.compile(r"^GET /issues/\d+\.html$")),
+                 ("attachment", re.compile(r"^GET /attachments/download/"))]
+
+    def __init__(self, project: dict[int, dict], profile: ServerProfile = None):
+        super().__init__(profile)
+        self.project = project
+        self.attachments = {a["id"]: a for issue in project.values() for a in issue["attachments"]}
+
+    def issue(self, i: int, include: set[str]) -> dict:
+        issue = {k: v for k, v in self.project[i].items()
+                 if not k.startswith('_') and k not in ("relations", "children", "attachments", "journals")}
+        for name in ("relations", "children", "attachments", "journals"):
+            if name in include:
+                issue[name] = self.project[i][name]
+        if "attachments" in include:
+            issue["attachments"] = [dict(a, content_url=f"{self.url}{a['content_url']}") for a in issue["attachments"]]
+        return issue
+
+    def page(self, args: dict) -> dict:
+        ids = sorted(self.project)
+        if "issue_id" in args:
+            wanted = {int(i) for i in args["issue_id"].split(',') if i}
+            ids = [i for i in ids if i in wanted]
+        if args.get("parent_id") == "*":
+            ids = [i for i in ids if self.project[i].get("parent")]
+        elif args.get("parent_id"):
+            parents = {int(i) for i in args["parent_id"].split(',') if i}
+            ids = [i for i in ids if (self.project[i].get("parent") or {}).get("id") in parents]
+        updated = args.get("updated_on", '')
+        if updated.startswith(">="):
+            ids = [i for i in ids if self.project[i]["updated_on"] >= updated[2:]]
+
+        offset = int(args.get("offset", 0))
+        limit = min(int(args.get("limit", 25)), 100)
+        include = set(args.get("include", '').split(',')) - {"journals", "children"}
+        return {"issues": [self.issue(i, include) for i in ids[offset:offset + limit]],
+                "total_count": len(ids), "offset": offset, "limit": limit}
+
+    def html(self, i: int) -> str:
+        issue = self.project[i]
+        notes = ''.join(f'<div id="change-{jid}" class="journal"><div id="journal-{jid}-notes" class="wiki">'
+                        f'{html}</div></div>' for jid, html in issue["_notes"].items())
+        return (f'<html><head><title>{issue["subject"]}</title></head><body><div id="content">'
+                f'<div class="issue"><div class="description"><div class="contextual">Quote</div>'
+                f'<p><strong>Description</strong></p><div class="wiki">{issue["_description"]}</div></div></div>'
+                f'<div id="history"><div class="tab-content" id="tab-content-history">{notes}</div></div>'
+                f'</div></body></html>')
+
+    def route(self, handler: MockHandler, method: str, body: bytes):
+        split = urlsplit(handler.path)
+        args = dict(parse_qsl(split.query.replace(';', '&')))
+
+        # Date header, which gives the importer the server time, is sent with every response
+        if method == "GET" and split.path.endswith("/issues.json"):
+            return handler.reply(200, self.page(args))
+
+        m = re.match(r"^/issues/(\d+)\.(json|html)$", split.path)
+        if method == "GET" and m and int(m.group(1)) in self.project:
+            i = int(m.group(1))
+            if m.group(2) == "html":
+                return handler.reply(200, self.html(i), "text/html; charset=utf-8")
+            include = set(args.get("include", '').split(','))
+            return handler.reply(200, {"issue": self.issue(i, include)})
+
+        m = re.match(r"^/attachments/download/(\d+)/", split.path)
+        if method == "GET" and m and int(m.group(1)) in self.attachments:
+            a = self.attachments[int(m.group(1))]
+            r = re.match(r"bytes=(\d+)-$", handler.headers.get("Range", ''))
+            offset = int(r.group(1)) if r else 0
+            if offset >= a["filesize"] and r:
+                return handler.reply(416, b'', "application/octet-stream")
+            return handler.reply(206 if r else 200, attachment_blocks(a["id"], a["filesize"], offset=offset),
+                                 "application/octet-stream", size=a["filesize"] - offset)
+
+        handler.reply(404, {"message": "not found"})
+
+
+class MockAzure(MockServer):
+    """
+    Azure DevOps work item tracking endpoints used by azureItem.py, azureBatch.py and AzureExporter.recover_map():
+    work item creation and json-patch, attachments (simple and chunked upload), $batch, WIQL and workitemsbatch
+    """
+    endpoints = [("$batch", re.compile(r"^POST /[^/]+/_apis/wit/\$batch$")),
+                 ("wiql", re.compile(r"^POST .*/_apis/wit/wiql$")),
+                 ("workitemsbatch", re.compile(r"^POST .*/_apis/wit/workitemsbatch$")),
+                 ("create", re.compile(r"^POST .*/_apis/wit/workitems/\$")),
+                 ("patch", re.compile(r"^PATCH .*/_apis/wit/workitems/\d+$")),
+                 ("attachment", re.compile(r"^POST .*/_apis/wit/attachments$")),
+                 ("attachment chunk", re.compile(r"^PUT .*/_apis/wit/attachments/"))]
+
+    def __init__(self, profile: ServerProfile = None):
+        super().__init__(profile)
+        self.ids = itertools.count(1)
+        self.items: dict[int, dict] = {}
+        self.attachments: dict[str, dict] = {}
+
+    def apply(self, method: str, path: str, ops: list[dict], batch: bool = False) -> tuple[int, dict]:
+        # work item operation, sent directly or inside $batch where items are created by PATCH
+        m = re.search(r"/_apis/wit/workitems/\$([^/?]+)", path)
+        if m and method != ("PATCH" if batch else "POST"):
+            return 405, {"message": f"{method} is not supported for work item creation"}
+        if m:
+            with self.lock:
+                wid = next(self.ids)
+                self.items[wid] = {"id": wid, "type": unquote(m.group(1)), "fields": {}, "relations": [], "rev": 0}
+            return self.patch(wid, ops)
+
+        m = re.search(r"/_apis/wit/workitems/(\d+)", path)
+        if method == "PATCH" and m:
+            return self.patch(int(m.group(1)), ops)
+
+        return 404, {"message": "not found"}
+
+    def patch(self, wid: int, ops: list[dict]) -> tuple[int, dict]:
+        with self.lock:
+            item = self.items.get(wid)
+            if item is None:
+                return 404, {"message": f"work item {wid} does not exist"}
+            for op in ops:
+                if op["path"] == "/relations/-":
+                    item["relations"].append(op["value"])
+                elif op["path"].startswith("/fields/"):
+                    item["fields"][op["path"][len("/fields/"):]] = op["value"]
+                else:
+                    return 400, {"message": f"unsupported path {op['path']}"}
+            item["rev"] += 1
+            return 200, {"id": wid, "rev": item["rev"], "fields": {"System.Title": item["fields"].get("System.Title")}}
+
+    def query(self, wiql: str, top: int) -> list[int]:
+        # the only WIQL the exporter sends: title contains one of the texts and id is above the previous page
+        texts = [t.replace("''", "'") for t in re.findall(r"\[System\.Title] CONTAINS '((?:[^']|'')*)'", wiql)]
+        after = int(re.search(r"\[System\.Id] > (\d+)", wiql).group(1))
+        with self.lock:
+            ids = sorted(wid for wid, item in self.items.items()
+                         if wid > after and any(t in item["fields"].get("System.Title", '') for t in texts))
+        return ids[:top]
+
+    def route(self, handler: MockHandler, method: str, body: bytes):
+        split = urlsplit(handler.path)
+        args = dict(parse_qsl(split.query))
+
+        if method == "POST" and split.path.endswith("/_apis/wit/wiql"):
+            ids = self.query(json.loads(body)["query"], int(args.get("$top", 20000)))
+            return handler.reply(200, {"workItems": [{"id": wid} for wid in ids]})
+
+        if method == "POST" and split.path.endswith("/_apis/wit/workitemsbatch"):
+            request = json.loads(body)
+            if len(request["ids"]) > 200:
+                return handler.reply(400, {"message": "too many ids"})
+            with self.lock:
+                items = [{"id": wid, "fields": {f: self.items[wid]["fields"].get(f) for f in request["fields"]
+                                                if f != "System.Id"}}
+                         for wid in request["ids"] if wid in self.items]
+            return handler.reply(200, {"count": len(items), "value": items})
+
+        if method == "POST" and split.path.endswith("/_apis/wit/$batch"):
+            results = []
+            for r in json.loads(body):
+                code, result = self.apply(r["method"], urlsplit(r["uri"]).path, r["body"], batch=True)
+                results.append({"code": code, "headers": {"Content-Type": "application/json"},
+                                "body": json.dumps(result)})
+            return handler.reply(200, {"count": len(results), "value": results})
+
+        if method == "POST" and split.path.endswith("/_apis/wit/attachments"):
+            with self.lock:
+                aid = f"{len(self.attachments) + 1:08}-0000-0000-0000-000000000000"
+                self.attachments[aid] = {"name": args.get("fileName", ''), "size": len(body), "chunks": 0}
+            return handler.reply(201, {"id": aid, "url": f"{self.url}{split.path}/{aid}"})
+
+        m = re.search(r"/_apis/wit/attachments/([^/]+)$", split.path)
+        if method == "PUT" and m and m.group(1) in self.attachments:
+            r = re.match(r"bytes (\d+)-(\d+)/(\d+)", handler.headers.get("Content-Range", ''))
+            if not r or int(r.group(2)) - int(r.group(1)) + 1 != len(body):
+                return handler.reply(400, {"message": "invalid Content-Range"})
+            with self.lock:
+                a = self.attachments[m.group(1)]
+                a["size"] += len(body)
+                a["chunks"] += 1
+            return handler.reply(201, {"id": m.group(1), "url": f"{self.url}{split.path}"})
+
+        ops = json.loads(body) if body else []
+        code, result = self.apply(method, split.path, ops)
+        handler.reply(code, result)
+
+
+def serve(connection, project: dict, redmine_profile: ServerProfile, azure_profile: ServerProfile):
+    """
+    run mock Redmine and Azure in a separate process, so they don't share CPU and memory with the measured code;
+    urls are sent back through the connection, servers stop when anything is received from it
+    :param connection: multiprocessing connection
+    :param project: arguments of generate_project()
+    :param redmine_profile: behaviour of Redmine
+    :param azure_profile: behaviour of Azure
+    """
+    redmine = MockRedmine(generate_project(**project), redmine_profile)
+    azure = MockAzure(azure_profile)
+    connection.send((redmine.start(), azure.start()))
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    redmine.stop()
+    azure.stop()
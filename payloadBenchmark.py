@@ -0,0 +1,230 @@
+import sys
+import time
+import tempfile
+from configuration import Configuration
+from azure import Azure
+from azureItem import AzureItem
+from dumpStore import DumpStore
+
+
+def _escape_text_legacy(text: str):
+    return (text
+            .encode('unicode_escape')
+            .decode()
+            .replace("'", r"\'")
+            .replace(r'\x', r'\u00'))
+
+
+class _LegacyTemplates:
+    # pseudo-json templates AzureItem used to fill by str.format, kept for benchmarking
+    create_item_template = """[
+        {{
+            'op': 'add',
+            'path': '/fields/System.CreatedDate',
+            'value': '{created_date}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.Title',
+            'value': '{title}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.CreatedBy',
+            'value': '{created_by}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.Tags',
+            'value': '{tags}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/Microsoft.VSTS.Common.Priority',
+            'value': '{priority}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.AssignedTo',
+            'value': '{assignee}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.State',
+            'value': '{status}'
+        }}
+        ]"""
+
+    patch_attachment_template = """[
+        {{
+            'op': 'add',
+            'path': '/relations/-',
+            'value': 
+            {{
+                'rel': 'AttachedFile',
+                'url': '{url}',
+                'attributes': 
+                {{
+                    'comment': ''
+                }}
+            }}
+        }}
+        ]"""
+
+    patch_closed_date_template = """[
+        {{
+            'op': 'replace',
+            'path': '/fields/Microsoft.VSTS.Common.ClosedDate',
+            'value': '{date}'
+        }}
+        ]"""
+
+    patch_description_template = """[
+        {{
+            'op': 'replace',
+            'path': '/fields/System.Description',
+            'value': '{description}'
+        }}
+        ]"""
+
+    patch_repro_steps_template = """[
+        {{
+            'op': 'replace',
+            'path': '/fields/Microsoft.VSTS.TCM.ReproSteps',
+            'value': '{description}'
+        }}
+        ]"""
+
+    patch_add_comment_template = """[
+        {{
+            'op': 'add',
+            'path': '/fields/System.History',
+            'value': '{html}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.ChangedBy',
+            'value': '{author}'
+        }},
+        {{
+            'op': 'add',
+            'path': '/fields/System.createdDate',
+            'value': '{date}'
+        }}
+        ]"""
+
+    patch_add_related_template = f"""[
+    {{{{
+        'op': 'add',
+        'path': '/relations/-',
+        'value': 
+        {{{{
+            'rel': 'System.LinkTypes.Related',
+            'url': 
+            '{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}/workItems/{{id}}',
+            'attributes': 
+            {{{{
+                'isLocked': false,
+                'name': 'Related'
+            }}}}
+        }}}}
+    }}}}
+    ]"""
+
+    patch_add_parent_template = f"""[
+    {{{{
+        'op': 'add',
+        'path': '/relations/-',
+        'value': 
+        {{{{
+            'rel': 'System.LinkTypes.Hierarchy-Reverse',
+            'url': 
+            '{Configuration.azureAddress}/{Configuration.azureOrganization}/{Configuration.azureProject}/workItems/{{id}}',
+            'attributes': 
+            {{{{
+                'isLocked': false,
+                'name': 'Parent'
+            }}}}
+        }}}}
+    }}}}
+    ]"""
+
+
+def _legacy_payloads(a: AzureItem, description: str, notes: list[tuple[dict, str]]) -> list[str]:
+    t = _LegacyTemplates
+    payloads = [t.create_item_template.format(created_date=a.createdDate,
+                                              title=_escape_text_legacy(a.title),
+                                              created_by=a.createdBy,
+                                              assignee=a.assignee,
+                                              tags=a.tags,
+                                              priority=a.priority,
+                                              status=a.status)]
+    if a.status == "Closed":
+        closed_date = a.closedDate if len(a.closedDate) > 5 else "2024-03-30T00:00:00Z"
+        payloads.append(t.patch_closed_date_template.format(date=closed_date))
+    payloads += [t.patch_attachment_template.format(url=att["url"]) for att in a.attachments.values()]
+    description = a.replace_attachments_urls(_escape_text_legacy(description))
+    if a.type == "bug":
+        payloads.append(t.patch_repro_steps_template.format(description=description))
+    else:
+        payloads.append(t.patch_description_template.format(description=description))
+    for n, html in notes:
+        html = a.replace_attachments_urls(_escape_text_legacy(html))
+        html = f"<p>Added by {n['author']} on {n['created_on']}</p>" + html
+        payloads.append(t.patch_add_comment_template.format(html=html, author=n["author"], date=n["created_on"]))
+    if a.redmineData.get("parent"):
+        payloads.append(t.patch_add_parent_template.format(id="1"))
+    payloads += [t.patch_add_related_template.format(id="1") for _ in a.redmineData.get("relations") or []]
+    return payloads
+
+
+def _payloads(a: AzureItem, description: str, notes: list[tuple[dict, str]]) -> list[bytes]:
+    _, _, ops = a.create_operation()
+    payloads = [Azure.payload(ops)]
+    if a.status == "Closed":
+        payloads.append(Azure.payload([op for _, op in a.closedate_steps()]))
+    payloads += [Azure.payload([Azure.attachment_op(att["url"])]) for att in a.attachments.values()]
+    field = 'Microsoft.VSTS.TCM.ReproSteps' if a.type == "bug" else 'System.Description'
+    payloads.append(Azure.payload([Azure.field_op(field, a.replace_attachments_urls(description), 'replace')]))
+    for n, html in notes:
+        html = f"<p>Added by {n['author']} on {n['created_on']}</p>" + a.replace_attachments_urls(html)
+        payloads.append(Azure.payload(Azure.comment_ops(html, n["author"], n["created_on"])))
+    if a.redmineData.get("parent"):
+        payloads.append(Azure.payload([Azure.add_link_op('System.LinkTypes.Hierarchy-Reverse', "1", 'Parent')]))
+    payloads += [Azure.payload([Azure.add_link_op('System.LinkTypes.Related', "1", 'Related')])
+                 for _ in a.redmineData.get("relations") or []]
+    return payloads
+
+
+if __name__ == '__main__':
+    # bytes on the wire and build time of Azure payloads on a dump: python payloadBenchmark.py [dump dir]
+    store = DumpStore.open(sys.argv[1] if len(sys.argv) > 1 else Configuration.redmineDumpDir)
+    samples = []
+    with tempfile.TemporaryDirectory() as working_dir:
+        for rid in store.ids():
+            a = AzureItem(store, rid, working_dir)
+            if not a.load() or not a.type:
+                continue
+            # uploaded attachments are not known here, any Azure attachment url will do
+            a.attachments = {att["filename"]: {"url": f"{Configuration.azureAddress}/_apis/wit/attachments/{att['id']}"}
+                             for att in a.redmineData.get("attachments") or []}
+            notes = []
+            for n in a.redmineData.get("notes") or []:
+                try:
+                    notes.append((n, store.note(rid, n["id"])))
+                except (OSError, KeyError):
+                    pass
+            samples.append((a, store.description(rid), notes))
+
+    results = []
+    for name, build, size in [("legacy templates", _legacy_payloads, lambda p: len(p.encode('utf-8'))),
+                              ("json payload", _payloads, len)]:
+        start = time.perf_counter()
+        payloads = [p for sample in samples for p in build(*sample)]
+        elapsed = time.perf_counter() - start
+        results.append(sum(size(p) for p in payloads))
+        print(f"{name:>20}: {results[-1]} bytes in {len(payloads)} requests, built in {elapsed:.3f}s "
+              f"for {len(samples)} items")
+
+    if results[-1]:
+        print(f"{'':>20}  json payloads are {results[0] / results[-1]:.2f} times smaller")
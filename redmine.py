@@ -1,9 +1,40 @@
+import os
+import asyncio
+import hashlib
+import threading
 import requests
+from urllib.parse import urlparse
 from configuration import Configuration
+from httpClient import HttpClient, AsyncHttpClient, AsyncResponse, aiohttp
 
 
 class Redmine:
     __header = {"X-Redmine-API-Key": f"{Configuration.redmineToken}"}
+    client = HttpClient(name="redmine",
+                        headers=__header,
+                        pool_size=Configuration.redmineMaxConnections,
+                        timeout=Configuration.redmineTimeout,
+                        retries=Configuration.redmineRetries,
+                        backoff=Configuration.redmineBackoff)
+    chunk_size = 1024 * 1024
+    __host_slots: dict[str, threading.BoundedSemaphore] = {}
+    __host_slots_lock = threading.Lock()
+
+    @staticmethod
+    def host_slot(url: str) -> threading.BoundedSemaphore:
+        """
+        get semaphore limiting number of simultaneous requests to the host of the url
+        :param url: any url of the host
+        :return: semaphore shared by all the threads
+        """
+        host = urlparse(url).netloc
+        with Redmine.__host_slots_lock:
+            slot = Redmine.__host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(Configuration.redmineMaxConnections)
+                Redmine.__host_slots[host] = slot
+
+        return slot
 
     @staticmethod
     def get(path, args=''):
@@ -12,12 +43,151 @@ class Redmine:
         else:
             p = f"{Configuration.redmineAddress}{path}"
 
-        return requests.get(p, headers=Redmine.__header)
+        with Redmine.host_slot(p):
+            return Redmine.client.get(p)
+
+    @staticmethod
+    def async_client() -> AsyncHttpClient:
+        """
+        client for asyncio mode, connections to Redmine are limited by redmineMaxConnections like in the threads
+        :return: client to be opened on the event loop by async with
+        """
+        return AsyncHttpClient(name="redmine",
+                               headers=Redmine.__header,
+                               pool_size=Configuration.redmineMaxConnections,
+                               timeout=Configuration.redmineTimeout,
+                               retries=Configuration.redmineRetries,
+                               backoff=Configuration.redmineBackoff)
+
+    @staticmethod
+    async def get_async(client: AsyncHttpClient, path, args='') -> AsyncResponse:
+        if args:
+            return await client.get(f"{Configuration.redmineAddress}{path}?{args}")
+        return await client.get(f"{Configuration.redmineAddress}{path}")
+
+    @staticmethod
+    def file_digest(file_path: str, digest: str) -> str:
+        """
+        calculate digest of the file with the algorithm Redmine used for the given digest
+        :param file_path: path to the file
+        :param digest: digest reported by Redmine: MD5 before Redmine 4.2, SHA256 since 4.2
+        :return: hex digest, empty string if the algorithm is unknown
+        """
+        algorithm = {32: "md5", 64: "sha256"}.get(len(digest))
+        if not algorithm:
+            return ''
+
+        h = hashlib.new(algorithm)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(Redmine.chunk_size), b''):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    @staticmethod
+    def check_file(file_path: str, size: int = None, digest: str = None) -> str:
+        """
+        verify downloaded file against attachment size and digest reported by Redmine
+        :return: empty string if the file is correct, otherwise description of the problem
+        """
+        if size is not None and os.path.getsize(file_path) != size:
+            return f"size {os.path.getsize(file_path)} instead of {size}"
+
+        if digest:
+            actual = Redmine.file_digest(file_path, digest)
+            if actual and actual != digest.lower():
+                return f"digest {actual} instead of {digest}"
+
+        return ''
 
     @staticmethod
-    def get_file(url, file_path):
-        r = requests.get(url, stream=True, headers=Redmine.__header)
-        with open(file_path, 'wb') as output:
-            output.write(r.content)
+    def get_file(url, file_path, size: int = None, digest: str = None) -> bool:
+        """
+        download file in chunks to file_path.part and rename it to file_path when it's complete and verified,
+        interrupted download is resumed from the size of .part file
+        :param url: file url
+        :param file_path: destination path
+        :param size: expected file size, optional
+        :param digest: expected file digest, optional
+        :return: True if file has been downloaded, False if it was already complete
+        """
+        if os.path.isfile(file_path) and not Redmine.check_file(file_path, size, digest):
+            return False
+
+        part_path = f"{file_path}.part"
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if size is not None and offset > size:
+                offset = 0
+
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            try:
+                with Redmine.host_slot(url), Redmine.client.get(url, stream=True, headers=headers) as r:
+                    if r.status_code == 416 and offset:
+                        # nothing left to download, .part file is verified below
+                        break
+
+                    r.raise_for_status()
+                    # server may ignore Range and send the whole file
+                    resumed = offset and r.status_code == 206
+                    with open(part_path, 'ab' if resumed else 'wb') as output:
+                        for chunk in r.iter_content(chunk_size=Redmine.chunk_size):
+                            output.write(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                attempt += 1
+                if attempt > Redmine.client.retries:
+                    raise
+                print(f"Warning: {url}: download interrupted at {offset}, resume #{attempt} [{e}]")
+
+        problem = Redmine.check_file(part_path, size, digest)
+        if problem:
+            os.remove(part_path)
+            raise Exception(f"downloaded file is corrupted: {problem}")
+
+        os.replace(part_path, file_path)
+        return True
+
+    @staticmethod
+    async def get_file_async(client: AsyncHttpClient, url, file_path, size: int = None, digest: str = None) -> bool:
+        """
+        get_file() for asyncio mode, file is verified in a thread not to block the event loop
+        """
+        if os.path.isfile(file_path) and not await asyncio.to_thread(Redmine.check_file, file_path, size, digest):
+            return False
+
+        part_path = f"{file_path}.part"
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if size is not None and offset > size:
+                offset = 0
+
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            try:
+                async with await client.get(url, stream=True, headers=headers) as r:
+                    if r.status_code == 416 and offset:
+                        # nothing left to download, .part file is verified below
+                        break
+
+                    r.raise_for_status()
+                    # server may ignore Range and send the whole file
+                    resumed = offset and r.status_code == 206
+                    with open(part_path, 'ab' if resumed else 'wb') as output:
+                        async for chunk in r.iter_content(Redmine.chunk_size):
+                            output.write(chunk)
+                break
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt > client.retries:
+                    raise
+                print(f"Warning: {url}: download interrupted at {offset}, resume #{attempt} [{e}]")
 
+        problem = await asyncio.to_thread(Redmine.check_file, part_path, size, digest)
+        if problem:
+            os.remove(part_path)
+            raise Exception(f"downloaded file is corrupted: {problem}")
 
+        os.replace(part_path, file_path)
+        return True
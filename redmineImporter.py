@@ -1,14 +1,164 @@
 
+import os
 import json
+import asyncio
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Iterable, Iterator, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from redmineItem import RedmineItem
 from configuration import Configuration
 from redmine import Redmine
+from dumpStore import DumpStore
+from metrics import metrics
 
 
 class RedmineImporter:
-    def __init__(self, dump_dir: str = Configuration.redmineDumpDir):
+    page_size = 100
+    manifest_name = "manifest.json"
+    manifest_save_period = 100
+
+    def __init__(self, dump_dir: str = Configuration.redmineDumpDir, store: DumpStore = None):
         self.issues: list[str] = []
         self.dumpDir: str = dump_dir
+        self.store: DumpStore = store or DumpStore.open(dump_dir)
+        self.updatedOn: dict[str, str] = {}     # issue id -> updated_on reported by the list
+        self.listedOn: str = ''                 # Redmine server time when the list was requested
+        self.cancel = threading.Event()         # set by another thread to stop dumping after the running issues
+
+    @staticmethod
+    def __get_page(offset: int, limit: int, filters: str = '') -> dict:
+        # sorting by id keeps pages stable while issues are created or updated during the scan
+        args = f'status_id=*;sort=id;limit={limit};offset={offset}'
+        if filters:
+            args += f';{filters}'
+        js = Redmine.get(f'/projects/{Configuration.redmineProject}/issues.json', args)
+        data = json.loads(js.content)
+        try:
+            server_time = parsedate_to_datetime(js.headers["Date"])
+        except (KeyError, TypeError, ValueError):
+            server_time = datetime.now(timezone.utc)
+        data["server_time"] = server_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return data
+
+    def __iter_pages(self, filters: str, total_limit: int, workers: int) -> Iterator[dict]:
+        # the first page gives total count of issues, the rest of pages are fetched in parallel
+        total_limit = int(total_limit)
+        data = self.__get_page(0, min(self.page_size, total_limit), filters)
+        yield data
+
+        total_count = min(total_limit, data['total_count'])
+        # server may cap page size below the requested one
+        step = data.get('limit') or self.page_size
+        offsets = range(step, total_count, step)
+        if not offsets:
+            return
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(self.__get_page, offset, min(step, total_count - offset), filters)
+                       for offset in offsets]
+            for f in as_completed(futures):
+                yield f.result()
+
+    def iter_issues(self,
+                    total_limit: int = 1e6,
+                    workers: int = Configuration.redmineMaxConnections,
+                    updated_since: str = '') -> Iterator[str]:
+        """
+        get issues of the project in configuration page by page, the first page gives total count of issues
+        and the rest of pages are fetched in parallel; ids are yielded as soon as their page arrives
+        and are appended to self.issues
+        :param total_limit: optional argument to limit the output list size (for test purposes)
+        :param workers: number of pages fetched in parallel
+        :param updated_since: optional ISO time, only issues updated since then are listed
+        :return: iterator over unique issue ids
+        """
+        seen = set(self.issues)
+        filters = f'updated_on=%3E%3D{updated_since}' if updated_since else ''
+
+        for idx, page in enumerate(self.__iter_pages(filters, total_limit, workers)):
+            if idx == 0:
+                self.listedOn = page["server_time"]
+            ids = []
+            for issue in page["issues"]:
+                rid = f'{issue["id"]}'
+                if rid not in seen:
+                    seen.add(rid)
+                    ids.append(rid)
+                    self.updatedOn[rid] = issue.get("updated_on", '')
+            self.issues.extend(ids)
+            yield from ids
+
+    @staticmethod
+    def fetch_children(ids: list[str]) -> dict[str, list[str]]:
+        """
+        get children of a batch of issues at once by listing issues whose parent is one of them,
+        list endpoint can't include children of an issue; issues of all the projects are listed
+        as children may live in another project
+        :param ids: parent issue ids
+        :return: dictionary of issue id -> list of children ids
+        """
+        children = {}
+        offset = 0
+        while ids:
+            js = Redmine.get('/issues.json', f'parent_id={",".join(ids)};status_id=*;sort=id;'
+                                             f'limit={RedmineImporter.page_size};offset={offset}')
+            data = json.loads(js.content)
+            for issue in data["issues"]:
+                parent = issue.get("parent")
+                if parent:
+                    children.setdefault(f'{parent["id"]}', []).append(f'{issue["id"]}')
+            offset += len(data["issues"])
+            if not data["issues"] or offset >= data["total_count"]:
+                break
+
+        return children
+
+    @staticmethod
+    def fetch_metadata(ids: list[str]) -> dict[str, dict]:
+        """
+        get issues in bulk from issues.json filtered by issue_id, one request per RedmineImporter.page_size issues;
+        list endpoint returns everything RedmineItem needs except journals and children.
+        Only the issue json request is saved: the page of every issue with a description or an update
+        and the journals of every issue with notes are still requested one by one
+        :param ids: issue ids
+        :return: dictionary of issue id -> issue json
+        """
+        metadata = {}
+        for start in range(0, len(ids), RedmineImporter.page_size):
+            batch = ids[start:start + RedmineImporter.page_size]
+            js = Redmine.get('/issues.json',
+                             f'issue_id={",".join(batch)};status_id=*;include=relations,attachments;limit={len(batch)}')
+            data = json.loads(js.content)
+            metadata.update({f'{issue["id"]}': issue for issue in data["issues"]})
+
+        return metadata
+
+    def __iter_bulk(self, issues: Iterable[str]) -> Iterator[tuple[str, dict]]:
+        # collect ids into batches and fetch metadata and children for the whole batch at once
+        batch = []
+        for i in issues:
+            batch.append(i)
+            if len(batch) == self.page_size:
+                yield from self.__with_metadata(batch)
+                batch = []
+        yield from self.__with_metadata(batch)
+
+    def __with_metadata(self, batch: list[str]) -> Iterator[tuple[str, dict]]:
+        try:
+            metadata = self.fetch_metadata(batch)
+            children = self.fetch_children(batch)
+        except Exception as e:
+            print(f"Error: Redmine: cannot get metadata for issues {', '.join(batch)} [{e}]")
+            metadata, children = {}, {}
+        for i in batch:
+            issue = metadata.get(i)
+            if issue is not None:
+                issue["children"] = [{"id": c} for c in children.get(i, [])]
+            # issue missing in bulk response is fetched by RedmineItem on its own
+            yield i, issue
 
     def list_issues(self, total_limit: int = 1e6) -> bool:
         """
@@ -16,38 +166,211 @@ class RedmineImporter:
         :param total_limit: optional argument to limit the output list size (for test purposes)
         :return: True if success
         """
-        offset = 0
+        try:
+            with metrics.phase("list") as phase:
+                for _ in self.iter_issues(total_limit):
+                    phase.advance()
+        except (KeyError, ValueError) as e:
+            print(f"Error: Redmine: cannot list issues [{e}]")
+            return False
 
-        while True:
-            limit = (total_limit - offset) if 0 < (total_limit - offset) < 100 else 100
-            js = Redmine.get(f'/projects/{Configuration.redmineProject}/issues.json',
-                             f'status_id=*;limit={limit};offset={offset}')
-            data = json.loads(js.content)
+        print(f"Found {len(self.issues)} issues")
+        return True
+
+    def load_manifest(self) -> dict:
+        """
+        read dump manifest: time of the last complete synchronization and summary of every dumped issue,
+        see RedmineItem.summary()
+        :return: manifest, empty one if there is no dump yet
+        """
+        try:
+            with open(os.path.join(self.dumpDir, self.manifest_name), "r") as data:
+                manifest = json.load(data)
+        except FileNotFoundError:
+            manifest = {}
+
+        manifest.setdefault("syncedOn", '')
+        manifest.setdefault("issues", {})
+        return manifest
+
+    def save_manifest(self, manifest: dict):
+        # index of packed dump is saved together with the manifest
+        self.store.flush()
+        os.makedirs(self.dumpDir, exist_ok=True)
+        manifest_path = os.path.join(self.dumpDir, self.manifest_name)
+        with open(f"{manifest_path}.tmp", "w") as json_file:
+            json.dump(manifest, json_file, separators=(',', ':'))
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    def dump(self,
+             issues: Iterable[str] = None,
+             workers: int = Configuration.redmineDumpWorkers,
+             replace: bool = False,
+             bulk: bool = Configuration.redmineBulkMetadata) -> bool:
+        """
+        Dump all the information from Redmine to disc
+        :param issues: ids to dump, self.issues by default; may be a stream like self.iter_issues(),
+        dumping starts as soon as the first id arrives
+        :param workers: number of issues dumped in parallel, 1 to dump sequentially
+        :param replace: replace issues which have been dumped before
+        :param bulk: fetch issue metadata in batches instead of one request per issue, see fetch_metadata()
+        :return: True if all the issues have been dumped
+        """
+        manifest = self.load_manifest()
+        failed = []
+        progress = {"done": 0}
+        lock = threading.Lock()
+        # backpressure: a stream is read only as fast as issues are dumped, a few of them wait in the pool
+        slots = threading.BoundedSemaphore(2 * max(1, workers))
+
+        def finished(item, f):
             try:
-                self.issues.extend([f'{issue["id"]}' for issue in data["issues"]])
-                offset = len(self.issues)
-                print(f"New length = {offset}")
-                total_count = data['total_count']
-                if offset >= total_limit or offset >= total_count:
+                ok = f.result()
+            except Exception as e:
+                print(f"Error: {item.id}: dump failed [{e}]")
+                ok = False
+            try:
+                if ok is None:
+                    return
+                with lock:
+                    progress["done"] += 1
+                    if ok:
+                        manifest["issues"][item.id] = item.summary()
+                        if progress["done"] % self.manifest_save_period == 0:
+                            self.save_manifest(manifest)
+                    else:
+                        failed.append(item.id)
+                        metrics.error("dump")
+                phase.advance(failed=not ok)
+            finally:
+                slots.release()
+
+        source = self.issues if issues is None else issues
+        # total of a stream is known only when it's over
+        total = len(source) if isinstance(source, list) else None
+        source = self.__iter_bulk(source) if bulk else ((i, None) for i in source)
+        with metrics.phase("dump", total) as phase, ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            submitted = 0
+            for i, issue in source:
+                slots.acquire()
+                if self.cancel.is_set():
+                    slots.release()
                     break
-            except KeyError as e:
-                print(f"Error: Redmine: Exception at offset={offset}\n{e}")
-                return False
+                submitted += 1
+                ri = RedmineItem(i)
+                executor.submit(self.__dump_item, ri, replace, issue).add_done_callback(partial(finished, ri))
+            phase.total = submitted
 
-        return True
+        return self.__finish_dump(manifest, failed)
 
-    def dump(self):
+    def __dump_item(self, item: RedmineItem, replace: bool, issue: dict) -> Optional[bool]:
+        # issues queued in the pool are skipped once the dump is cancelled, None marks them
+        return None if self.cancel.is_set() else item.dump(self.store, replace, issue)
+
+    async def dump_async(self,
+                         issues: Iterable[str] = None,
+                         tasks: int = Configuration.redmineAsyncTasks,
+                         replace: bool = False,
+                         bulk: bool = Configuration.redmineBulkMetadata) -> bool:
         """
-        Dump all the information from Redmine to disc
-        :return: void
+        dump() on one event loop instead of a thread pool: every issue is an asyncio task and at most `tasks`
+        of them are in flight, requests wait for one of redmineMaxConnections connections of the async client.
+        Dump is the same as the one of dump(). Requires aiohttp.
+        Run it by asyncio.run(importer.dump_async())
+        :param issues: ids to dump, self.issues by default; may be a stream like self.iter_issues()
+        :param tasks: number of issues dumped at once
+        :param replace: replace issues which have been dumped before
+        :param bulk: fetch issue metadata in batches instead of one request per issue
+        :return: True if all the issues have been dumped
+        """
+        manifest = self.load_manifest()
+        failed = []
+        progress = {"done": 0}
+        slots = asyncio.Semaphore(max(1, tasks))
+        running = set()
+
+        async def dump_item(client, i: str, issue: dict):
+            item = RedmineItem(i)
+            try:
+                ok = await item.dump_async(self.store, client, replace, issue)
+            except Exception as e:
+                print(f"Error: {item.id}: dump failed [{e}]")
+                ok = False
+            finally:
+                slots.release()
+
+            # tasks run on one thread, so the manifest doesn't need a lock
+            progress["done"] += 1
+            if ok:
+                manifest["issues"][item.id] = item.summary()
+                if progress["done"] % self.manifest_save_period == 0:
+                    self.save_manifest(manifest)
+            else:
+                failed.append(item.id)
+                metrics.error("dump")
+            phase.advance(failed=not ok)
+
+        source = self.issues if issues is None else issues
+        total = len(source) if isinstance(source, list) else None
+        # stream of ids and bulk metadata come from blocking requests, they are read in a thread
+        streamed = bulk or not isinstance(source, list)
+        source = iter(self.__iter_bulk(source) if bulk else ((i, None) for i in source))
+        async with Redmine.async_client() as client:
+            with metrics.phase("dump", total) as phase:
+                submitted = 0
+                try:
+                    while True:
+                        entry = await asyncio.to_thread(next, source, None) if streamed else next(source, None)
+                        if entry is None:
+                            break
+                        # backpressure: the next issue is taken only when one of the tasks is over
+                        await slots.acquire()
+                        if self.cancel.is_set():
+                            slots.release()
+                            break
+                        submitted += 1
+                        task = asyncio.create_task(dump_item(client, *entry))
+                        running.add(task)
+                        task.add_done_callback(running.discard)
+                finally:
+                    await asyncio.gather(*running)
+                phase.total = submitted
+
+        return self.__finish_dump(manifest, failed)
+
+    def __finish_dump(self, manifest: dict, failed: list[str]) -> bool:
+        # failed issues have to be listed again next time, so the synchronization time is moved only on success
+        cancelled = self.cancel.is_set()
+        if not failed and not cancelled and self.listedOn:
+            manifest["syncedOn"] = self.listedOn
+        self.save_manifest(manifest)
+
+        if failed:
+            print(f"Error: failed to dump {len(failed)} issues: {', '.join(failed)}")
+        if cancelled:
+            print(f"Warning: dump has been cancelled")
+
+        return not failed and not cancelled
+
+    def update(self, workers: int = Configuration.redmineDumpWorkers) -> bool:
+        """
+        Delta dump: list issues updated since the last synchronization recorded in the manifest
+        and dump again only the ones whose updated_on differs from the dumped version
+        :param workers: number of issues dumped in parallel
+        :return: True if all the changed issues have been dumped
         """
-        for i in self.issues:
-            ri = RedmineItem(i)
-            ri.dump(self.dumpDir)
+        manifest = self.load_manifest()
+        dumped = manifest["issues"]
+        print(f"Start updating dump of {len(dumped)} issues changed since {manifest['syncedOn'] or 'the beginning'}...")
 
+        changed = (i for i in self.iter_issues(updated_since=manifest["syncedOn"])
+                   if dumped.get(i, {}).get("updatedOn") != self.updatedOn[i])
+        return self.dump(changed, workers, replace=True)
 
 if __name__ == '__main__':
     # for test purposes
     x = RedmineImporter()
     x.list_issues() # instead of getting all the issues can use a specific ID's for test purposes in form: x.issues = ['197370']
-    x.dump()
+    x.dump()        # or stream ids to start dumping before listing is finished: x.dump(x.iter_issues())
+                    # or dump on one event loop (requires aiohttp): asyncio.run(x.dump_async())
+                    # next waves: RedmineImporter().update() re-dumps only issues changed since this run
@@ -1,11 +1,15 @@
 import os
 import json
-from bs4 import BeautifulSoup
+import shutil
+import asyncio
+from htmlExtractor import parse_issue_html, has_notes
 from redmine import Redmine
+from httpClient import AsyncHttpClient
+from dumpStore import DumpStore
+from metrics import metrics
 
 
 class RedmineItem:
-
     def __init__(self, redmine_id: str):
         self.id = redmine_id
         self.tracker = ""
@@ -18,13 +22,14 @@ class RedmineItem:
         self.description = ""
         self.createdBy = ""
         self.createdOn = ""
+        self.updatedOn = ""
         self.closedOn = ""
         self.attachments = []
         self.related = []
         self.children = []
         self.parent = ''
         self.notes_info = []
-        self.notes_content = []
+        self.notes_content = {}
 
     def __parse_subproj(self, issue) -> str:
         subproj = ''
@@ -55,7 +60,11 @@ class RedmineItem:
         att_list = []
         try:
             attachments = issue['attachments']
-            att_list = [{"id": f"{r['id']}", "filename": r['filename'], "url": r['content_url']} for r in attachments]
+            att_list = [{"id": f"{r['id']}",
+                         "filename": r['filename'],
+                         "url": r['content_url'],
+                         "filesize": r.get('filesize'),
+                         "digest": r.get('digest')} for r in attachments]
         except KeyError as e:
             print(f"Warning: {self.id}: No attachment found [{e}]")
 
@@ -71,17 +80,6 @@ class RedmineItem:
 
         return id_list
 
-    def __parse_description(self, html_soup):
-        try:
-            d = html_soup.body.find('div', attrs={'class': 'description'})
-
-            if bool(d):
-                d.find('div', {'class': 'contextual'}).decompose()
-
-            return d
-        except Exception as e:
-            print(f"Warning: {self.id}: No children found [{e}]")
-
     def __parse_notes_info(self, issue) -> list[dict]:
         notes_info = []
         journals = issue.get("journals")
@@ -99,15 +97,6 @@ class RedmineItem:
 
         return notes_info
 
-    def __parse_notes_content(self, html_soup) -> dict[str,str]:
-        notes_list = {}
-        history_block = html_soup.body.find("div", "tab-content")
-        for n in self.notes_info:
-            message = history_block.find("div", id=f"journal-{n['id']}-notes")
-            notes_list[n["id"]] = message
-
-        return notes_list
-
     def __parse_field1(self, issue, name) -> str:
         field = ''
         try:
@@ -126,56 +115,196 @@ class RedmineItem:
 
         return f"{field}"
 
-    def fill(self) -> bool:
+    def fill(self, issue: dict = None) -> bool:
+        """
+        get issue data from Redmine
+        :param issue: issue json fetched in bulk from issues.json with relations, attachments and children;
+        html page is requested only if the issue may have notes or description, journals only if the page
+        has notes, as the page doesn't give exact time of a note
+        :return: True if success
+        """
         try:
             # parse from json
-            js = Redmine.get(f"/issues/{self.id}.json", "include=relations,children,attachments,journals")
-            data = json.loads(js.content)
-
-            issue = data['issue']
-            self.tracker = self.__parse_field2(issue, 'tracker', 'name')
-            self.createdBy = self.__parse_field2(issue, 'author', 'name')
-            self.status = self.__parse_field2(issue, 'status', 'name')
-            self.priority = self.__parse_field2(issue, 'priority', 'name')
-            self.assignee = self.__parse_field2(issue, 'assigned_to', 'name')
-            self.targetVersion = self.__parse_field2(issue, 'fixed_version', 'name')
-            self.parent = self.__parse_field2(issue, 'parent', 'id')
-            self.title = self.__parse_field1(issue, 'subject')
-            self.createdOn = self.__parse_field1(issue, 'created_on')
-            self.closedOn = self.__parse_field1(issue, 'closed_on')
-            self.subProject = self.__parse_subproj(issue)
-            self.related = self.__parse_relations(issue)
-            self.children = self.__parse_children(issue)
-            self.attachments = self.__parse_attachments(issue)
-            self.notes_info = self.__parse_notes_info(issue)
+            html = None
+            if issue is None:
+                js = Redmine.get(f"/issues/{self.id}.json", "include=relations,children,attachments,journals")
+                issue = json.loads(js.content)['issue']
+            elif issue.get('updated_on') != issue.get('created_on'):
+                # any note updates the issue, so an issue that has never been updated has no journals
+                html = Redmine.get(f"/issues/{self.id}.html?include=journals")
+                if has_notes(html.content):
+                    js = Redmine.get(f"/issues/{self.id}.json", "include=journals")
+                    issue['journals'] = json.loads(js.content)['issue'].get('journals', [])
+            self.__parse(issue)
 
             # parse from html
-            html = Redmine.get(f"/issues/{self.id}.html?include=journals")
-            html_soup = BeautifulSoup(html.content, 'html.parser')
-            self.description = self.__parse_description(html_soup)
-            self.notes_content = self.__parse_notes_content(html_soup)
+            if html is not None or self.__has_html(issue):
+                if html is None:
+                    html = Redmine.get(f"/issues/{self.id}.html?include=journals")
+                with metrics.timer("parse"):
+                    self.__parse_html(html.content)
             return True
         except Exception as e:
             print(f"Error: {self.id}: cannot fill data [{e}]")
 
         return False
 
-    def dump(self, root_dir: str) -> bool:
+    async def fill_async(self, client: AsyncHttpClient, issue: dict = None) -> bool:
+        """
+        fill() for asyncio mode, html is parsed in a thread not to block the event loop, see parse_issue_html()
+        """
+        try:
+            html = None
+            if issue is None:
+                js = await Redmine.get_async(client, f"/issues/{self.id}.json",
+                                             "include=relations,children,attachments,journals")
+                issue = json.loads(js.content)['issue']
+            elif issue.get('updated_on') != issue.get('created_on'):
+                html = await Redmine.get_async(client, f"/issues/{self.id}.html?include=journals")
+                if has_notes(html.content):
+                    js = await Redmine.get_async(client, f"/issues/{self.id}.json", "include=journals")
+                    issue['journals'] = json.loads(js.content)['issue'].get('journals', [])
+            self.__parse(issue)
+
+            if html is not None or self.__has_html(issue):
+                if html is None:
+                    html = await Redmine.get_async(client, f"/issues/{self.id}.html?include=journals")
+                with metrics.timer("parse"):
+                    await asyncio.to_thread(self.__parse_html, html.content)
+            return True
+        except Exception as e:
+            print(f"Error: {self.id}: cannot fill data [{e}]")
 
-        rid = f"{self.id}"
-        issue_path = os.path.join(root_dir, rid)
-        attachments_path = os.path.join(issue_path, "attachments")
-        history_path = os.path.join(issue_path, "history")
+        return False
 
-        # create directory, exit if exists
-        try:
-            os.makedirs(attachments_path, exist_ok=False)
-            os.makedirs(history_path, exist_ok=False)
-        except OSError as e:
-            print(f"Error: {self.id}: failed to dump work item, can't create output directories [{e}]")
+    def __parse(self, issue: dict):
+        self.tracker = self.__parse_field2(issue, 'tracker', 'name')
+        self.createdBy = self.__parse_field2(issue, 'author', 'name')
+        self.status = self.__parse_field2(issue, 'status', 'name')
+        self.priority = self.__parse_field2(issue, 'priority', 'name')
+        self.assignee = self.__parse_field2(issue, 'assigned_to', 'name')
+        self.targetVersion = self.__parse_field2(issue, 'fixed_version', 'name')
+        self.parent = self.__parse_field2(issue, 'parent', 'id')
+        self.title = self.__parse_field1(issue, 'subject')
+        self.createdOn = self.__parse_field1(issue, 'created_on')
+        self.updatedOn = self.__parse_field1(issue, 'updated_on')
+        self.closedOn = self.__parse_field1(issue, 'closed_on')
+        self.subProject = self.__parse_subproj(issue)
+        self.related = self.__parse_relations(issue)
+        self.children = self.__parse_children(issue)
+        self.attachments = self.__parse_attachments(issue)
+        self.notes_info = self.__parse_notes_info(issue)
+
+    def __has_html(self, issue: dict) -> bool:
+        # issue page is needed only for description and notes
+        if 'description' in issue and not issue['description'] and not self.notes_info:
+            self.description, self.notes_content = '', {}
+            return False
+        return True
+
+    def __parse_html(self, content: bytes):
+        # plain strings come back from the parser processes, nothing keeps the parsed page alive
+        self.description, self.notes_content = parse_issue_html(content, [n["id"] for n in self.notes_info])
+
+    def summary(self) -> dict:
+        """
+        short description of the dumped issue for the dump manifest, lets the exporter plan its work
+        without reading data.json of every issue
+        :return: manifest entry of the issue
+        """
+        return {
+            "updatedOn": self.updatedOn,
+            "tracker": self.tracker,
+            "status": self.status,
+            "parent": self.parent,
+            "relations": self.related,
+            "notes": len(self.notes_info),
+            "attachments": len(self.attachments),
+            "attachmentsSize": sum(a.get('filesize') or 0 for a in self.attachments),
+            "descriptionSize": len(self.description)
+        }
+
+    def dump(self, store: DumpStore, replace: bool = False, issue: dict = None) -> bool:
+        """
+        Fetch the issue and save it to the dump. Attachments are downloaded to the staging area first
+        and the issue is saved only when everything has been fetched, so a failed dump can be repeated.
+        :param store: dump in directory or packed layout, see DumpStore.open()
+        :param replace: replace existing dump of the issue, attachments which didn't change are reused
+        :param issue: optional issue json fetched in bulk, see fill()
+        :return: True if success
+        """
+        dumped = store.exists(f"{self.id}")
+        if dumped and not replace:
+            print(f"Error: {self.id}: failed to dump work item, it already exists in the dump")
+            return False
+
+        with metrics.timer("fill"):
+            if not self.fill(issue):
+                metrics.error("fill")
+                return False
+
+        ok = True
+
+        # download attachments, take the ones which are already in the previous dump from there
+        for idx, a in enumerate(self.attachments):
+            try:
+                file_path = self.__stage_attachment(store, a, dumped)
+                with metrics.timer("download"):
+                    Redmine.get_file(a['url'], file_path, a['filesize'], a['digest'])
+            except Exception as e:
+                print(f"Error: {self.id}: failed to dump attachment #{idx} [{e}]")
+                metrics.error("download")
+                ok = False
+
+        return self.__save(store, ok)
+
+    async def dump_async(self, store: DumpStore, client: AsyncHttpClient,
+                         replace: bool = False, issue: dict = None) -> bool:
+        """
+        dump() for asyncio mode: requests are sent by the client of the event loop,
+        files are verified and the issue is saved in threads
+        :param client: opened client, see Redmine.async_client()
+        """
+        dumped = store.exists(f"{self.id}")
+        if dumped and not replace:
+            print(f"Error: {self.id}: failed to dump work item, it already exists in the dump")
             return False
 
-        if not self.fill():
+        with metrics.timer("fill"):
+            if not await self.fill_async(client, issue):
+                metrics.error("fill")
+                return False
+
+        ok = True
+        for idx, a in enumerate(self.attachments):
+            try:
+                file_path = await asyncio.to_thread(self.__stage_attachment, store, a, dumped)
+                with metrics.timer("download"):
+                    await Redmine.get_file_async(client, a['url'], file_path, a['filesize'], a['digest'])
+            except Exception as e:
+                print(f"Error: {self.id}: failed to dump attachment #{idx} [{e}]")
+                metrics.error("download")
+                ok = False
+
+        return await asyncio.to_thread(self.__save, store, ok)
+
+    def __stage_attachment(self, store: DumpStore, a: dict, dumped: bool) -> str:
+        # staging path of the attachment, unchanged file of the previous dump is linked there
+        rid = f"{self.id}"
+        file_path = store.staging_attachment(rid, a['filename'])
+        old_path = store.attachment(rid, a['filename']) if dumped else ''
+        if (not os.path.isfile(file_path) and old_path and os.path.isfile(old_path)
+                and not Redmine.check_file(old_path, a['filesize'], a['digest'])):
+            try:
+                os.link(old_path, file_path)
+            except OSError:
+                shutil.copy2(old_path, file_path)
+
+        return file_path
+
+    def __save(self, store: DumpStore, complete: bool) -> bool:
+        if not complete:
+            print(f"Error: {self.id}: dump is incomplete, downloaded attachments are kept in {store.staging_dir}")
             return False
 
         d = {
@@ -189,6 +318,7 @@ class RedmineItem:
             "title": self.title,
             "createdBy": self.createdBy,
             "createdOn": self.createdOn,
+            "updatedOn": self.updatedOn,
             "closedOn": self.closedOn,
             "parent": self.parent,
             "relations": self.related,
@@ -197,32 +327,12 @@ class RedmineItem:
             "notes": self.notes_info
         }
 
-        # save general data
-        try:
-            with open(os.path.join(issue_path, 'data.json'), "w") as json_file:
-                json.dump(d, json_file, indent=4)
-        except Exception as e:
-            print(f"Error: {self.id}: failed to dump json [{e}]")
-
-        # save html content for description
         try:
-            with open(os.path.join(issue_path, 'description.htm'), "w", encoding="utf-8") as descr_file:
-                descr_file.write(f"{self.description}")
+            with metrics.timer("save"):
+                store.save(f"{self.id}", d, self.description, self.notes_content)
         except Exception as e:
-            print(f"Error: {self.id}: failed to dump description [{e}]")
-
-        # save html content for notes
-        for note_id in self.notes_content:
-            try:
-                with open(os.path.join(history_path, f"{note_id}.htm"), 'w', encoding="utf-8") as h_file:
-                    h_file.write(f"{self.notes_content[note_id]}")
-            except Exception as e:
-                print(f"Error: {self.id}: failed to dump history element #{note_id} [{e}]")
-
-        # download attachments
-        for idx, a in enumerate(self.attachments):
-            try:
-                Redmine.get_file(a['url'], os.path.join(attachments_path, a['filename']))
-            except Exception as e:
-                print(f"Error: {self.id}: failed to dump attachment #{idx} [{e}]")
+            print(f"Error: {self.id}: failed to save dump [{e}]")
+            metrics.error("save")
+            return False
 
+        return True
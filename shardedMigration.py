@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from contextlib import contextmanager
+from configuration import Configuration
+from redmineImporter import RedmineImporter
+from azureExporter import AzureExporter
+from migrationState import MigrationState
+from dumpStore import DumpStore
+from metrics import metrics
+
+
+class ShardLeases:
+    """
+    Expiring leases kept as files in a directory shared by all the workers, e.g. on the dump volume.
+    <name>.lease holds the owner, expiry time and progress of the claimed work, <name>.done marks finished work.
+    Leases are changed only under a lock file created exclusively, files are replaced atomically.
+    The lock file holds a token of its holder; it's removed by an atomic rename to a unique name,
+    so a stale lock is broken by one worker only and a fresh lock renamed by mistake is put back.
+    Expiry is compared with the local clock, so clocks of the hosts have to be synchronized.
+    """
+    lock_name = ".lock"
+    lock_timeout = 30  # seconds, lock left by a crashed worker is removed after that
+
+    def __init__(self, directory: str, owner: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.owner = owner
+
+    @staticmethod
+    def __token(path: str) -> str:
+        try:
+            with open(path, "r") as lock:
+                return lock.read()
+        except FileNotFoundError:
+            return ''
+
+    def __unlock(self, path: str, token: str) -> bool:
+        """
+        remove the lock if it still holds the token
+        :return: True if the lock has been removed by this call
+        """
+        moved = f"{path}.{uuid.uuid4().hex}"
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return False
+        if self.__token(moved) == token:
+            os.remove(moved)
+            return True
+        # the lock has been taken by another worker meanwhile, it's put back unless yet another one took it
+        try:
+            os.link(moved, path)
+        except FileExistsError:
+            pass
+        os.remove(moved)
+        return False
+
+    @contextmanager
+    def __locked(self):
+        path = os.path.join(self.directory, self.lock_name)
+        token = f"{self.owner}:{uuid.uuid4().hex}"
+        while True:
+            try:
+                lock = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(lock, token.encode())
+                os.close(lock)
+                break
+            except FileExistsError:
+                # token is read before the time, a lock replaced in between looks fresh
+                stale = self.__token(path)
+                try:
+                    if time.time() - os.path.getmtime(path) > self.lock_timeout:
+                        self.__unlock(path, stale)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            self.__unlock(path, token)
+
+    def __path(self, name: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    def __read(self, name: str) -> dict:
+        try:
+            with open(self.__path(name, "lease"), "r") as lease:
+                return json.load(lease)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def __write(self, name: str, progress: dict):
+        path = self.__path(name, "lease")
+        with open(f"{path}.tmp", "w") as lease:
+            json.dump({"owner": self.owner, "expires": time.time() + Configuration.shardLeaseTime,
+                       "progress": progress}, lease)
+        os.replace(f"{path}.tmp", path)
+
+    def done(self, name: str) -> bool:
+        return os.path.exists(self.__path(name, "done"))
+
+    def holder(self, name: str) -> str:
+        """
+        :return: owner of the unexpired lease, empty if the work is free to claim
+        """
+        lease = self.__read(name)
+        return lease["owner"] if lease and lease["expires"] > time.time() else ''
+
+    def claim(self, name: str) -> bool:
+        """
+        take the work if it's not finished and nobody else holds an unexpired lease on it;
+        expired lease of a crashed worker is taken over
+        :param name: shard number, 'plan' or 'merge'
+        :return: True if the lease is ours now
+        """
+        with self.__locked():
+            if self.done(name) or self.holder(name) not in ('', self.owner):
+                return False
+            self.__write(name, {})
+            return True
+
+    def renew(self, name: str, progress: dict) -> bool:
+        """
+        heartbeat: extend the lease and report progress of the work
+        :return: False if the lease has expired and has been taken over by another worker
+        """
+        with self.__locked():
+            if self.__read(name).get("owner") != self.owner:
+                return False
+            self.__write(name, progress)
+            return True
+
+    def release(self, name: str):
+        # unfinished work is left to the next worker which claims it
+        with self.__locked():
+            if self.__read(name).get("owner") == self.owner:
+                os.remove(self.__path(name, "lease"))
+
+    def finish(self, name: str) -> bool:
+        """
+        mark the work as done and drop the lease
+        :return: False if the lease has been taken over by another worker meanwhile
+        """
+        with self.__locked():
+            if self.__read(name).get("owner") != self.owner:
+                return False
+            with open(self.__path(name, "done"), "w") as done:
+                json.dump({"owner": self.owner, "finished": time.time()}, done)
+            os.remove(self.__path(name, "lease"))
+            return True
+
+
+class ShardedMigration:
+    """
+    Migration by several workers, possibly on different hosts sharing the dump and the working directories.
+    The first worker lists the issues and splits their ids into ranges of shardSize issues (shards/plan.json).
+    Every worker claims a free shard by a lease, dumps and exports it into shards/<number> and takes the next one;
+    the lease is extended by heartbeats carrying progress of the worker, so a shard of a crashed worker
+    is taken over by another one when the lease expires. Export of a shard resumes from its migration state;
+    a worker which finds its lease taken over stops after the running item, still shardLeaseTime has to be
+    well above possible pauses of a worker. Issues which can't be dumped, e.g. deleted after planning,
+    are recorded in shards/<number>/failed.json and don't keep the shard unfinished.
+    Migration states on the shared volume use the rollback journal, WAL works only on a single host.
+    Links between items are not added by shards: when every shard is finished, one of the workers merges
+    manifests and migration states of the shards into the dump and the working directories, saves
+    the complete redmine2azure map and adds parent and related links of all the items.
+    """
+    shards_dir = "shards"
+    plan_name = "plan.json"
+
+    def __init__(self,
+                 dump_dir: str = Configuration.redmineDumpDir,
+                 working_dir: str = Configuration.azureWorkingDir,
+                 owner: str = ''):
+        self.dumpDir: str = dump_dir
+        self.workingDir: str = working_dir
+        self.shardsDir: str = os.path.join(working_dir, self.shards_dir)
+        # shards are dumped by several workers at once, packed dump has a single index
+        self.store: DumpStore = DumpStore(dump_dir)
+        self.owner: str = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.leases = ShardLeases(self.shardsDir, self.owner)
+
+    def run(self,
+            redmine_workers: int = Configuration.redmineDumpWorkers,
+            batch_size: int = Configuration.azureBatchSize,
+            combined: bool = Configuration.azureCombinedPatch) -> bool:
+        """
+        work on shards until all of them are finished, then merge them; every worker runs the same
+        :param redmine_workers: number of issues of a shard dumped in parallel
+        :param batch_size: operations per $batch request, 0 to send one request per operation
+        :param combined: patch fields and attachments of an item by one request
+        :return: True if all the issues have been migrated and the shards merged
+        """
+        print(f"Start sharded migration as {self.owner}...")
+        if not self.__until_done("plan", lambda cancel: self.__plan()):
+            return False
+        shards = [f"{n}" for n in range(len(self.__load_plan()["shards"]))]
+
+        failed = set()
+        while True:
+            pending = [s for s in shards if not self.leases.done(s)]
+            if not pending:
+                break
+            # shards failed here are left to other workers
+            shard = next((s for s in pending if s not in failed and self.leases.claim(s)), None)
+            if shard is not None:
+                if not self.__hold(shard, lambda cancel: self.__migrate(shard, cancel, redmine_workers,
+                                                                         batch_size, combined)):
+                    failed.add(shard)
+                continue
+            if all(s in failed for s in pending):
+                print(f"Error: failed to migrate shards {', '.join(pending)}")
+                return False
+            # other workers are busy with the rest, their shards are taken over if they stop heartbeating
+            time.sleep(Configuration.shardHeartbeatPeriod)
+
+        if not self.__until_done("merge", lambda cancel: self.__merge(shards, cancel, batch_size)):
+            return False
+
+        lost = [i for s in shards for i in self.__load_failed(os.path.join(self.shardsDir, s))]
+        if lost:
+            print(f"Error: {len(lost)} issues have not been migrated: {', '.join(lost)}")
+        return not lost
+
+    def __until_done(self, name: str, action) -> bool:
+        # the work is done by this worker or the one holding its lease, waiting one takes it over on expiry
+        while not self.leases.done(name):
+            if self.leases.claim(name):
+                if not self.__hold(name, action):
+                    return False
+            else:
+                print(f"Info: {name} is done by {self.leases.holder(name) or 'another worker'}, wait...")
+                time.sleep(Configuration.shardHeartbeatPeriod)
+
+        return True
+
+    def __hold(self, name: str, action) -> bool:
+        """
+        run the claimed work while a heartbeat thread extends its lease
+        :param action: function of the event which is set when the lease is lost, the work has to stop then
+        :return: True if the work has been finished by this worker
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            expires = time.time() + Configuration.shardLeaseTime
+            while not stop.wait(Configuration.shardHeartbeatPeriod):
+                attempt = time.time()
+                try:
+                    renewed = self.leases.renew(name, metrics.snapshot()["phases"])
+                except Exception as e:
+                    # shared volume may fail for a while, e.g. lease file open by another worker on Windows;
+                    # the lease is still ours if the next heartbeat comes before it expires
+                    print(f"Warning: shard {name}: cannot renew lease [{e}]")
+                    if time.time() + Configuration.shardHeartbeatPeriod < expires:
+                        continue
+                    print(f"Error: shard {name}: lease expires before it can be renewed")
+                    lost.set()
+                    return
+                if not renewed:
+                    print(f"Error: shard {name}: lease has been taken over by another worker")
+                    lost.set()
+                    return
+                expires = attempt + Configuration.shardLeaseTime
+
+        beating = threading.Thread(target=heartbeat, daemon=True)
+        beating.start()
+        try:
+            ok = action(lost)
+        except Exception as e:
+            print(f"Error: shard {name}: failed [{e}]")
+            ok = False
+        finally:
+            stop.set()
+            beating.join()
+
+        if ok and not lost.is_set() and self.leases.finish(name):
+            return True
+        if not lost.is_set():
+            self.leases.release(name)
+        return False
+
+    def __load_plan(self) -> dict:
+        with open(os.path.join(self.shardsDir, self.plan_name), "r") as plan:
+            return json.load(plan)
+
+    def __plan(self) -> bool:
+        importer = RedmineImporter(self.dumpDir, self.store)
+        if not importer.list_issues():
+            return False
+
+        ids = sorted(importer.issues, key=int)
+        size = max(1, Configuration.shardSize)
+        shards = [{"first": ids[i], "last": ids[min(i + size, len(ids)) - 1], "issues": ids[i:i + size]}
+                  for i in range(0, len(ids), size)]
+        path = os.path.join(self.shardsDir, self.plan_name)
+        with open(f"{path}.tmp", "w") as plan:
+            json.dump({"listedOn": importer.listedOn, "shards": shards}, plan)
+        os.replace(f"{path}.tmp", path)
+        print(f"Planned {len(shards)} shards of {len(ids)} issues")
+        return True
+
+    @staticmethod
+    def __load_failed(shard_dir: str) -> list[str]:
+        try:
+            with open(os.path.join(shard_dir, "failed.json"), "r") as failed:
+                return json.load(failed)
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def __save_failed(shard_dir: str, failed: list[str]):
+        path = os.path.join(shard_dir, "failed.json")
+        with open(f"{path}.tmp", "w") as data:
+            json.dump(failed, data)
+        os.replace(f"{path}.tmp", path)
+
+    def __migrate(self, shard: str, cancel: threading.Event,
+                  redmine_workers: int, batch_size: int, combined: bool) -> bool:
+        # manifest, migration state and work items of the shard are kept in its own directory
+        issues = self.__load_plan()["shards"][int(shard)]["issues"]
+        shard_dir = os.path.join(self.shardsDir, shard)
+        print(f"Start shard {shard}: {len(issues)} issues from {issues[0]} to {issues[-1]}...")
+
+        importer = RedmineImporter(shard_dir, self.store)
+        importer.cancel = cancel
+        dumped = importer.load_manifest()["issues"]
+        # issue saved by a crashed worker after the last manifest save is dumped again
+        todo = [i for i in issues if i not in dumped]
+        importer.dump(todo, redmine_workers, replace=True)
+        if cancel.is_set():
+            return False
+        # failing the shard would keep it unfinished for every worker, so the failed issues are left out
+        dumped = importer.load_manifest()["issues"]
+        failed = [i for i in todo if i not in dumped]
+        if failed:
+            print(f"Error: shard {shard}: issues {', '.join(failed)} failed to dump, they are not migrated")
+        self.__save_failed(shard_dir, failed)
+
+        exporter = AzureExporter(shard_dir, shard_dir, self.store, MigrationState(shard_dir, shared=True))
+        exporter.cancel = cancel
+        try:
+            # the store is shared by all the shards, so the shard is limited to its own issues
+            exporter.load(issues)
+            exporter.create(batch_size)
+            if not cancel.is_set():
+                exporter.attachments()
+            if not cancel.is_set():
+                exporter.patch(batch_size, combined, relations=False)
+        finally:
+            exporter.state.close()
+
+        return not cancel.is_set()
+
+    def __merge(self, shards: list[str], cancel: threading.Event, batch_size: int) -> bool:
+        print(f"Start merging {len(shards)} shards...")
+        manifest = {"syncedOn": self.__load_plan()["listedOn"], "issues": {}}
+        state = MigrationState(self.workingDir, shared=True)
+        try:
+            for shard in shards:
+                shard_dir = os.path.join(self.shardsDir, shard)
+                manifest["issues"].update(RedmineImporter(shard_dir, self.store).load_manifest()["issues"])
+                state.merge(os.path.join(shard_dir, MigrationState.file_name))
+        finally:
+            state.close()
+        RedmineImporter(self.dumpDir, self.store).save_manifest(manifest)
+
+        exporter = AzureExporter(self.dumpDir, self.workingDir, self.store, MigrationState(self.workingDir, shared=True))
+        exporter.cancel = cancel
+        try:
+            exporter.load()
+            exporter.link(batch_size)
+            exporter.save_map()
+        finally:
+            exporter.state.close()
+
+        return not cancel.is_set()
+
+
+if __name__ == '__main__':
+    # run on every node, all of them need the same dump and working directories, e.g. on a shared volume
+    # a new migration starts with an empty <working dir>/shards directory
+    ShardedMigration().run()
@@ -0,0 +1,207 @@
+import os
+import sys
+import queue
+import threading
+from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from configuration import Configuration
+from redmineItem import RedmineItem
+from redmineImporter import RedmineImporter
+from azureExporter import AzureExporter
+from azureItem import AzureItem
+from dumpStore import DumpStore, TransientDumpStore
+from metrics import metrics
+
+
+class StreamingMigration:
+    """
+    Migration without a full intermediate dump: issues are listed, fetched from Redmine and exported to Azure
+    one by one. The steps are connected by bounded queues, so a slow step holds the previous ones back
+    and only a few hundred issues are kept in memory and on disk at once.
+    Links to items which are not in Azure yet are deferred in the migration state and added as soon as
+    the linked item is created, in this run or in one of the next waves.
+    Dump is written only if dump_dir is given, as an audit copy which AzureExporter can read as well.
+    """
+    stream_dir = "stream"  # manifest and attachments in flight of a run without dump, in the working directory
+
+    def __init__(self, working_dir: str = Configuration.azureWorkingDir, dump_dir: str = ''):
+        stream_dir = dump_dir or os.path.join(working_dir, self.stream_dir)
+        self.store: DumpStore = DumpStore.open(dump_dir) if dump_dir else TransientDumpStore(stream_dir)
+        self.importer = RedmineImporter(stream_dir, self.store)
+        self.exporter = AzureExporter(stream_dir, working_dir, self.store)
+        self.state = self.exporter.state
+        # map of created items and deferred links are changed together
+        self.lock = threading.Lock()
+
+    def run(self,
+            issues: Iterable[str] = None,
+            redmine_workers: int = Configuration.redmineDumpWorkers,
+            azure_workers: int = Configuration.azureWorkers,
+            queue_size: int = Configuration.streamQueueSize,
+            combined: bool = Configuration.azureCombinedPatch) -> bool:
+        """
+        migrate issues changed since the previous run, every issue is exported as soon as it's fetched
+        :param issues: ids to migrate, by default issues updated since the previous run are listed
+        :param redmine_workers: number of issues fetched in parallel
+        :param azure_workers: number of issues exported in parallel
+        :param queue_size: max number of issues waiting for each step
+        :param combined: patch fields and attachments of an item by one request, see AzureItem.patch_combined()
+        :return: True if all the issues have been migrated
+        """
+        manifest = self.importer.load_manifest()
+        if issues is None:
+            print(f"Start migrating issues changed since {manifest['syncedOn'] or 'the beginning'}...")
+            issues = self.importer.iter_issues(updated_since=manifest["syncedOn"])
+        self.link_ready()
+
+        fetched = queue.Queue(maxsize=max(1, queue_size))
+        dumped = queue.Queue(maxsize=max(1, queue_size))
+        failed = []
+        progress = {"listed": True, "done": 0}
+        lock = threading.Lock()
+        phase = None
+
+        def list_issues():
+            try:
+                for i in issues:
+                    # waits while Redmine workers are behind
+                    fetched.put(f"{i}")
+            except Exception as e:
+                print(f"Error: Redmine: cannot list issues [{e}]")
+                progress["listed"] = False
+            finally:
+                for _ in range(redmine_workers):
+                    fetched.put(None)
+
+        def finished(rid: str, ok: bool):
+            with lock:
+                progress["done"] += 1
+                if not ok:
+                    failed.append(rid)
+                elif progress["done"] % RedmineImporter.manifest_save_period == 0:
+                    self.importer.save_manifest(manifest)
+            phase.advance(failed=not ok)
+
+        def dump_issues():
+            while (rid := fetched.get()) is not None:
+                item = RedmineItem(rid)
+                try:
+                    ok = item.dump(self.store, replace=True)
+                except Exception as e:
+                    print(f"Error: {rid}: dump failed [{e}]")
+                    ok = False
+                if not ok:
+                    metrics.error("dump")
+                    finished(rid, False)
+                    continue
+
+                # waits while Azure workers are behind
+                dumped.put((rid, item.summary()))
+
+        def export_issues():
+            while (entry := dumped.get()) is not None:
+                rid, summary = entry
+                # the manifest keeps the version of the last export, a failed one is compared with it again
+                with lock:
+                    updated = manifest["issues"].get(rid, {}).get("updatedOn") != summary["updatedOn"]
+                try:
+                    ok = self.export(rid, combined, updated)
+                except Exception as e:
+                    print(f"Error: {self.exporter.redmineToAzureMap.get(rid, 0)}({rid}): export failed [{e}]")
+                    metrics.error("export")
+                    ok = False
+                self.store.discard(rid)
+                if ok:
+                    with lock:
+                        manifest["issues"][rid] = summary
+                finished(rid, ok)
+
+        workers = 1 + max(1, redmine_workers) + max(1, azure_workers)
+        with metrics.phase("migrate") as phase, ThreadPoolExecutor(max_workers=workers) as executor:
+            redmine = [executor.submit(list_issues)] + [executor.submit(dump_issues) for _ in range(redmine_workers)]
+            azure = [executor.submit(export_issues) for _ in range(azure_workers)]
+            for f in redmine:
+                f.result()
+            for _ in azure:
+                dumped.put(None)
+            for f in azure:
+                f.result()
+
+        self.exporter.save_map()
+        waiting = self.state.deferred_links()
+        if waiting:
+            print(f"Warning: {len(waiting)} links wait for items which are not in Azure yet, "
+                  f"they are added when the items are migrated: "
+                  f"{', '.join(sorted({target for target, _, _ in waiting}))}")
+
+        # failed issues have to be listed again next time, so the synchronization time is moved only on success
+        if not failed and progress["listed"] and self.importer.listedOn:
+            manifest["syncedOn"] = self.importer.listedOn
+        self.importer.save_manifest(manifest)
+
+        if failed:
+            print(f"Error: failed to migrate {len(failed)} issues: {', '.join(failed)}")
+
+        return not failed and progress["listed"]
+
+    def export(self, rid: str, combined: bool = Configuration.azureCombinedPatch, updated: bool = False) -> bool:
+        """
+        create work item of a fetched issue, upload its attachments, patch it and add links to the items
+        which are in Azure already; links of other items waiting for this one are added as soon as it's created
+        :param rid: Redmine ID
+        :param combined: patch fields and attachments of the item by one request
+        :param updated: the issue has changed since its last export, fields and description of the existing
+        work item are sent again
+        :return: True if the work item is in Azure
+        """
+        a = self.exporter.item(rid)
+        aid = self.exporter.redmineToAzureMap.get(rid)
+        if aid:
+            a.id = aid
+            if updated and not a.update_workitem():
+                return False
+        elif not a.create_workitem() or not a.id:
+            return False
+        else:
+            with self.lock:
+                self.exporter.redmineToAzureMap[rid] = f"{a.id}"
+            self.link_deferred(rid)
+
+        a.create_attachments()
+        a.patch(self.exporter.redmineToAzureMap, relations=False, combined=combined)
+
+        missing = []
+        with self.lock:
+            steps = a.relation_steps(self.exporter.redmineToAzureMap, missing)
+            for step, target in missing:
+                if not a.done(step):
+                    self.state.defer_link(rid, step, target)
+        a.patch_links(steps)
+        return True
+
+    def link_deferred(self, target: str):
+        """
+        add links which have been waiting for the item
+        :param target: Redmine ID of the item which is in Azure now
+        """
+        target_id = self.exporter.redmineToAzureMap[target]
+        for _, rid, step in self.state.deferred_links(target):
+            aid = self.exporter.redmineToAzureMap.get(rid)
+            if not aid:
+                continue
+            a = AzureItem(self.store, rid, os.path.join(self.exporter.workingDir, rid), self.state)
+            a.id = aid
+            if a.patch_links([(step, a.link_op(step, target_id))]):
+                self.state.remove_link(rid, step, target)
+
+    def link_ready(self):
+        # links deferred by previous runs whose targets have been created since then
+        for target in {target for target, _, _ in self.state.deferred_links()}:
+            if target in self.exporter.redmineToAzureMap:
+                self.link_deferred(target)
+
+
+if __name__ == '__main__':
+    # python streamingMigration.py [audit dump directory]
+    # every run migrates issues changed since the previous one
+    StreamingMigration(dump_dir=sys.argv[1] if len(sys.argv) > 1 else '').run()
@@ -0,0 +1,108 @@
+import io
+import json
+import unittest
+import requests
+from contextlib import redirect_stdout
+from unittest import mock
+from azureBatch import AzureBatch
+
+
+def response(status: int, results: list[tuple[int, dict]] = None) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r._content = json.dumps({"value": [{"code": code, "body": json.dumps(body)} for code, body in results or []]}
+                            if 200 <= status < 300 else {"message": "error"}).encode()
+    return r
+
+
+class AzureBatchTest(unittest.TestCase):
+    def send(self, script: list, keys: list[str], recover=None, retries: int = 2) -> dict[str, dict]:
+        """
+        every request is answered by the next entry of the script: a response, an exception to raise
+        or a function of the keys sent; keys of every request are recorded in self.requests
+        """
+        self.requests = []
+
+        def post(url, data=None, **kwargs):
+            sent = [op["uri"] for op in json.loads(data)]
+            self.requests.append(sent)
+            answer = script.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer(sent) if callable(answer) else answer
+
+        batch = AzureBatch(size=10, retries=retries)
+        for k in keys:
+            batch.add(k, "PATCH", k, [])
+        with mock.patch("azure.Azure.post", side_effect=post), redirect_stdout(io.StringIO()):
+            return batch.send(recover=recover)
+
+    @staticmethod
+    def applied(sent: list[str]) -> requests.Response:
+        return response(200, [(200, {"id": k}) for k in sent])
+
+    def test_operation_results(self):
+        recovered = []
+
+        def recover(keys):
+            recovered.extend(keys)
+            return {"d": {"id": "found"}}
+
+        done = self.send([response(200, [(200, {"id": "a"}), (429, {}), (400, {}), (500, {}), (500, {})]),
+                          self.applied],
+                         ["a", "b", "c", "d", "e"], recover)
+        # throttled and not found ones are resent, rejected one is not
+        self.assertEqual(self.requests[1], ["b", "e"])
+        self.assertEqual(recovered, ["d", "e"])
+        self.assertEqual(done, {"a": {"id": "a"}, "b": {"id": "b"}, "d": {"id": "found"}, "e": {"id": "e"}})
+
+    def test_throttled_request_is_resent(self):
+        done = self.send([response(503), response(429), self.applied], ["a", "b"])
+        self.assertEqual(self.requests, [["a", "b"]] * 3)
+        self.assertEqual(set(done), {"a", "b"})
+
+    def test_request_which_never_reached_server_is_resent(self):
+        done = self.send([requests.ConnectTimeout("connect"), self.applied], ["a"])
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(set(done), {"a"})
+
+    def test_ambiguous_failure_is_not_resent_without_lookup(self):
+        for failure in (requests.ReadTimeout("read"), response(500)):
+            done = self.send([failure], ["a", "b"])
+            self.assertEqual(len(self.requests), 1)
+            self.assertEqual(done, {})
+
+    def test_ambiguous_failure_is_looked_up(self):
+        done = self.send([requests.ReadTimeout("read"), self.applied], ["a", "b"],
+                         recover=lambda keys: {"a": {"id": "found"}})
+        self.assertEqual(self.requests, [["a", "b"], ["b"]])
+        self.assertEqual(done, {"a": {"id": "found"}, "b": {"id": "b"}})
+
+    def test_failed_lookup_is_not_resent(self):
+        def recover(keys):
+            raise requests.ConnectionError("down")
+
+        done = self.send([response(502)], ["a"], recover)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(done, {})
+
+    def test_rejected_request_is_not_resent(self):
+        recover = mock.Mock(return_value={})
+        done = self.send([response(400)], ["a"], recover)
+        self.assertEqual(len(self.requests), 1)
+        recover.assert_not_called()
+        self.assertEqual(done, {})
+
+    def test_result_count_mismatch_is_ambiguous(self):
+        done = self.send([response(200, [(200, {"id": "a"})])], ["a", "b"])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(done, {})
+
+    def test_retries_are_limited(self):
+        done = self.send([response(503)] * 3, ["a"], retries=2)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(done, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from dumpStore import DumpStore, PackedDumpStore, convert
+
+
+def save_issue(store: DumpStore, rid: str, attachments: dict[str, bytes] = None, description: str = "<p>d</p>"):
+    attachments = attachments or {}
+    for name, content in attachments.items():
+        with open(store.staging_attachment(rid, name), "wb") as f:
+            f.write(content)
+    data = {"id": rid,
+            "attachments": [{"id": f"{n}", "filename": name} for n, name in enumerate(attachments)],
+            "notes": [{"id": 7, "author": "A", "created_on": "2024-01-01T00:00:00Z"}]}
+    store.save(rid, data, description, {7: f"<p>note of {rid}</p>"})
+
+
+class PackedDumpStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = self.dir.name
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def open(self) -> PackedDumpStore:
+        with redirect_stdout(io.StringIO()):
+            return PackedDumpStore(self.root)
+
+    def test_records_and_blobs(self):
+        store = self.open()
+        save_issue(store, "1", {"a.png": b"same", "b.txt": b"other"})
+        save_issue(store, "2", {"a.png": b"same"})
+        store.flush()
+
+        self.assertEqual(sorted(store.ids()), ["1", "2"])
+        self.assertEqual(store.description("1"), "<p>d</p>")
+        self.assertEqual(store.note("2", 7), "<p>note of 2</p>")
+        # the same content is kept once
+        self.assertEqual(store.attachment("1", "a.png"), store.attachment("2", "a.png"))
+        with open(store.attachment("1", "b.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"other")
+        self.assertEqual(store.attachment("1", "missing.png"), '')
+        self.assertEqual(store.attachment("3", "a.png"), '')
+
+    def test_last_record_wins(self):
+        store = self.open()
+        save_issue(store, "1", description="old")
+        save_issue(store, "1", description="new")
+        store.flush()
+        self.assertEqual(self.open().description("1"), "new")
+
+    def test_tail_scan_after_torn_write(self):
+        store = self.open()
+        save_issue(store, "1")
+        store.flush()
+        # saved after the index, then a record torn by a crash
+        save_issue(store, "2")
+        save_issue(store, "3")
+        pack_path = os.path.join(self.root, PackedDumpStore.pack_name)
+        with open(pack_path, "r+b") as pack:
+            pack.truncate(os.path.getsize(pack_path) - 5)
+
+        store = self.open()
+        self.assertEqual(sorted(store.ids()), ["1", "2"])
+        self.assertEqual(store.note("2", 7), "<p>note of 2</p>")
+
+        # the torn tail has been dropped, so new records are readable
+        save_issue(store, "3")
+        store.flush()
+        self.assertEqual(sorted(self.open().ids()), ["1", "2", "3"])
+
+    def test_damaged_index_is_rebuilt(self):
+        store = self.open()
+        save_issue(store, "1")
+        save_issue(store, "2")
+        store.flush()
+        with open(os.path.join(self.root, PackedDumpStore.index_name), "w") as index:
+            index.write("{broken")
+        self.assertEqual(sorted(self.open().ids()), ["1", "2"])
+
+
+class ConvertTest(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as root:
+            plain, packed, back = (os.path.join(root, d) for d in ("plain", "packed", "back"))
+            store = DumpStore(plain)
+            save_issue(store, "1", {"a.png": b"first"})
+            save_issue(store, "2", {"image.png": b"x", "b.txt": b"y"})
+            with open(os.path.join(plain, DumpStore.manifest_name), "w") as manifest:
+                manifest.write('{"issues": {}}')
+
+            with redirect_stdout(io.StringIO()):
+                self.assertTrue(convert(plain, packed, True))
+                self.assertTrue(convert(packed, back, False))
+
+            self.assertIsInstance(DumpStore.open(packed), PackedDumpStore)
+            result = DumpStore.open(back)
+            self.assertNotIsInstance(result, PackedDumpStore)
+            self.assertEqual(sorted(result.ids()), ["1", "2"])
+            for rid in ("1", "2"):
+                self.assertEqual(result.data(rid), store.data(rid))
+                self.assertEqual(result.description(rid), store.description(rid))
+                self.assertEqual(result.note(rid, 7), store.note(rid, 7))
+            with open(result.attachment("2", "image.png"), "rb") as f:
+                self.assertEqual(f.read(), b"x")
+            self.assertTrue(os.path.isfile(os.path.join(back, DumpStore.manifest_name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
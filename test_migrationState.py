@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+from migrationState import MigrationState
+
+
+class MigrationStateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.state = MigrationState(self.dir.name)
+
+    def tearDown(self):
+        self.state.close()
+        self.dir.cleanup()
+
+    def test_steps(self):
+        self.state.mark("1", "description")
+        self.state.mark("1", "attachment:a.png", '{"id": "x", "url": "u"}')
+        self.state.mark_all("1", ["note:5", "note:6"])
+        self.assertTrue(self.state.done("1", "description"))
+        self.assertFalse(self.state.done("2", "description"))
+        self.assertEqual(self.state.steps("1", "note:"), {"note:5": '', "note:6": ''})
+        self.assertEqual(self.state.attachments("1"), {"a.png": {"id": "x", "url": "u"}})
+
+        self.state.unmark("1", "description")
+        self.assertFalse(self.state.done("1", "description"))
+        self.assertTrue(self.state.done("1", "note:5"))
+
+    def test_missing(self):
+        for rid, aid in (("1", "101"), ("2", "102"), ("3", "103")):
+            self.state.set_azure_id(rid, aid)
+        self.state.mark("2", "description")
+        # steps of items which haven't been created don't count
+        self.state.mark("4", "description")
+        self.assertEqual(self.state.missing("description"), ["1", "3"])
+        self.assertEqual(self.state.map(), {"1": "101", "2": "102", "3": "103"})
+
+    def test_state_survives_reopening(self):
+        self.state.set_azure_id("1", "101")
+        self.state.mark("1", "closedate")
+        self.state.close()
+        self.state = MigrationState(self.dir.name)
+        self.assertEqual(self.state.azure_id("1"), "101")
+        self.assertTrue(self.state.done("1", "closedate"))
+
+    def test_merge(self):
+        self.state.set_azure_id("1", "101")
+        self.state.mark("1", "description", "here")
+        with tempfile.TemporaryDirectory() as other_dir:
+            other = MigrationState(other_dir, shared=True)
+            other.set_azure_id("1", "999")
+            other.set_azure_id("2", "102")
+            other.mark("1", "description", "there")
+            other.mark("2", "note:7")
+            other.add_blob("hash", "b1", "url")
+            other.close()
+            self.state.merge(os.path.join(other_dir, MigrationState.file_name))
+
+        # rows which are here already are kept
+        self.assertEqual(self.state.map(), {"1": "101", "2": "102"})
+        self.assertEqual(self.state.steps("1"), {"description": "here"})
+        self.assertTrue(self.state.done("2", "note:7"))
+        self.assertEqual(self.state.blob("hash"), {"id": "b1", "url": "url"})
+
+    def test_deferred_links(self):
+        self.state.defer_link("1", "parent", "9")
+        self.state.defer_link("2", "related:9", "9")
+        self.state.defer_link("2", "related:9", "9")
+        self.state.defer_link("3", "related:8", "8")
+        self.assertEqual(sorted(self.state.deferred_links("9")), [("9", "1", "parent"), ("9", "2", "related:9")])
+        self.assertEqual(len(self.state.deferred_links()), 3)
+
+        self.state.remove_link("1", "parent", "9")
+        self.assertEqual(self.state.deferred_links("9"), [("9", "2", "related:9")])
+
+
+if __name__ == '__main__':
+    unittest.main()
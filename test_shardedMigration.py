@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from configuration import Configuration
+from shardedMigration import ShardLeases
+
+
+class ShardLeasesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = self.dir.name
+        self.lease_time = Configuration.shardLeaseTime
+        Configuration.shardLeaseTime = 60
+
+    def tearDown(self):
+        Configuration.shardLeaseTime = self.lease_time
+        self.dir.cleanup()
+
+    def test_claim(self):
+        a, b = ShardLeases(self.root, "a"), ShardLeases(self.root, "b")
+        self.assertTrue(a.claim("0"))
+        self.assertTrue(a.claim("0"))
+        self.assertFalse(b.claim("0"))
+        self.assertEqual(b.holder("0"), "a")
+        self.assertTrue(b.claim("1"))
+
+        self.assertTrue(a.renew("0", {"create": 5}))
+        self.assertFalse(b.renew("0", {}))
+        a.release("0")
+        self.assertEqual(b.holder("0"), '')
+        self.assertTrue(b.claim("0"))
+
+    def test_finish(self):
+        a, b = ShardLeases(self.root, "a"), ShardLeases(self.root, "b")
+        self.assertTrue(a.claim("0"))
+        self.assertFalse(b.finish("0"))
+        self.assertTrue(a.finish("0"))
+        self.assertTrue(b.done("0"))
+        self.assertFalse(b.claim("0"))
+        self.assertFalse(a.claim("0"))
+
+    def test_expired_lease_is_taken_over(self):
+        a, b = ShardLeases(self.root, "a"), ShardLeases(self.root, "b")
+        self.assertTrue(a.claim("0"))
+        path = os.path.join(self.root, "0.lease")
+        with open(path, "r") as lease:
+            expired = dict(json.load(lease), expires=time.time() - 1)
+        with open(path, "w") as lease:
+            json.dump(expired, lease)
+
+        self.assertTrue(b.claim("0"))
+        # the old holder finds its lease lost
+        self.assertFalse(a.renew("0", {}))
+        self.assertFalse(a.finish("0"))
+        self.assertTrue(b.finish("0"))
+
+    def test_stale_lock_is_broken(self):
+        path = os.path.join(self.root, ShardLeases.lock_name)
+        with open(path, "w") as lock:
+            lock.write("crashed:0")
+        past = time.time() - ShardLeases.lock_timeout - 1
+        os.utime(path, (past, past))
+
+        self.assertTrue(ShardLeases(self.root, "a").claim("0"))
+        self.assertEqual(sorted(os.listdir(self.root)), ["0.lease"])
+
+    def test_one_of_concurrent_claims_wins(self):
+        path = os.path.join(self.root, ShardLeases.lock_name)
+        with open(path, "w") as lock:
+            lock.write("crashed:0")
+        past = time.time() - ShardLeases.lock_timeout - 1
+        os.utime(path, (past, past))
+
+        results = []
+        workers = [threading.Thread(target=lambda n=n: results.append(ShardLeases(self.root, f"w{n}").claim("0")))
+                   for n in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(sorted(os.listdir(self.root)), ["0.lease"])
+
+
+if __name__ == '__main__':
+    unittest.main()
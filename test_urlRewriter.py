@@ -0,0 +1,48 @@
+import unittest
+from urlRewriter import UrlRewriter, attachment_pattern
+
+
+class UrlRewriterTest(unittest.TestCase):
+    def rewrite(self, html: str, redmine_address: str = "https://redmine.example.com") -> tuple[str, list[str]]:
+        rewriter = UrlRewriter({"5": "AZ5", "7": "AZ7"})
+        rewriter.pattern = attachment_pattern(redmine_address)
+        return rewriter.rewrite(html)
+
+    def test_relative_links(self):
+        self.assertEqual(self.rewrite('<a href="/attachments/download/7/x.png">x</a> <img src=\'/attachments/5\'>'),
+                         ('<a href="AZ7">x</a> <img src=\'AZ5\'>', []))
+        self.assertEqual(self.rewrite('<img src=/attachments/thumbnail/7/200>'), ('<img src=AZ7>', []))
+        self.assertEqual(self.rewrite('see (/attachments/7) and /attachments/5/x(1).png'), ('see (AZ7) and AZ5', []))
+        self.assertEqual(self.rewrite('/attachments/5/a.txt'), ('AZ5', []))
+
+    def test_redmine_address(self):
+        self.assertEqual(self.rewrite('<a href="https://redmine.example.com/attachments/download/7/x.png">'),
+                         ('<a href="AZ7">', []))
+        self.assertEqual(self.rewrite('link:https://redmine.example.com/attachments/5'), ('link:AZ5', []))
+
+    def test_subdirectory(self):
+        address = "https://example.com/redmine/"
+        self.assertEqual(self.rewrite('<a href="/redmine/attachments/7">', address), ('<a href="AZ7">', []))
+        self.assertEqual(self.rewrite('<a href="https://example.com/redmine/attachments/7">', address),
+                         ('<a href="AZ7">', []))
+        self.assertEqual(self.rewrite('<a href="/attachments/7">', address), ('<a href="/attachments/7">', []))
+
+    def test_query_and_fragment(self):
+        self.assertEqual(self.rewrite('<img src="/attachments/download/7/x.png?t=1&amp;s=2">'), ('<img src="AZ7">', []))
+        self.assertEqual(self.rewrite('<a href="https://redmine.example.com/attachments/5?download=1#top">'),
+                         ('<a href="AZ5">', []))
+
+    def test_links_to_other_sites(self):
+        for html in ('<a href="https://github.com/foo/attachments/5">',
+                     '<a href="https://redmine.example.com.evil/attachments/5">',
+                     '<a href="https://other.example.com/redmine/attachments/download/7/x.png?t=1">',
+                     'path/attachments/5'):
+            self.assertEqual(self.rewrite(html), (html, []))
+
+    def test_unresolved(self):
+        html = '<a href="/attachments/download/9/x.png?t=1">x</a>'
+        self.assertEqual(self.rewrite(html), (html, ["9"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
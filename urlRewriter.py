@@ -0,0 +1,48 @@
+import re
+from urllib.parse import urlsplit
+from configuration import Configuration
+
+
+def attachment_pattern(redmine_address: str) -> re.Pattern:
+    """
+    links to Redmine attachments, relative or with Redmine address:
+    /attachments/download/<id>/<name>, /attachments/<id>/<name>, /attachments/thumbnail/<id>/<size>, /attachments/<id>
+    relative link starts at a boundary of an attribute or a word (after a quote, '=', '(' or whitespace),
+    so the same path in links to other sites isn't matched; query and fragment are a part of the link
+    :param redmine_address: Redmine url, path of Redmine installed to a subdirectory is a part of the links
+    :return: pattern with attachment id in the first group
+    """
+    address = urlsplit(redmine_address)
+    start = r"(?<![^\s\"'=(])"
+    if address.netloc:
+        start = f"(?:{re.escape(f'{address.scheme}://{address.netloc}')}|{start})"
+    path = re.escape(address.path.rstrip('/'))
+    return re.compile(rf"{start}{path}/attachments/(?:download/|thumbnail/)?(\d+)(?=[/\s\"'<>?#)]|$)"
+                      rf"(?:/[^\s\"'<>?#]*)?(?:[?#][^\s\"'<>]*)?")
+
+
+class UrlRewriter:
+    """
+    Rewrites all the links to Redmine attachments of an item by one pass over html,
+    download links, views, thumbnails and inline images alike
+    """
+    pattern = attachment_pattern(Configuration.redmineAddress)
+
+    def __init__(self, urls: dict[str, str]):
+        self.urls = urls  # Redmine attachment id -> Azure attachment url
+
+    def rewrite(self, html: str) -> tuple[str, list[str]]:
+        """
+        :param html: description or note
+        :return: html with Azure urls and Redmine ids of attachments which are not in Azure, links to them are kept
+        """
+        unresolved = []
+
+        def replace(m: re.Match) -> str:
+            url = self.urls.get(m.group(1))
+            if url is None:
+                unresolved.append(m.group(1))
+                return m.group(0)
+            return url
+
+        return self.pattern.sub(replace, html), unresolved